@@ -0,0 +1,131 @@
+"""
+Investment analytics benchmark: vectorized metrics against a row-by-row loop.
+
+Synthetic properties are scored twice: by `InvestmentAnalytics.compute` in one
+NumPy pass, and one row at a time with the same formulas, the way ad-hoc
+analyses iterate over a DataFrame. With a database URI, the refresh of the
+`article_metrics` table is then timed on a scratch articles table (dropped and
+refilled): full, with nothing changed, and with `--changed` of the prices
+changed:
+
+    python -m benchmarks.bench_analytics --rows 100000 sqlite:////tmp/bench.sqlite
+"""
+
+import argparse
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import sqlalchemy
+
+from benchmarks.bench_storage import make_rows
+from mega_hatsu import schema
+from mega_hatsu.analytics import ARTICLE_METRICS, InvestmentAnalytics
+from mega_hatsu.storage import open_backend
+
+
+def make_inputs(size, seed=0):
+    """
+    Builds synthetic inputs: prices of 5 to 200 million yen, gross yields of
+    6 to 14 % and 50 to 2000 kW of panels.
+
+    Args:
+        size (int): Number of properties.
+        seed (int): Seed of the generator.
+
+    Returns:
+        dict: Input field -> numpy.ndarray.
+    """
+    rng = np.random.default_rng(seed)
+    price = rng.uniform(5e6, 2e8, size)
+    return {
+        'sales_price': price,
+        'estimated_electricity_sales_revenue': price * rng.uniform(0.06, 0.14, size),
+        'total_panel_capacity': rng.uniform(50, 2000, size),
+    }
+
+
+def row_by_row(analytics, inputs):
+    """Computes the metrics one property at a time."""
+    results = []
+    for index in range(len(inputs['sales_price'])):
+        row = {field: values[index:index + 1] for field, values in inputs.items()}
+        results.append(analytics.compute(row))
+    return results
+
+
+def refresh(uri, analytics, inputs, changed):
+    """
+    Times the refreshes of the metrics table.
+
+    Args:
+        uri (str): Database URI.
+        analytics (InvestmentAnalytics): The analytics.
+        inputs (dict): Inputs of the properties.
+        changed (float): Share of the properties whose price changes.
+
+    Returns:
+        dict: Seconds of each refresh.
+    """
+    backend = open_backend(uri)
+    metadata = sqlalchemy.MetaData()
+    schema.articles_table(metadata)
+    schema.versions_table(metadata)
+    sqlalchemy.Table(ARTICLE_METRICS, metadata)
+    metadata.drop_all(backend.engine)
+    table = backend.ensure_schema()
+    rows = make_rows(table, len(inputs['sales_price']), datetime.now(timezone.utc))
+    for index, row in enumerate(rows):
+        for field, values in inputs.items():
+            row[field] = float(values[index])
+    with backend.engine.begin() as conn:
+        for start in range(0, len(rows), 1000):
+            backend.upsert(conn, table, rows[start:start + 1000])
+
+    results = {}
+    for phase in ('full', 'unchanged', 'changed'):
+        if phase == 'changed':
+            with backend.engine.begin() as conn:
+                conn.execute(sqlalchemy.text(
+                    'update articles set sales_price = sales_price * 0.95 where identifier in :identifiers ;'
+                ).bindparams(sqlalchemy.bindparam('identifiers', expanding=True)), {
+                    'identifiers': [row['identifier'] for row in rows[:int(len(rows) * changed)]]
+                })
+        start = time.perf_counter()
+        analytics.refresh(backend)
+        results[phase] = time.perf_counter() - start
+    backend.engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('uris', nargs='*', help='URIs of scratch databases')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--loop-rows', type=int, default=2000, help='properties scored by the row-by-row loop')
+    parser.add_argument('--changed', type=float, default=0.05)
+    args = parser.parse_args()
+
+    analytics = InvestmentAnalytics()
+    inputs = make_inputs(args.rows)
+    start = time.perf_counter()
+    analytics.compute(inputs)
+    vectorized = args.rows / (time.perf_counter() - start)
+    sample = {field: values[:args.loop_rows] for field, values in inputs.items()}
+    start = time.perf_counter()
+    row_by_row(analytics, sample)
+    looped = args.loop_rows / (time.perf_counter() - start)
+    print('vectorized: {:.0f} rows/s, row by row: {:.0f} rows/s ({:.0f}x)'.format(
+        vectorized, looped, vectorized / looped
+    ))
+
+    for uri in args.uris:
+        results = refresh(uri, analytics, inputs, args.changed)
+        print('{:<12} full {:.2f}s, unchanged {:.3f}s, {:.0%} changed {:.3f}s'.format(
+            sqlalchemy.engine.make_url(uri).get_backend_name(),
+            results['full'], results['unchanged'], args.changed, results['changed']
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+End-to-end crawl benchmark of `InfosSpider` against the local mock site.
+
+Starts `benchmarks.mock_server` in a background thread, crawls it with the
+project settings and reports items/sec, download latency percentiles, the
+longest stall of the reactor and the peak resident memory of the crawl. Each crawl profile runs in its own process
+(the Twisted reactor cannot be restarted):
+
+    python -m benchmarks.bench_crawl --listings 2000 --latency 50 --profiles polite standard bulk-refresh
+
+`--pipeline` also stores the items with `MegaHatsuPipeline`, using the
+`POSTGRES_*` settings (pass `-s NAME=VALUE` to override them), e.g. to compare
+the blocking and threaded database writes:
+
+    python -m benchmarks.bench_crawl --pipeline --profile bulk-refresh -s POSTGRES_ASYNC_WRITES=False
+    python -m benchmarks.bench_crawl --pipeline --profile bulk-refresh -s POSTGRES_ASYNC_WRITES=True
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from twisted.internet import task
+
+from benchmarks.mock_server import MockSite, serve
+from mega_hatsu.spiders.infos import InfosSpider
+
+
+def percentile(values, share):
+    """Returns the value below which `share` of the sorted values fall."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def crawl(args):
+    """
+    Runs one crawl against a fresh mock server.
+
+    Args:
+        args (argparse.Namespace): Parsed command line.
+
+    Returns:
+        dict: The measurements of the crawl.
+    """
+    site = MockSite(None, args.listings, args.per_page, args.day, args.churn)
+    server = serve(
+        site,
+        port=0,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate
+    )
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    # The links of the pages point to the port picked by the system.
+    site.base = base_url
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    settings = get_project_settings()
+    settings.set('MEGA_HATSU_BASE_URL', base_url, priority='cmdline')
+    settings.set('LOG_LEVEL', 'WARNING', priority='cmdline')
+    settings.set('TELNETCONSOLE_ENABLED', False, priority='cmdline')
+    if args.profile:
+        settings.set('CRAWL_PROFILE', args.profile, priority='cmdline')
+    if args.pipeline:
+        pipelines = dict(settings.getdict('ITEM_PIPELINES'), **{'mega_hatsu.pipelines.MegaHatsuPipeline': 300})
+        settings.set('ITEM_PIPELINES', pipelines, priority='cmdline')
+    for override in args.set:
+        name, _, value = override.partition('=')
+        settings.set(name, value, priority='cmdline')
+
+    latencies = []
+
+    def response_received(response, request, spider):
+        if 'download_latency' in request.meta:
+            latencies.append(request.meta['download_latency'])
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(InfosSpider)
+    crawler.signals.connect(response_received, signal=signals.response_received)
+
+    # A call scheduled every `interval` runs late by as long as the reactor is blocked.
+    interval = 0.01
+    ticks = []
+    stalls = [0.0]
+
+    def tick():
+        now = time.perf_counter()
+        if ticks:
+            stalls[0] = max(stalls[0], now - ticks[-1] - interval)
+        ticks[:] = [now]
+
+    def engine_started():
+        task.LoopingCall(tick).start(interval)
+
+    crawler.signals.connect(engine_started, signal=signals.engine_started)
+    start = time.perf_counter()
+    process.crawl(crawler)
+    process.start()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    stats = crawler.stats.get_stats()
+    items = stats.get('item_scraped_count', 0)
+    latencies.sort()
+    return {
+        'profile': args.profile or '-',
+        'listings': args.listings,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_sec': items / elapsed if elapsed else 0.0,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p95_ms': percentile(latencies, 0.95) * 1000,
+        'reactor_stall_ms': stalls[0] * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'responses_503': stats.get('downloader/response_status_count/503', 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listings', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--day', type=int, default=0)
+    parser.add_argument('--churn', type=float, default=0.02)
+    parser.add_argument('--latency', type=float, default=50.0, help='mean response delay in ms')
+    parser.add_argument('--jitter', type=float, default=20.0, help='response delay deviation in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--profile', default='', help='crawl profile of a single run')
+    parser.add_argument('--profiles', nargs='+', help='run one crawl per profile, in separate processes')
+    parser.add_argument('--pipeline', action='store_true', help='store items with MegaHatsuPipeline')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+
+    if not args.profiles:
+        result = crawl(args)
+        print(json.dumps(result) if args.json else result)
+        return
+
+    columns = (
+        'profile', 'items', 'seconds', 'items_per_sec',
+        'latency_p50_ms', 'latency_p95_ms', 'reactor_stall_ms', 'peak_rss_mb'
+    )
+    print(' '.join('{:>14}'.format(column) for column in columns))
+    for profile in args.profiles:
+        command = [sys.executable, '-m', 'benchmarks.bench_crawl', '--json', '--profile', profile]
+        for name in ('listings', 'per_page', 'day', 'churn', 'latency', 'jitter', 'error_rate'):
+            command += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+        if args.pipeline:
+            command.append('--pipeline')
+        for override in args.set:
+            command += ['-s', override]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(' '.join(
+            '{:>14}'.format('{:.1f}'.format(result[column]) if isinstance(result[column], float) else result[column])
+            for column in columns
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Item construction benchmark: `ItemLoader` + `MegaHatsuItem` against `MegaHatsuRecord`.
+
+The property fixtures are extracted once, then items are built from the raw
+values the way `InfosSpider.parse_individual` does with and without the
+`FAST_ITEMS` setting. The report gives the CPU time per item and the memory
+held by a batch of items, as retained between the spider and the pipeline
+flush:
+
+    python -m benchmarks.bench_items --items 10000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from scrapy.http import HtmlResponse
+from scrapy.loader import ItemLoader
+
+from benchmarks.bench_parse import PROPERTY_URL, load_pages
+from mega_hatsu.extractors import PropertyExtractor
+from mega_hatsu.items import MegaHatsuItem, MegaHatsuRecord
+
+
+def load_item(fields):
+    """Builds a `MegaHatsuItem` through an `ItemLoader`."""
+    loader = ItemLoader(MegaHatsuItem())
+    for field, values in fields.items():
+        loader.add_value(field, values)
+    return loader.load_item()
+
+
+def load_record(fields):
+    """Builds a `MegaHatsuRecord` directly."""
+    return MegaHatsuRecord.from_fields(fields)
+
+
+def measure(build, pages, count):
+    """
+    Builds `count` items from the extracted pages, in turn.
+
+    Args:
+        build (callable): Item factory taking the extracted fields.
+        pages (list): Extracted fields of the fixtures.
+        count (int): Number of items to build.
+
+    Returns:
+        tuple: (microseconds per item, bytes retained per item)
+    """
+    start = time.process_time()
+    for index in range(count):
+        build(pages[index % len(pages)])
+    cpu = (time.process_time() - start) / count * 1e6
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [build(pages[index % len(pages)]) for index in range(count)]
+    retained = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+    del items
+    return cpu, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000)
+    args = parser.parse_args()
+
+    extractor = PropertyExtractor()
+    pages = []
+    for url, body in load_pages('property', PROPERTY_URL):
+        fields = extractor.extract(HtmlResponse(url, body=body, encoding='utf-8').selector.root)
+        fields['url'] = url
+        fields['identifier'] = url.split('/')[-2]
+        pages.append(fields)
+
+    print('{:<18} {:>12} {:>12}'.format('items', 'us/item', 'B/item'))
+    for name, build in (('ItemLoader', load_item), ('MegaHatsuRecord', load_record)):
+        cpu, retained = measure(build, pages, args.items)
+        print('{:<18} {:>12.1f} {:>12.0f}'.format(name, cpu, retained))
+
+
+if __name__ == '__main__':
+    main()
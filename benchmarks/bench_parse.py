@@ -0,0 +1,235 @@
+"""
+Offline parse benchmark over the saved mega-hatsu pages in `benchmarks/fixtures`.
+
+Listing pages are replayed through `InfosSpider.parse_individuals` and property
+pages through `InfosSpider.parse_individual` as `HtmlResponse` objects, without
+any network access. The report gives pages/sec for both callbacks, and per
+field the extraction time, the input processor time of `MegaHatsuItem` and the
+memory allocated while extracting.
+
+    python -m benchmarks.bench_parse                   # report
+    python -m benchmarks.bench_parse --save-baseline   # report and store the baseline
+    python -m benchmarks.bench_parse --compare         # fail on regressions against it
+
+Listing pages live in `fixtures/listing/`, property pages in
+`fixtures/property/` (the file name is used as the property identifier).
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+from scrapy.http import HtmlResponse
+from scrapy.loader import ItemLoader
+from scrapy.utils.test import get_crawler
+
+from mega_hatsu.extractors import PageIndex
+from mega_hatsu.items import MegaHatsuItem
+from mega_hatsu.spiders.infos import InfosSpider
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures'
+BASELINE = pathlib.Path(__file__).parent / 'parse_baseline.json'
+LISTING_URL = 'https://mega-hatsu.com/article-for-sale/page/{}/'
+PROPERTY_URL = 'https://mega-hatsu.com/article-for-sale/{}/'
+
+
+def load_pages(kind, url_template):
+    """
+    Reads the fixtures of one kind.
+
+    Args:
+        kind (str): 'listing' or 'property'.
+        url_template (str): Template building the page URL from the file stem.
+
+    Returns:
+        list: (url, body) pairs.
+    """
+    return [
+        (url_template.format(path.stem.split('-')[-1] if kind == 'listing' else path.stem), path.read_bytes())
+        for path in sorted((FIXTURES / kind).glob('*.html'))
+    ]
+
+
+def pages_per_second(callback, pages, repeat):
+    """
+    Replays pages through a spider callback and measures its throughput.
+
+    A fresh `HtmlResponse` is built for every call so the lxml parse is
+    included, as it is during a crawl.
+
+    Args:
+        callback (callable): Spider callback.
+        pages (list): (url, body) pairs.
+        repeat (int): Number of passes over the pages.
+
+    Returns:
+        float: Pages per second.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for url, body in pages:
+            for _ in callback(HtmlResponse(url, body=body, encoding='utf-8')):
+                pass
+    return repeat * len(pages) / (time.perf_counter() - start)
+
+
+def field_profile(spider, pages, repeat):
+    """
+    Measures every field of the property pages separately.
+
+    Args:
+        spider (InfosSpider): The spider whose extractor is measured.
+        pages (list): (url, body) pairs of property pages.
+        repeat (int): Number of passes over the pages.
+
+    Returns:
+        dict: Field -> {'extract_us', 'process_us', 'alloc_bytes'} per page.
+            The document walk shared by all fields is reported as '<index>'.
+    """
+    extractor = spider.extractor
+    roots = [HtmlResponse(url, body=body, encoding='utf-8').selector.root for url, body in pages]
+    profile = defaultdict(lambda: defaultdict(float))
+    for _ in range(repeat):
+        for root in roots:
+            start = time.perf_counter()
+            page = PageIndex(root)
+            profile['<index>']['extract_us'] += time.perf_counter() - start
+            loader = ItemLoader(MegaHatsuItem())
+            for compiled in extractor.compiled:
+                field = compiled[0].field
+                start = time.perf_counter()
+                values = extractor.resolve(page, compiled)
+                profile[field]['extract_us'] += time.perf_counter() - start
+                start = time.perf_counter()
+                loader.add_value(field, values)
+                profile[field]['process_us'] += time.perf_counter() - start
+            start = time.perf_counter()
+            loader.load_item()
+            profile['<output>']['process_us'] += time.perf_counter() - start
+
+    tracemalloc.start()
+    for root in roots:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        page = PageIndex(root)
+        profile['<index>']['alloc_bytes'] += tracemalloc.get_traced_memory()[1] - before
+        for compiled in extractor.compiled:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            extractor.resolve(page, compiled)
+            profile[compiled[0].field]['alloc_bytes'] += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    calls = repeat * len(roots)
+    return {
+        field: {
+            'extract_us': values['extract_us'] / calls * 1e6,
+            'process_us': values['process_us'] / calls * 1e6,
+            'alloc_bytes': values['alloc_bytes'] / len(roots),
+        }
+        for field, values in profile.items()
+    }
+
+
+def run(repeat, rounds):
+    """
+    Runs the whole benchmark and keeps the best round of every measurement,
+    which is much less sensitive to machine noise than a single long run.
+
+    Args:
+        repeat (int): Number of passes over the fixtures per round.
+        rounds (int): Number of rounds.
+
+    Returns:
+        dict: The measurements, in the format of the baseline file.
+    """
+    spider = InfosSpider.from_crawler(get_crawler(InfosSpider))
+    listing = load_pages('listing', LISTING_URL)
+    properties = load_pages('property', PROPERTY_URL)
+    best = None
+    for _ in range(rounds):
+        results = {
+            'listing_pages_per_sec': pages_per_second(spider.parse_individuals, listing, repeat),
+            'property_pages_per_sec': pages_per_second(spider.parse_individual, properties, repeat),
+            'fields': field_profile(spider, properties, repeat),
+        }
+        if best is None:
+            best = results
+            continue
+        for key in ('listing_pages_per_sec', 'property_pages_per_sec'):
+            best[key] = max(best[key], results[key])
+        for field, values in results['fields'].items():
+            for metric, value in values.items():
+                best['fields'][field][metric] = min(best['fields'][field][metric], value)
+    return best
+
+
+def report(results):
+    print('listing pages/sec:  {:>10.1f}'.format(results['listing_pages_per_sec']))
+    print('property pages/sec: {:>10.1f}'.format(results['property_pages_per_sec']))
+    print()
+    print('{:<42} {:>12} {:>12} {:>12}'.format('field', 'extract us', 'process us', 'alloc B'))
+    for field, values in sorted(results['fields'].items(), key=lambda entry: -entry[1]['extract_us']):
+        print('{:<42} {:>12.2f} {:>12.2f} {:>12.0f}'.format(
+            field, values['extract_us'], values['process_us'], values['alloc_bytes']
+        ))
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Lists the measurements that got worse than the baseline by more than `tolerance`.
+
+    Args:
+        results (dict): Current measurements.
+        baseline (dict): Stored measurements.
+        tolerance (float): Accepted relative slowdown, e.g. 0.25 for 25%.
+
+    Returns:
+        list: Human readable descriptions of the regressions.
+    """
+    found = []
+    for key in ('listing_pages_per_sec', 'property_pages_per_sec'):
+        if results[key] < baseline[key] * (1 - tolerance):
+            found.append('{}: {:.1f} -> {:.1f}'.format(key, baseline[key], results[key]))
+    for field, values in results['fields'].items():
+        previous = baseline['fields'].get(field)
+        if previous is None:
+            continue
+        for metric in ('extract_us', 'process_us'):
+            # Ignore the noise of fields that only take a few microseconds.
+            if values[metric] > max(previous[metric] * (1 + tolerance), previous[metric] + 5):
+                found.append('{} {}: {:.2f} -> {:.2f}'.format(field, metric, previous[metric], values[metric]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=100, help='passes over the fixtures per round')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds, the best one is kept')
+    parser.add_argument('--baseline', type=pathlib.Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.rounds)
+    report(results)
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True))
+        print('\nbaseline saved to {}'.format(args.baseline))
+    if args.compare:
+        found = regressions(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if found:
+            print('\nregressions against {}:'.format(args.baseline))
+            for line in found:
+                print('  ' + line)
+            sys.exit(1)
+        print('\nno regression against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
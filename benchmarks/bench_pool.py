@@ -0,0 +1,67 @@
+"""
+Bulk re-parse benchmark: property pages to records with a `ParsePool`.
+
+The property fixtures are repeated up to `--pages` pages and parsed in order,
+in the current process and then with pools of every `--workers` size, the way
+a saved page archive is re-parsed. The report gives pages/sec and the speedup
+over the single process run:
+
+    python -m benchmarks.bench_pool --pages 5000 --workers 1 2 4 8
+
+The records of every pool are checked against the in-process ones.
+"""
+
+import argparse
+import time
+
+from benchmarks.bench_parse import PROPERTY_URL, load_pages
+from mega_hatsu.parsing import ParsePool, parse_page
+
+
+def run_local(pages):
+    """Parses the pages in the current process."""
+    return [parse_page(url, body, encoding) for url, body, encoding in pages]
+
+
+def run_pool(pages, workers, chunksize):
+    """
+    Parses the pages with a pool, the worker start-up included.
+
+    Args:
+        pages (list): (url, body, encoding) tuples.
+        workers (int): Number of worker processes.
+        chunksize (int): Pages sent to a worker at once.
+
+    Returns:
+        list: (record, errors) per page.
+    """
+    with ParsePool(workers) as pool:
+        return list(pool.map(pages, chunksize=chunksize))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chunksize', type=int, default=16)
+    args = parser.parse_args()
+
+    fixtures = load_pages('property', PROPERTY_URL)
+    pages = [fixtures[index % len(fixtures)] + ('utf-8',) for index in range(args.pages)]
+
+    start = time.perf_counter()
+    expected = run_local(pages)
+    local = len(pages) / (time.perf_counter() - start)
+    print('{:<10} {:>12} {:>8}'.format('workers', 'pages/s', 'speedup'))
+    print('{:<10} {:>12.0f} {:>8.2f}'.format('local', local, 1.0))
+    for workers in args.workers:
+        start = time.perf_counter()
+        results = run_pool(pages, workers, args.chunksize)
+        rate = len(pages) / (time.perf_counter() - start)
+        if [repr(record) for record, _ in results] != [repr(record) for record, _ in expected]:
+            raise SystemExit('records of the pool with {} workers differ'.format(workers))
+        print('{:<10} {:>12.0f} {:>8.2f}'.format(workers, rate, rate / local))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""
+Local stand-in for mega-hatsu.com, for load and throughput tests.
+
+Serves synthetic listings with the structure `InfosSpider` expects:
+
+    /robots.txt
+    /article-for-sale/                 first listing page, with `span.pages`
+    /article-for-sale/page/N/          listing pages, `h5 a` links to properties
+    /article-for-sale/<identifier>/    property pages (`property_detail_talbe`,
+                                       `plice_include`, `property_sub_table`...)
+
+Pages are generated from templates and a seed, so the same day always serves
+the same content. `--day` moves the inventory forward: every day a `--churn`
+share of the listings is delisted and replaced, and some prices change. Pages
+carry an `ETag` and answer conditional requests with 304.
+
+    python -m benchmarks.mock_server --listings 50000 --latency 50 --error-rate 0.01
+
+then crawl it with:
+
+    scrapy crawl infos -s MEGA_HATSU_BASE_URL=http://127.0.0.1:8765 -s ROBOTSTXT_OBEY=False
+"""
+
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFECTURES = [
+    ('北海道', ['釧路市', '帯広市', '苫小牧市']),
+    ('茨城県', ['笠間市', 'つくば市', '鉾田市']),
+    ('栃木県', ['那須塩原市', '大田原市']),
+    ('千葉県', ['香取市', '匝瑳市', '山武市']),
+    ('静岡県', ['浜松市', '掛川市']),
+    ('三重県', ['津市', '伊賀市']),
+    ('岡山県', ['岡山市', '美作市']),
+    ('福岡県', ['大牟田市', '北九州市']),
+    ('熊本県', ['八代市', '山鹿市']),
+    ('鹿児島県', ['鹿屋市', '霧島市']),
+]
+PANEL_MAKERS = ['カナディアンソーラー', 'ハンファQセルズ', 'JAソーラー', 'トリナソーラー', 'ネクストエナジー']
+PCS_MAKERS = ['オムロン', '田淵電機', 'ファーウェイ', '安川電機']
+INCLUDES = ['システム', '土地', '連系', '消費税', '造成', '保険', '登記', '防草シート', 'フェンス', '看板', '遠隔監視', '工事費']
+
+LISTING_PAGE = """<html><head><meta charset="utf-8"><title>販売中の物件一覧</title></head><body>
+<div class="article-list">
+{articles}
+</div>
+<div class="wp-pagenavi"><span class="pages">{page} / {pages}</span></div>
+</body></html>"""
+
+LISTING_ARTICLE = """<article><h5><a href="{url}">{title}</a></h5><p>利回り {yield_:.2f}%</p></article>"""
+
+PROPERTY_PAGE = """<html><head><meta charset="utf-8"><title>{title}</title></head><body>
+<div class="store-head">メガ発 物件情報</div>
+<h2>{title}</h2>
+<img class="property_img" src="{base}/wp-content/uploads/{identifier}.png">
+<table class="property_table">
+<tr><th>物件番号</th><td>{number:,}</td></tr>
+<tr><th>販売価格</th><td>{price_million:.2f}百万円<br>（税込 {price:,}円）</td></tr>
+<tr><th>利回り</th><td>{yield_:.2f}%</td></tr>
+</table>
+<table class="property_sub_table"><tbody>
+<tr><th>設置場所</th><td>{prefecture}{city}{district}</td></tr>
+<tr><th>販売区画数</th><td>{lots}区画</td></tr>
+<tr><th>保証</th><td>{guarantee}年</td></tr>
+</tbody></table>
+<div class="row plice_include">
+{includes}
+</div>
+<h3>そのほかにかかる費用・特徴</h3>
+<p>管理費 年間{maintenance}万円</p>
+<table class="property_detail_talbe">
+<tr><th>メーカー</th><td>{panel_maker}</td></tr>
+<tr><th>パネル総容量</th><td>{capacity:,.1f}kW</td></tr>
+<tr><th>型式</th><td>PV-{panel_watts}M</td></tr>
+<tr><th>最大出力</th><td>{panel_watts}W</td></tr>
+<tr><th>変換効率</th><td>{efficiency:.1f}%</td></tr>
+<tr><th>出力保証</th><td>25年</td></tr>
+<tr><th>製品保証</th><td>{warranty}年</td></tr>
+</table>
+<table class="property_detail_talbe">
+<tr><th>メーカー</th><td>{pcs_maker}</td></tr>
+<tr><th>型式</th><td>PCS-{pcs_capacity:.0f}</td></tr>
+<tr><th>パワコン総容量</th><td>{pcs_capacity:.1f}kW</td></tr>
+<tr><th>変換効率</th><td>{pcs_efficiency:.1f}%</td></tr>
+<tr><th>製品保証</th><td>10年</td></tr>
+</table>
+<p class="rate">想定表面利回り <strong>{yield_:.2f}</strong>%</p>
+<p class="rate_text">※ 想定売電収入(年間)÷販売価格</p>
+<table>
+<tr><th>観測地点</th><td>{city}</td></tr>
+<tr><th>年間想定発電量</th><td>{generation:,}kWh</td></tr>
+<tr><th>売電単価（税込）</th><td>{tariff:.1f}円</td></tr>
+<tr><th>想定売電収入(年間)</th><td>{revenue:,}円</td></tr>
+<tr><th>想定売電収入(20年)</th><td>{revenue_20:,}円</td></tr>
+<tr><th>二酸化炭素排出削減量</th><td>{co2:.1f}t</td></tr>
+<tr><th>杉の木に換算</th><td>{cedar:,}本</td></tr>
+</table>
+</body></html>"""
+
+PROPERTY_PATH = re.compile(r'^/article-for-sale/(plant-\d+)/$')
+LISTING_PATH = re.compile(r'^/article-for-sale/(?:page/(\d+)/)?$')
+
+
+class MockSite:
+    """
+    Synthetic inventory of the mock site for a given day.
+
+    Listing `n` is identified as 'plant-n'. On day `d` the listings
+    `d * churned` to `d * churned + listings - 1` are for sale, where `churned`
+    is the number of listings replaced per day.
+
+    Attributes:
+        base (str): Base URL the links point to.
+        listings (int): Number of listings for sale.
+        per_page (int): Listings per listing page.
+        day (int): Day of the simulated inventory.
+        churn (float): Share of the listings replaced per day.
+        seed (int): Seed of the generated content.
+    """
+
+    def __init__(self, base, listings, per_page=20, day=0, churn=0.02, seed=0):
+        self.base = base
+        self.listings = listings
+        self.per_page = per_page
+        self.day = day
+        self.churn = churn
+        self.seed = seed
+        self.first = day * int(listings * churn)
+
+    @property
+    def pages(self):
+        return max(1, -(-self.listings // self.per_page))
+
+    def is_listed(self, number):
+        return self.first <= number < self.first + self.listings
+
+    def listing(self, page):
+        """
+        Renders a listing page.
+
+        Args:
+            page (int): 1-based page number.
+
+        Returns:
+            str: The page HTML, or None when the page does not exist.
+        """
+        if not 1 <= page <= self.pages:
+            return None
+        start = self.first + (page - 1) * self.per_page
+        stop = min(start + self.per_page, self.first + self.listings)
+        articles = []
+        for number in range(start, stop):
+            values = self.values(number)
+            articles.append(LISTING_ARTICLE.format(
+                url='{}/article-for-sale/{}/'.format(self.base, values['identifier']),
+                title=values['title'],
+                yield_=values['yield_']
+            ))
+        return LISTING_PAGE.format(articles='\n'.join(articles), page=page, pages=self.pages)
+
+    def property(self, identifier):
+        """
+        Renders a property page.
+
+        Args:
+            identifier (str): The property identifier, 'plant-<n>'.
+
+        Returns:
+            str: The page HTML, or None when the property is not listed.
+        """
+        number = int(identifier.split('-')[1])
+        if not self.is_listed(number):
+            return None
+        values = self.values(number)
+        values['includes'] = '\n'.join(
+            '<div><span{}>{}</span></div>'.format(' class="active"' if flag else '', label)
+            for label, flag in zip(INCLUDES, values['flags'])
+        )
+        return PROPERTY_PAGE.format(base=self.base, **values)
+
+    def values(self, number):
+        """
+        Generates the content of a listing, stable for a given seed and day.
+
+        The price of about one listing in ten changes every day.
+
+        Args:
+            number (int): Listing number.
+
+        Returns:
+            dict: Template values.
+        """
+        rng = random.Random('{}-{}'.format(self.seed, number))
+        prefecture, cities = rng.choice(PREFECTURES)
+        city = rng.choice(cities)
+        capacity = round(rng.uniform(40, 1200), 1)
+        price = int(capacity * rng.uniform(180000, 260000))
+        if random.Random('{}-{}-{}'.format(self.seed, number, self.day)).random() < 0.1:
+            price = int(price * random.Random('{}-{}'.format(number, self.day)).uniform(0.9, 1.0))
+        generation = int(capacity * rng.uniform(1100, 1400))
+        tariff = rng.choice([14.3, 15.4, 19.8, 23.8, 25.3, 39.6])
+        revenue = int(generation * tariff)
+        pcs_capacity = round(capacity * rng.uniform(0.6, 0.9), 1)
+        return {
+            'identifier': 'plant-{}'.format(number),
+            'number': number,
+            'title': '{}{} 太陽光発電所 No.{}'.format(prefecture, city, number),
+            'prefecture': prefecture,
+            'city': city,
+            'district': '大字{}'.format(rng.choice(['東', '西', '南', '北', '中'])),
+            'price': price,
+            'price_million': price / 10**6,
+            'yield_': revenue / price * 100,
+            'lots': rng.randint(1, 4),
+            'guarantee': rng.choice([10, 15, 20]),
+            'flags': [rng.random() < 0.5 for _ in INCLUDES],
+            'maintenance': rng.randint(5, 30),
+            'panel_maker': rng.choice(PANEL_MAKERS),
+            'capacity': capacity,
+            'panel_watts': rng.choice([270, 300, 330, 365, 405]),
+            'efficiency': rng.uniform(16, 21),
+            'warranty': rng.choice([10, 12, 15]),
+            'pcs_maker': rng.choice(PCS_MAKERS),
+            'pcs_capacity': pcs_capacity,
+            'pcs_efficiency': rng.uniform(94, 98),
+            'generation': generation,
+            'tariff': tariff,
+            'revenue': revenue,
+            'revenue_20': revenue * 20,
+            'co2': generation * 0.000478,
+            'cedar': int(generation * 0.035),
+        }
+
+
+def make_handler(site, latency, jitter, error_rate):
+    """
+    Builds the request handler class serving a `MockSite`.
+
+    Args:
+        site (MockSite): The site to serve.
+        latency (float): Mean response delay in seconds.
+        jitter (float): Maximum deviation from the mean delay in seconds.
+        error_rate (float): Share of page requests answered with a 503.
+
+    Returns:
+        type: A `BaseHTTPRequestHandler` subclass.
+    """
+    counters = {'requests': 0, 'errors': 0, 'not_modified': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with lock:
+                counters['requests'] += 1
+            if self.path == '/robots.txt':
+                return self.send_page(200, 'User-agent: *\nDisallow:\n', 'text/plain')
+            if latency or jitter:
+                time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            if error_rate and random.random() < error_rate:
+                with lock:
+                    counters['errors'] += 1
+                return self.send_page(503, 'Service Unavailable', 'text/plain')
+            page = None
+            match = PROPERTY_PATH.match(self.path)
+            if match:
+                page = site.property(match.group(1))
+            else:
+                match = LISTING_PATH.match(self.path)
+                if match:
+                    page = site.listing(int(match.group(1) or 1))
+            if page is None:
+                return self.send_page(404, 'Not Found', 'text/plain')
+            self.send_page(200, page, 'text/html; charset=utf-8')
+
+        def send_page(self, status, text, content_type):
+            body = text.encode('utf-8')
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if status == 200 and self.headers.get('If-None-Match') == etag:
+                with lock:
+                    counters['not_modified'] += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if status == 200:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    Handler.counters = counters
+    return Handler
+
+
+def serve(site, host='127.0.0.1', port=8765, latency=0.0, jitter=0.0, error_rate=0.0):
+    """
+    Creates the mock server; call `serve_forever` on it, e.g. in a thread.
+
+    Args:
+        site (MockSite): The site to serve.
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free one.
+        latency (float): Mean response delay in seconds.
+        jitter (float): Maximum deviation from the mean delay in seconds.
+        error_rate (float): Share of page requests answered with a 503.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(site, latency, jitter, error_rate))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--listings', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--day', type=int, default=0, help='day of the simulated inventory')
+    parser.add_argument('--churn', type=float, default=0.02, help='share of listings replaced per day')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='response delay deviation in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    base = 'http://{}:{}'.format(args.host, args.port)
+    site = MockSite(base, args.listings, args.per_page, args.day, args.churn, args.seed)
+    server = serve(site, args.host, args.port, args.latency / 1000, args.jitter / 1000, args.error_rate)
+    print('serving {} listings on {} pages at {}'.format(args.listings, site.pages, base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
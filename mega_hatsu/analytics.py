@@ -0,0 +1,378 @@
+"""
+Investment metrics of the stored properties, precomputed in the `article_metrics` table.
+
+From the scraped sales price, annual electricity sales revenue and panel
+capacity, every property gets:
+
+- `price_per_kw`: sales price per kW of panels,
+- `revenue_per_kw`: annual revenue per kW of panels,
+- `gross_yield`: annual revenue / sales price, in percent,
+- per panel degradation scenario (`ANALYTICS_DEGRADATION`), the payback time
+  in years (`payback_years_<scenario>`) and the internal rate of return over
+  the `ANALYTICS_YEARS` of the feed-in tariff (`irr_<scenario>`). Scenarios are
+  named after the yearly degradation in percent: 0.005 gives `irr_0_5pct`.
+
+The revenue of the first year is the scraped one, reduced by the
+`ANALYTICS_OPERATING_COST` share, and decreases by the degradation rate every
+following year. Metrics are computed with NumPy over all the refreshed rows at
+once; the IRR is found by bisection on the closed form of the net present
+value, for every row in parallel.
+
+A refresh only recomputes the properties whose inputs (`INPUT_FIELDS`) or
+assumptions changed since their metrics were stored. Every metric column is
+indexed, so ranking the whole inventory (`rank`) is an index scan:
+
+    python -m mega_hatsu.analytics sqlite:///mega_hatsu.sqlite --rank irr_0_5pct
+
+`MegaHatsuPipeline` refreshes the table after every completed crawl when
+`ANALYTICS_ENABLED` is on.
+"""
+
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+import sqlalchemy
+
+from mega_hatsu.schema import ARTICLES
+from mega_hatsu.storage import open_backend
+
+ARTICLE_METRICS = 'article_metrics'
+
+# Columns of the articles table the metrics are computed from, copied to the
+# metrics table to detect the rows to refresh.
+INPUT_FIELDS = ('sales_price', 'estimated_electricity_sales_revenue', 'total_panel_capacity', 'Yield', 'status')
+
+# Rows upserted per statement.
+WRITE_BATCH_SIZE = 1000
+
+# Bounds of the IRR bisection and number of halvings (precision ~1e-18).
+IRR_BOUNDS = (-0.99, 10.0)
+IRR_ITERATIONS = 64
+
+
+def scenario_name(degradation):
+    """
+    Returns the column suffix of a degradation scenario.
+
+    Args:
+        degradation (float): Yearly degradation of the production, e.g. 0.005.
+
+    Returns:
+        str: The suffix, e.g. '0_5pct'.
+    """
+    return '{:g}pct'.format(round(degradation * 100, 6)).replace('.', '_')
+
+
+def metrics_table(metadata, degradations, name=ARTICLE_METRICS):
+    """
+    Builds the table definition of the investment metrics.
+
+    Args:
+        metadata (sqlalchemy.MetaData): Metadata the table is attached to.
+        degradations (iterable): Yearly degradation of every scenario.
+        name (str): Name of the table.
+
+    Returns:
+        sqlalchemy.Table: The table definition, keyed by `identifier`, with an
+            index on every metric.
+    """
+    metrics = ['price_per_kw', 'revenue_per_kw', 'gross_yield']
+    for degradation in degradations:
+        metrics += ['payback_years_' + scenario_name(degradation), 'irr_' + scenario_name(degradation)]
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column('identifier', sqlalchemy.Text, primary_key=True),
+        *[
+            sqlalchemy.Column(field, sqlalchemy.Text if field == 'status' else sqlalchemy.Float)
+            for field in INPUT_FIELDS
+        ],
+        sqlalchemy.Column('assumptions', sqlalchemy.Text),
+        sqlalchemy.Column('computed_at', sqlalchemy.DateTime(timezone=True)),
+        *[sqlalchemy.Column(metric, sqlalchemy.Float, index=True) for metric in metrics]
+    )
+
+
+def payback_years(price, cash_flow, degradation):
+    """
+    Computes the time for the cumulated revenue to reach the price.
+
+    Args:
+        price (numpy.ndarray): Sales prices.
+        cash_flow (numpy.ndarray): Net revenue of the first year.
+        degradation (float): Yearly degradation of the revenue.
+
+    Returns:
+        numpy.ndarray: Years, fractional; NaN when the price is never recovered
+            or an input is missing.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if degradation == 0:
+            years = price / cash_flow
+        else:
+            growth = 1 - degradation
+            # Cumulated revenue after t years: cash_flow * (1 - growth**t) / (1 - growth).
+            remaining = 1 - price * (1 - growth) / cash_flow
+            years = np.log(remaining) / np.log(growth)
+    return np.where((price > 0) & (cash_flow > 0) & np.isfinite(years), years, np.nan)
+
+
+def _npv(rate, price, cash_flow, growth, years):
+    """Net present value of buying at `price` for a declining annuity."""
+    discount = 1 / (1 + rate)
+    ratio = growth * discount
+    flat = np.abs(1 - ratio) < 1e-12
+    annuity = discount * np.where(flat, years, (1 - ratio ** years) / np.where(flat, 1, 1 - ratio))
+    return cash_flow * annuity - price
+
+
+def irr(price, cash_flow, degradation, years):
+    """
+    Computes the internal rate of return of every property.
+
+    The cash flows are -price at year 0, then cash_flow * (1 - degradation)**(t-1)
+    at the end of year t, for t = 1 .. years.
+
+    Args:
+        price (numpy.ndarray): Sales prices.
+        cash_flow (numpy.ndarray): Net revenue of the first year.
+        degradation (float): Yearly degradation of the revenue.
+        years (int): Number of years of revenue.
+
+    Returns:
+        numpy.ndarray: Yearly rates (0.08 for 8%); NaN when the rate is out of
+            `IRR_BOUNDS` or an input is missing.
+    """
+    growth = 1 - degradation
+    low = np.full(price.shape, IRR_BOUNDS[0])
+    high = np.full(price.shape, IRR_BOUNDS[1])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        valid = (
+            (price > 0) & (cash_flow > 0)
+            & (_npv(low, price, cash_flow, growth, years) > 0)
+            & (_npv(high, price, cash_flow, growth, years) < 0)
+        )
+        # The net present value decreases with the rate: keep the half where it changes sign.
+        for _ in range(IRR_ITERATIONS):
+            rate = (low + high) / 2
+            positive = _npv(rate, price, cash_flow, growth, years) > 0
+            low = np.where(positive, rate, low)
+            high = np.where(positive, high, rate)
+    return np.where(valid, (low + high) / 2, np.nan)
+
+
+def _nullable(values):
+    """Converts an array to a list, with None for the NaN and infinite values."""
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+class InvestmentAnalytics:
+    """
+    Computes the metrics of the `article_metrics` table and keeps it up to date.
+
+    Attributes:
+        degradations (tuple): Yearly degradation of every scenario.
+        years (int): Number of years of revenue of the IRR.
+        operating_cost (float): Share of the revenue spent on operations.
+        assumptions (str): The parameters above, stored with every row so that
+            changing them refreshes all the rows.
+        table (sqlalchemy.Table): The expected metrics table.
+    """
+
+    def __init__(self, degradations=(0.0, 0.005, 0.01), years=20, operating_cost=0.0):
+        """
+        Args:
+            degradations (iterable): Yearly degradation of every scenario.
+            years (int): Number of years of revenue of the IRR.
+            operating_cost (float): Share of the revenue spent on operations.
+        """
+        self.degradations = tuple(float(degradation) for degradation in degradations)
+        self.years = years
+        self.operating_cost = operating_cost
+        self.assumptions = 'years={};operating_cost={:g};degradation={}'.format(
+            years, operating_cost, ','.join('{:g}'.format(degradation) for degradation in self.degradations)
+        )
+        self.table = metrics_table(sqlalchemy.MetaData(), self.degradations)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates the analytics from the `ANALYTICS_*` settings.
+
+        Args:
+            settings (scrapy.settings.Settings): The crawler settings.
+
+        Returns:
+            InvestmentAnalytics: The analytics.
+        """
+        return cls(
+            degradations=[float(degradation) for degradation in settings.getlist('ANALYTICS_DEGRADATION')],
+            years=settings.getint('ANALYTICS_YEARS', 20),
+            operating_cost=settings.getfloat('ANALYTICS_OPERATING_COST'),
+        )
+
+    def compute(self, inputs):
+        """
+        Computes the metrics of many properties at once.
+
+        Args:
+            inputs (dict): Input field -> numpy.ndarray of floats, NaN when missing.
+
+        Returns:
+            dict: Metric column -> numpy.ndarray.
+        """
+        price = inputs['sales_price']
+        revenue = inputs['estimated_electricity_sales_revenue']
+        capacity = inputs['total_panel_capacity']
+        cash_flow = revenue * (1 - self.operating_cost)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                'price_per_kw': price / capacity,
+                'revenue_per_kw': revenue / capacity,
+                'gross_yield': revenue / price * 100,
+            }
+        for degradation in self.degradations:
+            name = scenario_name(degradation)
+            metrics['payback_years_' + name] = payback_years(price, cash_flow, degradation)
+            metrics['irr_' + name] = irr(price, cash_flow, degradation, self.years)
+        return metrics
+
+    def ensure_table(self, engine):
+        """
+        Creates the metrics table, recreating it when its metric columns differ
+        from the scenarios (its rows are derived, so nothing is lost).
+
+        Args:
+            engine (sqlalchemy.Engine): Engine connected to the database.
+        """
+        inspector = sqlalchemy.inspect(engine)
+        if inspector.has_table(self.table.name):
+            existing = {column['name'] for column in inspector.get_columns(self.table.name)}
+            if existing == {column.name for column in self.table.columns}:
+                return
+            self.table.drop(engine)
+        self.table.create(engine)
+
+    def stale_rows(self, conn, full=False):
+        """
+        Selects the inputs of the properties whose metrics must be computed.
+
+        Args:
+            conn (sqlalchemy.Connection): Connection to the database.
+            full (bool): Select every property, not only the changed ones.
+
+        Returns:
+            list: Rows of `identifier` and the `INPUT_FIELDS`.
+        """
+        articles = sqlalchemy.table(ARTICLES, *[sqlalchemy.column(field) for field in ('identifier',) + INPUT_FIELDS])
+        metrics = self.table
+        query = sqlalchemy.select(articles.c.identifier, *[articles.c[field] for field in INPUT_FIELDS])
+        if not full:
+            query = query.select_from(
+                articles.outerjoin(metrics, metrics.c.identifier == articles.c.identifier)
+            ).where(sqlalchemy.or_(
+                metrics.c.identifier.is_(None),
+                metrics.c.assumptions.is_distinct_from(self.assumptions),
+                *[metrics.c[field].is_distinct_from(articles.c[field]) for field in INPUT_FIELDS]
+            ))
+        return conn.execute(query).all()
+
+    def refresh(self, backend, full=False):
+        """
+        Recomputes and stores the metrics of the changed properties.
+
+        Args:
+            backend (StorageBackend): Backend of the database holding the articles table.
+            full (bool): Recompute every property.
+
+        Returns:
+            int: Number of properties refreshed.
+        """
+        self.ensure_table(backend.engine)
+        with backend.engine.connect() as conn:
+            rows = self.stale_rows(conn, full)
+        if not rows:
+            return 0
+        columns = list(zip(*rows))
+        identifiers = columns[0]
+        inputs = {
+            field: np.array(values, dtype=float)
+            for field, values in zip(INPUT_FIELDS, columns[1:])
+            if field != 'status'
+        }
+        values = {field: _nullable(array) for field, array in inputs.items()}
+        values.update((metric, _nullable(array)) for metric, array in self.compute(inputs).items())
+        values['status'] = columns[1 + INPUT_FIELDS.index('status')]
+        computed_at = datetime.now(timezone.utc)
+        records = [
+            dict(
+                {field: column[index] for field, column in values.items()},
+                identifier=identifier,
+                assumptions=self.assumptions,
+                computed_at=computed_at,
+            )
+            for index, identifier in enumerate(identifiers)
+        ]
+        with backend.engine.begin() as conn:
+            for start in range(0, len(records), WRITE_BATCH_SIZE):
+                backend.upsert(conn, self.table, records[start:start + WRITE_BATCH_SIZE])
+        return len(records)
+
+
+def rank(conn, metric, limit=20, ascending=False, include_deleted=False):
+    """
+    Returns the properties with the best values of a metric.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection to the database.
+        metric (str): Metric column, e.g. 'irr_0_5pct' or 'price_per_kw'.
+        limit (int): Number of properties.
+        ascending (bool): Lowest values first, e.g. for prices and payback times.
+        include_deleted (bool): Also rank the properties no longer listed.
+
+    Returns:
+        list: Mappings of the metrics table rows, best first.
+
+    Raises:
+        ValueError: If the metrics table has no such metric.
+    """
+    table = sqlalchemy.Table(ARTICLE_METRICS, sqlalchemy.MetaData(), autoload_with=conn)
+    metrics = [
+        column.name for column in table.columns
+        if column.name not in ('identifier', 'assumptions', 'computed_at') + INPUT_FIELDS
+    ]
+    if metric not in metrics:
+        raise ValueError('Unknown metric {!r}, expected one of: {}'.format(metric, ', '.join(metrics)))
+    column = table.c[metric]
+    query = sqlalchemy.select(table).where(column.is_not(None))
+    if not include_deleted:
+        query = query.where(sqlalchemy.or_(table.c.status.is_(None), table.c.status != 'deleted'))
+    query = query.order_by(column.asc() if ascending else column.desc()).limit(limit)
+    return conn.execute(query).mappings().all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('uri', help='URI of the database holding the articles table')
+    parser.add_argument('--full', action='store_true', help='recompute every property')
+    parser.add_argument('--degradation', type=float, nargs='+', default=[0.0, 0.005, 0.01])
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--operating-cost', type=float, default=0.0)
+    parser.add_argument('--rank', metavar='METRIC', help='print the best properties for a metric')
+    parser.add_argument('--ascending', action='store_true', help='rank the lowest values first')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    backend = open_backend(args.uri)
+    analytics = InvestmentAnalytics(args.degradation, args.years, args.operating_cost)
+    print('refreshed {} properties'.format(analytics.refresh(backend, full=args.full)))
+    if args.rank:
+        with backend.engine.connect() as conn:
+            for row in rank(conn, args.rank, args.limit, args.ascending):
+                print('{:<40} {:>16.4f}'.format(row['identifier'], row[args.rank]))
+    backend.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Compressed, content-addressed archive of the downloaded pages.
+
+Every listing and property page a crawl downloads can be kept in `ARCHIVE_DIR`,
+so that a fix of the extraction is applied to past pages with the
+`reextract` command instead of a new crawl of mega-hatsu.com:
+
+- `pages-<crawl date>.pack`: the page bodies, one zstd frame each, appended as
+  they are downloaded,
+- `index.sqlite`: where every body is (pack, offset, length), keyed by the hash
+  of its content, and which page was downloaded when (URL, identifier, kind,
+  crawl date, encoding).
+
+A body is stored once however many times it is downloaded, so the pages that
+do not change between crawls only cost an index row. Once `dictionary_samples`
+pages were stored, a zstd dictionary is trained on them and used for the next
+ones: pages of the site share most of their markup, which the dictionary holds
+instead of every frame.
+
+`zstandard` is only needed when the archive is used.
+"""
+
+import os
+import sqlite3
+
+from mega_hatsu.fingerprints import body_digest
+
+INDEX = 'index.sqlite'
+
+# Size of the trained dictionary, in bytes.
+DICTIONARY_SIZE = 112640
+
+
+class PageArchive:
+    """
+    Archive of pages in a directory.
+
+    Writes are committed every `commit_every` pages and on `close`; the pack
+    files are flushed first, so the index never points past their end.
+
+    Attributes:
+        path (str): Directory of the archive.
+        level (int): zstd compression level.
+        dictionary_samples (int): Pages stored before a dictionary is trained,
+            0 to never train one.
+        commit_every (int): Number of pending pages that triggers a commit.
+    """
+
+    def __init__(self, path, level=10, dictionary_samples=200, commit_every=200):
+        """
+        Opens the archive, creating it when needed.
+
+        Args:
+            path (str): Directory of the archive.
+            level (int): zstd compression level.
+            dictionary_samples (int): Pages stored before a dictionary is trained.
+            commit_every (int): Number of pending pages that triggers a commit.
+        """
+        import zstandard
+
+        self.zstandard = zstandard
+        self.path = path
+        self.level = level
+        self.dictionary_samples = dictionary_samples
+        self.commit_every = commit_every
+        self.pending = 0
+        self.packs = {}
+        self.samples = []
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, INDEX))
+        self.db.executescript(
+            'create table if not exists dictionaries (id integer primary key, data blob not null);'
+            'create table if not exists blobs ('
+            'digest text primary key, pack text not null, offset integer not null, '
+            'length integer not null, dictionary integer);'
+            'create table if not exists pages ('
+            'url text not null, crawl_date text not null, identifier text, kind text not null, '
+            'digest text not null, encoding text, primary key (url, crawl_date));'
+            'create index if not exists pages_identifier on pages (identifier, crawl_date);'
+            'create index if not exists pages_crawl_date on pages (crawl_date, kind);'
+        )
+        self.dictionaries = {
+            number: zstandard.ZstdCompressionDict(data)
+            for number, data in self.db.execute('select id, data from dictionaries')
+        }
+        self.dictionary = max(self.dictionaries, default=None)
+        self.compressor = self._compressor()
+        self.decompressors = {}
+
+    def _compressor(self):
+        """Returns a compressor using the latest dictionary, if any."""
+        dictionary = self.dictionaries.get(self.dictionary)
+        return self.zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+
+    def _pack(self, crawl_date):
+        """Returns the open pack file of a crawl date."""
+        pack = self.packs.get(crawl_date)
+        if pack is None:
+            pack = self.packs[crawl_date] = open(
+                os.path.join(self.path, 'pages-{}.pack'.format(crawl_date)), 'ab'
+            )
+        return pack
+
+    def add(self, url, body, crawl_date, kind, identifier=None, encoding=None):
+        """
+        Archives a downloaded page.
+
+        Args:
+            url (str): URL of the page.
+            body (bytes): Body of the page.
+            crawl_date (str): ISO date of the crawl.
+            kind (str): 'listing' or 'property'.
+            identifier (str): Property identifier of a property page.
+            encoding (str): Encoding of the body.
+
+        Returns:
+            bool: Whether the body was new to the archive.
+        """
+        digest = body_digest(body)
+        stored = self.db.execute('select 1 from blobs where digest = ?', (digest,)).fetchone() is None
+        if stored:
+            pack = self._pack(crawl_date)
+            frame = self.compressor.compress(body)
+            offset = pack.tell()
+            pack.write(frame)
+            self.db.execute(
+                'insert into blobs (digest, pack, offset, length, dictionary) values (?, ?, ?, ?, ?)',
+                (digest, os.path.basename(pack.name), offset, len(frame), self.dictionary)
+            )
+            self._sample(body)
+        self.db.execute(
+            'insert or replace into pages (url, crawl_date, identifier, kind, digest, encoding) '
+            'values (?, ?, ?, ?, ?, ?)',
+            (url, crawl_date, identifier, kind, digest, encoding)
+        )
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+        return stored
+
+    def _sample(self, body):
+        """Keeps the first bodies and trains the dictionary once there are enough."""
+        if self.dictionary is not None or not self.dictionary_samples:
+            return
+        self.samples.append(body)
+        if len(self.samples) < self.dictionary_samples:
+            return
+        dictionary = self.zstandard.train_dictionary(DICTIONARY_SIZE, self.samples, level=self.level)
+        self.samples = []
+        self.commit()
+        cursor = self.db.execute('insert into dictionaries (data) values (?)', (dictionary.as_bytes(),))
+        self.dictionary = cursor.lastrowid
+        self.dictionaries[self.dictionary] = dictionary
+        self.compressor = self._compressor()
+
+    def read(self, digest):
+        """
+        Reads a body from the archive.
+
+        Args:
+            digest (str): Hash of the body.
+
+        Returns:
+            bytes: The body.
+
+        Raises:
+            KeyError: If the archive has no such body.
+        """
+        row = self.db.execute(
+            'select pack, offset, length, dictionary from blobs where digest = ?', (digest,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        pack, offset, length, dictionary = row
+        with open(os.path.join(self.path, pack), 'rb') as file:
+            file.seek(offset)
+            frame = file.read(length)
+        decompressor = self.decompressors.get(dictionary)
+        if decompressor is None:
+            decompressor = self.decompressors[dictionary] = self.zstandard.ZstdDecompressor(
+                dict_data=self.dictionaries.get(dictionary)
+            )
+        return decompressor.decompress(frame)
+
+    def pages(self, kind='property', as_of=None, identifiers=None):
+        """
+        Lists the latest archived version of every page of a kind.
+
+        Args:
+            kind (str): 'listing' or 'property'.
+            as_of (str): ISO date, only pages downloaded until then.
+            identifiers (iterable): Only the pages of these properties.
+
+        Yields:
+            tuple: (url, identifier, crawl_date, digest, encoding), by URL.
+        """
+        self.commit()
+        query = (
+            'select p.url, p.identifier, p.crawl_date, p.digest, p.encoding from pages p '
+            'join (select url, max(crawl_date) as crawl_date from pages '
+            'where kind = ? and crawl_date <= ? group by url) latest '
+            'on latest.url = p.url and latest.crawl_date = p.crawl_date '
+        )
+        parameters = [kind, as_of or '9999-12-31']
+        if identifiers is not None:
+            identifiers = list(identifiers)
+            query += 'where p.identifier in ({}) '.format(', '.join('?' * len(identifiers)))
+            parameters += identifiers
+        yield from self.db.execute(query + 'order by p.url', parameters)
+
+    def commit(self):
+        """Flushes the pack files and commits the index."""
+        for pack in self.packs.values():
+            pack.flush()
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        """Commits the pending pages and closes the files."""
+        self.commit()
+        for pack in self.packs.values():
+            pack.close()
+        self.packs = {}
+        self.db.close()
@@ -0,0 +1,158 @@
+"""
+Crash-safe progress of `MegaHatsuPipeline` for resumable crawls.
+
+When a crawl runs with `JOBDIR`, Scrapy persists its request queue and the
+fingerprints of the requests already scheduled there. This module persists the
+pipeline side in the same directory:
+
+- `pipeline.json`, the checkpoint: the crawl time, the identifiers already
+  processed (written to the database) and the identifiers of the property
+  pages scheduled, replaced atomically after every flush,
+- `pipeline.journal.<n>`, one JSON line per item processed or property page
+  scheduled since the checkpoint, so items scraped but not flushed yet are not
+  lost when the process dies. A new segment starts with every batch, so the segments of a
+  batch can be removed once it is written while the next one is journaled.
+
+A restarted crawl reloads both and continues with the same identifier set,
+so properties processed before the restart are not reported as deleted, nor
+the ones whose page was in flight when the process died: Scrapy does not
+schedule those requests again, but the properties were listed.
+"""
+
+import glob
+import json
+import os
+from datetime import datetime
+
+CHECKPOINT = 'pipeline.json'
+JOURNAL = 'pipeline.journal'
+
+
+class PipelineCheckpoint:
+    """
+    Checkpoint and item journal of the pipeline in a job directory.
+
+    Attributes:
+        jobdir (str): The `JOBDIR` of the crawl.
+    """
+
+    def __init__(self, jobdir):
+        """
+        Opens the journal for appending, creating the job directory when needed.
+
+        Args:
+            jobdir (str): The `JOBDIR` of the crawl.
+        """
+        self.jobdir = jobdir
+        os.makedirs(jobdir, exist_ok=True)
+        self.checkpoint_path = os.path.join(jobdir, CHECKPOINT)
+        self.journal_path = os.path.join(jobdir, JOURNAL)
+        self.journal = None
+        self.sequence = max(self._segments(), default=-1) + 1
+
+    def _segments(self):
+        """Returns the numbers of the journal segments on disk, in order."""
+        numbers = []
+        for path in glob.glob(glob.escape(self.journal_path) + '.*'):
+            suffix = path.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        """Returns the path of a journal segment."""
+        return '{}.{}'.format(self.journal_path, number)
+
+    def load(self):
+        """
+        Reads the state left by a previous run of the job.
+
+        A truncated last journal line, written while the process died, is
+        ignored.
+
+        Returns:
+            tuple: (seen_at, seen, listed, entries) where seen_at is the crawl
+                time (None for a new job), seen the set of processed
+                identifiers, listed the set of identifiers whose page was
+                scheduled and entries the journal entries, in order.
+        """
+        seen_at, seen, listed = None, set(), set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding='utf-8') as file:
+                state = json.load(file)
+            seen_at = datetime.fromisoformat(state['seen_at'])
+            seen = set(state['seen'])
+            listed = set(state.get('listed', ()))
+        entries = []
+        for number in self._segments():
+            with open(self._segment_path(number), encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        return seen_at, seen, listed, entries
+
+    def record(self, entry):
+        """
+        Appends an entry to the journal.
+
+        Args:
+            entry (dict): JSON serializable entry.
+        """
+        if self.journal is None:
+            self.journal = open(self._segment_path(self.sequence), 'a', encoding='utf-8')
+        self.journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.journal.flush()
+
+    def rotate(self):
+        """
+        Closes the current journal segment, further entries go to a new one.
+
+        Returns:
+            int: Number of the new segment; the entries of the lower ones are
+                those of the batch being written.
+        """
+        self.close()
+        self.sequence += 1
+        return self.sequence
+
+    def commit(self, seen_at, seen, listed, upto):
+        """
+        Replaces the checkpoint and removes the journal segments it covers,
+        once their entries are in the database.
+
+        The checkpoint is written to a temporary file, synced and renamed over
+        the previous one, so a crash leaves either the old or the new state.
+        Only touches the files of the written batch, so it can run in the
+        writer thread while the next batch is journaled.
+
+        Args:
+            seen_at (datetime.datetime): Time of the crawl.
+            seen (set): Identifiers processed up to the written batch.
+            listed (set): Identifiers whose page was scheduled by then.
+            upto (int): Segment number returned by `rotate` for that batch.
+        """
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'seen_at': seen_at.isoformat(), 'seen': sorted(seen), 'listed': sorted(listed)}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.checkpoint_path)
+        for number in self._segments():
+            if number < upto:
+                os.remove(self._segment_path(number))
+
+    def clear(self):
+        """Removes the checkpoint and the journal of a finished job."""
+        self.close()
+        for number in self._segments():
+            os.remove(self._segment_path(number))
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def close(self):
+        """Closes the journal."""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
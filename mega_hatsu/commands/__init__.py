@@ -0,0 +1,2 @@
+# This package contains the custom Scrapy commands of the project
+# (see COMMANDS_MODULE in settings.py).
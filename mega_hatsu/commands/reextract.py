@@ -0,0 +1,159 @@
+"""
+`scrapy reextract`: runs the current extraction over the page archive.
+
+The latest archived version of every property page (see `PageArchive`) is
+parsed again with the current extractor and item processors, and the stored
+values that differ are updated in the database. Only the values found on the
+archived page change: a field the page does not have keeps its stored value,
+statuses and `last_seen` are left as they are, and properties missing from
+the database are skipped. A change of a tracked field (see `HISTORY_FIELDS`)
+is recorded as a new version in the same transaction. mega-hatsu.com is never
+contacted.
+
+    scrapy reextract                                  # every field
+    scrapy reextract --fields sales_price2 price_notes
+    scrapy reextract --as-of 2024-06-30 --workers 4 --dry-run
+"""
+
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import sqlalchemy
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from mega_hatsu.archive import PageArchive
+from mega_hatsu.items import RECORD_FIELDS
+from mega_hatsu.parsing import ParsePool, parse_page
+from mega_hatsu.pipelines import item_row
+from mega_hatsu.storage import database_uri, open_backend
+
+# Columns the command never changes.
+KEPT_COLUMNS = ('identifier', 'status')
+
+# Pages parsed and written per transaction.
+CHUNK_SIZE = 1000
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    requires_crawler_process = False
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Re-extract the archived property pages and update the stored rows'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--fields', nargs='+', metavar='FIELD', help='only update these fields (default: all)')
+        parser.add_argument('--as-of', metavar='DATE', help='use the pages archived until this ISO date')
+        parser.add_argument('--identifier', action='append', dest='identifiers', metavar='ID',
+                            help='only these properties (may be repeated)')
+        parser.add_argument('--workers', type=int, default=0, help='parse in this many processes')
+        parser.add_argument('--dry-run', action='store_true', help='report the changes without writing them')
+
+    def run(self, args, opts):
+        fields = opts.fields or [field for field in RECORD_FIELDS if field not in KEPT_COLUMNS]
+        unknown = sorted(set(fields) - set(RECORD_FIELDS) | set(fields) & set(KEPT_COLUMNS))
+        if unknown:
+            raise UsageError('Cannot re-extract: {}'.format(', '.join(unknown)))
+        columns = list(fields)
+        if {'installation_location', 'title', 'geodetic_point'} & set(fields):
+            columns += ['prefecture_code', 'municipality']
+
+        archive = PageArchive(self.settings.get('ARCHIVE_DIR', 'archive'))
+        backend = open_backend(database_uri(self.settings))
+        table = backend.ensure_schema()
+        pool = ParsePool(opts.workers) if opts.workers > 0 else None
+        changes = dict.fromkeys(columns, 0)
+        parsed = updated = 0
+        now = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        try:
+            pages = archive.pages('property', as_of=opts.as_of, identifiers=opts.identifiers)
+            while True:
+                chunk = [page for _, page in zip(range(CHUNK_SIZE), pages)]
+                if not chunk:
+                    break
+                inputs = [(url, archive.read(digest), encoding or 'utf-8') for url, _, _, digest, encoding in chunk]
+                results = pool.map(inputs) if pool is not None else (parse_page(*page) for page in inputs)
+                rows = {record['identifier']: item_row(record, columns) for record, _ in results}
+                parsed += len(rows)
+                rows = self._changed(backend, table, rows, changes)
+                if rows and not opts.dry_run:
+                    with backend.engine.begin() as conn:
+                        self._update(conn, table, rows)
+                        backend.record_versions(conn, list(rows), now)
+                updated += len(rows)
+        finally:
+            if pool is not None:
+                pool.close()
+            archive.close()
+            backend.engine.dispose()
+
+        print('{} {} of {} archived properties in {:.1f}s'.format(
+            'Would update' if opts.dry_run else 'Updated', updated, parsed, time.perf_counter() - start
+        ))
+        for column, count in changes.items():
+            if count:
+                print('  {}: {} changed'.format(column, count))
+
+    @staticmethod
+    def _changed(backend, table, rows, changes):
+        """
+        Keeps the re-extracted values that differ from the stored ones. Values
+        missing from the archived page (None) are never a change.
+
+        Args:
+            backend (StorageBackend): Backend of the database.
+            table (sqlalchemy.Table): The articles table.
+            rows (dict): Identifier -> re-extracted values.
+            changes (dict): Column -> number of changed rows, updated in place.
+
+        Returns:
+            dict: Identifier -> changed values of the stored properties.
+        """
+        columns = list(next(iter(rows.values())))
+        with backend.engine.connect() as conn:
+            stored = {
+                row['identifier']: row
+                for row in conn.execute(
+                    sqlalchemy.select(table.c.identifier, *[table.c[column] for column in columns])
+                    .where(table.c.identifier.in_(list(rows)))
+                ).mappings()
+            }
+        changed = {}
+        for identifier, row in rows.items():
+            if identifier not in stored:
+                continue
+            differing = {
+                column: row[column] for column in columns
+                if row[column] is not None and row[column] != stored[identifier][column]
+            }
+            for column in differing:
+                changes[column] += 1
+            if differing:
+                changed[identifier] = differing
+        return changed
+
+    @staticmethod
+    def _update(conn, table, rows):
+        """
+        Updates the changed values, with one statement per set of columns.
+
+        Args:
+            conn (sqlalchemy.Connection): Connection inside a transaction.
+            table (sqlalchemy.Table): The articles table.
+            rows (dict): Identifier -> changed values.
+        """
+        groups = defaultdict(list)
+        for identifier, row in rows.items():
+            groups[tuple(sorted(row))].append(dict(row, key=identifier))
+        for params in groups.values():
+            conn.execute(
+                table.update().where(table.c.identifier == sqlalchemy.bindparam('key')),
+                params
+            )
@@ -0,0 +1,308 @@
+"""
+Detection of properties relisted under a new identifier.
+
+The pipeline keys properties by their URL slug, so a plant relisted under a new
+slug is stored as 'new' and its former listing ends up 'deleted'.
+`RelistDetector` compares every new property with the stored properties not
+seen during the crawl so far and records the probable relists in the
+`article_relists` table, the new identifier pointing to the former one.
+
+Candidates are found through a blocking key rather than by comparing every
+pair: the prefecture and the total panel capacity, which a relisted plant
+keeps, within `RELIST_CAPACITY_TOLERANCE`. The lookup is a range scan of the
+(prefecture_code, total_panel_capacity) index of the articles table, so its
+cost does not grow with the history. The few candidates are then scored on:
+
+- the titles, as the Jaccard similarity of their character trigrams once the
+  listing tags (【値下げ】, No.12) are removed,
+- the municipality and the panel manufacturer, equal or not,
+- the sales price, relists often coming with a price change.
+
+Pairs scoring at least `RELIST_MIN_SCORE` are recorded. When a completed crawl
+finds the former listing still listed, the pair is a duplicate listing rather
+than a relist and is removed again (`prune`).
+
+    with engine.connect() as conn:
+        relisted = relists(conn, since=datetime(2024, 1, 1, tzinfo=timezone.utc))
+"""
+
+import functools
+import re
+import unicodedata
+
+import sqlalchemy
+
+from mega_hatsu.schema import ARTICLES
+
+ARTICLE_RELISTS = 'article_relists'
+
+# New properties whose candidates are looked up in one statement.
+LOOKUP_BATCH_SIZE = 100
+
+# Weight of every compared field in the score; capacity and prefecture are the blocking key.
+WEIGHTS = {
+    'title': 0.4,
+    'municipality': 0.2,
+    'manufacturer': 0.2,
+    'sales_price': 0.2,
+}
+
+# Relative price difference at which the price no longer counts as similar.
+PRICE_TOLERANCE = 0.3
+
+_LISTING_TAGS = re.compile(r'【[^】]*】|\[[^\]]*\]|No\.?\d+', re.IGNORECASE)
+
+
+def relists_table(metadata, name=ARTICLE_RELISTS):
+    """
+    Builds the table definition of the detected relists.
+
+    Args:
+        metadata (sqlalchemy.MetaData): Metadata the table is attached to.
+        name (str): Name of the table.
+
+    Returns:
+        sqlalchemy.Table: The table definition, keyed by the new identifier.
+    """
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column('identifier', sqlalchemy.Text, primary_key=True),
+        sqlalchemy.Column('previous_identifier', sqlalchemy.Text, index=True),
+        sqlalchemy.Column('score', sqlalchemy.Float),
+        sqlalchemy.Column('detected_at', sqlalchemy.DateTime(timezone=True), index=True),
+    )
+
+
+@functools.lru_cache(maxsize=16384)
+def title_shingles(title):
+    """
+    Returns the character trigrams of a title, without its listing tags.
+
+    Args:
+        title (str): Title of a listing.
+
+    Returns:
+        frozenset: The trigrams.
+    """
+    if not title:
+        return frozenset()
+    text = _LISTING_TAGS.sub('', unicodedata.normalize('NFKC', title))
+    text = re.sub(r'\s+', '', text)
+    return frozenset(text[index:index + 3] for index in range(max(1, len(text) - 2)))
+
+
+def _same(first, second):
+    """1 for equal values, 0 for different ones, 0.5 when one is unknown."""
+    if first is None or second is None:
+        return 0.5
+    return float(first == second)
+
+
+def score(new, old):
+    """
+    Scores the similarity of two properties of the same block.
+
+    Args:
+        new (mapping): The new property, with `title`, `municipality`,
+            `manufacturer` and `sales_price`.
+        old (mapping): A stored property with the same fields.
+
+    Returns:
+        float: Similarity from 0 to 1.
+    """
+    new_title, old_title = title_shingles(new['title']), title_shingles(old['title'])
+    if new_title and old_title:
+        title = len(new_title & old_title) / len(new_title | old_title)
+    else:
+        title = 0.5
+    if new['sales_price'] and old['sales_price']:
+        difference = abs(new['sales_price'] - old['sales_price']) / max(new['sales_price'], old['sales_price'])
+        price = max(0.0, 1 - difference / PRICE_TOLERANCE)
+    else:
+        price = 0.5
+    return (
+        WEIGHTS['title'] * title
+        + WEIGHTS['municipality'] * _same(new['municipality'], old['municipality'])
+        + WEIGHTS['manufacturer'] * _same(new['manufacturer'], old['manufacturer'])
+        + WEIGHTS['sales_price'] * price
+    )
+
+
+class RelistDetector:
+    """
+    Finds the former listing of new properties and records them as relists.
+
+    Attributes:
+        min_score (float): Lowest score of a recorded relist.
+        capacity_tolerance (float): Relative difference of panel capacity
+            within which two properties are compared.
+        table (sqlalchemy.Table): The relists table.
+    """
+
+    def __init__(self, min_score=0.75, capacity_tolerance=0.01):
+        """
+        Args:
+            min_score (float): Lowest score of a recorded relist.
+            capacity_tolerance (float): Relative difference of panel capacity
+                within which two properties are compared.
+        """
+        self.min_score = min_score
+        self.capacity_tolerance = capacity_tolerance
+        self.table = relists_table(sqlalchemy.MetaData())
+        self._articles = sqlalchemy.table(
+            ARTICLES,
+            sqlalchemy.column('identifier'),
+            sqlalchemy.column('title'),
+            sqlalchemy.column('municipality'),
+            sqlalchemy.column('manufacturer'),
+            sqlalchemy.column('sales_price'),
+            sqlalchemy.column('total_panel_capacity'),
+            sqlalchemy.column('prefecture_code'),
+            sqlalchemy.column('status'),
+            sqlalchemy.column('last_seen', sqlalchemy.DateTime(timezone=True)),
+        )
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates the detector from the `RELIST_*` settings.
+
+        Args:
+            settings (scrapy.settings.Settings): The crawler settings.
+
+        Returns:
+            RelistDetector: The detector.
+        """
+        return cls(
+            min_score=settings.getfloat('RELIST_MIN_SCORE', 0.75),
+            capacity_tolerance=settings.getfloat('RELIST_CAPACITY_TOLERANCE', 0.01),
+        )
+
+    def ensure_table(self, engine):
+        """
+        Creates the relists table when missing.
+
+        Args:
+            engine (sqlalchemy.Engine): Engine connected to the database.
+        """
+        self.table.create(engine, checkfirst=True)
+
+    def _block(self, row):
+        """Returns the condition selecting the candidates of a new property."""
+        articles = self._articles
+        capacity = row['total_panel_capacity']
+        if row['prefecture_code'] is None:
+            prefecture = articles.c.prefecture_code.is_(None)
+        else:
+            prefecture = articles.c.prefecture_code == row['prefecture_code']
+        return sqlalchemy.and_(
+            prefecture,
+            articles.c.total_panel_capacity.between(
+                capacity * (1 - self.capacity_tolerance), capacity * (1 + self.capacity_tolerance)
+            ),
+        )
+
+    def candidates(self, conn, rows, seen_at):
+        """
+        Selects the stored properties in the blocks of new properties that
+        were not seen during the crawl so far.
+
+        Args:
+            conn (sqlalchemy.Connection): Connection inside a transaction.
+            rows (list): Rows of the new properties.
+            seen_at (datetime.datetime): Time of the crawl.
+
+        Returns:
+            list: Mappings of the candidates.
+        """
+        articles = self._articles
+        found = []
+        for start in range(0, len(rows), LOOKUP_BATCH_SIZE):
+            batch = rows[start:start + LOOKUP_BATCH_SIZE]
+            found.extend(conn.execute(
+                sqlalchemy.select(articles)
+                .where(sqlalchemy.or_(*[self._block(row) for row in batch]))
+                .where(sqlalchemy.or_(articles.c.last_seen.is_(None), articles.c.last_seen < seen_at))
+            ).mappings().all())
+        return found
+
+    def detect(self, conn, backend, rows, seen_at):
+        """
+        Records the relists among new properties, in the transaction of their write.
+
+        Args:
+            conn (sqlalchemy.Connection): Connection inside a transaction.
+            backend (StorageBackend): Backend of the database.
+            rows (list): Rows of the properties just written with status 'new'.
+            seen_at (datetime.datetime): Time of the crawl.
+
+        Returns:
+            int: Number of relists recorded.
+        """
+        rows = [row for row in rows if row['total_panel_capacity']]
+        if not rows:
+            return 0
+        candidates = self.candidates(conn, rows, seen_at)
+        relisted = []
+        for row in rows:
+            best = None
+            for candidate in candidates:
+                if candidate['identifier'] == row['identifier'] or candidate['prefecture_code'] != row['prefecture_code']:
+                    continue
+                difference = abs(candidate['total_panel_capacity'] - row['total_panel_capacity'])
+                if difference > row['total_panel_capacity'] * self.capacity_tolerance:
+                    continue
+                similarity = score(row, candidate)
+                if similarity >= self.min_score and (best is None or similarity > best[1]):
+                    best = (candidate['identifier'], similarity)
+            if best is not None:
+                relisted.append({
+                    'identifier': row['identifier'],
+                    'previous_identifier': best[0],
+                    'score': best[1],
+                    'detected_at': seen_at,
+                })
+        if relisted:
+            backend.upsert(conn, self.table, relisted)
+        return len(relisted)
+
+    def prune(self, conn, seen_at):
+        """
+        Removes the relists of a completed crawl whose former listing is still listed.
+
+        Args:
+            conn (sqlalchemy.Connection): Connection inside a transaction.
+            seen_at (datetime.datetime): Time of the crawl.
+
+        Returns:
+            int: Number of pairs removed.
+        """
+        articles, relisted = self._articles, self.table
+        listed = sqlalchemy.select(articles.c.identifier).where(
+            sqlalchemy.or_(articles.c.status.is_(None), articles.c.status != 'deleted')
+        )
+        return conn.execute(
+            relisted.delete()
+            .where(relisted.c.detected_at == seen_at)
+            .where(relisted.c.previous_identifier.in_(listed))
+        ).rowcount
+
+
+def relists(conn, since=None):
+    """
+    Returns the recorded relists.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection to the database.
+        since (datetime.datetime): Only the relists detected from then on.
+
+    Returns:
+        list: Mappings with `identifier`, `previous_identifier`, `score` and
+            `detected_at`, most recent first.
+    """
+    table = relists_table(sqlalchemy.MetaData())
+    query = sqlalchemy.select(table)
+    if since is not None:
+        query = query.where(table.c.detected_at >= since)
+    return conn.execute(query.order_by(table.c.detected_at.desc(), table.c.identifier)).mappings().all()
@@ -0,0 +1,131 @@
+"""
+Columnar feed export of the items scraped from mega-hatsu.com.
+
+`ParquetItemExporter` writes Parquet files with a fixed, typed schema derived
+from the item fields: the numeric fields of `schema.NUMERIC_FIELDS` are
+doubles, the "price includes" flags of `schema.FLAG_FIELDS` small integers and
+everything else strings, so every file of every crawl has the same columns
+whether or not a value was found. Items are buffered column by column and
+written as a row group every `row_group_size` items, which keeps the memory of
+the export bounded by one row group instead of the whole crawl.
+
+Partitioning by crawl date is done with the feed URI, using the `crawl_date`
+attribute of the spider:
+
+    FEEDS = {
+        'exports/crawl_date=%(crawl_date)s/%(batch_id)d.parquet': {'format': 'parquet'},
+    }
+
+`pyarrow` is only needed when the exporter is used.
+"""
+
+from itemadapter import ItemAdapter
+from scrapy.exporters import BaseItemExporter
+
+from mega_hatsu.items import RECORD_FIELDS, MegaHatsuItem, MegaHatsuRecord
+from mega_hatsu.schema import FLAG_FIELDS, NUMERIC_FIELDS
+
+
+def arrow_schema(fields):
+    """
+    Returns the Arrow schema of the exported fields.
+
+    Args:
+        fields (iterable): Names of the exported fields, in column order.
+
+    Returns:
+        pyarrow.Schema: The schema.
+    """
+    import pyarrow
+
+    def column_type(field):
+        if field in NUMERIC_FIELDS:
+            return pyarrow.float64()
+        if field in FLAG_FIELDS:
+            return pyarrow.int8()
+        return pyarrow.string()
+
+    return pyarrow.schema([pyarrow.field(field, column_type(field)) for field in fields])
+
+
+class ParquetItemExporter(BaseItemExporter):
+    """
+    Streams items to a Parquet file, one row group every `row_group_size` items.
+
+    The columns are `fields_to_export` (i.e. `FEED_EXPORT_FIELDS`, duplicates
+    removed), or every item field when it is not set. Values that do not fit
+    the column type are stored as nulls rather than failing the export, and
+    list values of text fields are joined with newlines, as in the database.
+
+    Only property items are exported: the `SeenItem` of a property that did not
+    change (incremental crawls, listing delta mode) only carries its
+    identifier and is skipped.
+    """
+
+    def __init__(self, file, row_group_size=1000, compression='zstd', **kwargs):
+        """
+        Args:
+            file (file): Binary file opened by the feed storage.
+            row_group_size (int): Items per row group.
+            compression (str): Parquet compression codec.
+            **kwargs: Options of `BaseItemExporter` (`fields_to_export`, ...).
+        """
+        super().__init__(dont_fail=True, **kwargs)
+        import pyarrow.parquet
+        self.parquet = pyarrow.parquet
+        self.file = file
+        self.row_group_size = int(row_group_size)
+        self.compression = compression
+        fields = self.fields_to_export or RECORD_FIELDS
+        if isinstance(fields, dict):
+            fields = list(fields)
+        self.schema = arrow_schema(dict.fromkeys(fields))
+        self.columns = {field: [] for field in self.schema.names}
+        self.buffered = 0
+        self.writer = None
+
+    def start_exporting(self):
+        self.writer = self.parquet.ParquetWriter(self.file, self.schema, compression=self.compression)
+
+    def export_item(self, item):
+        if not isinstance(item, (MegaHatsuItem, MegaHatsuRecord)):
+            return
+        adapter = ItemAdapter(item)
+        for field, values in self.columns.items():
+            values.append(self._convert(field, adapter.get(field)))
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self._write_row_group()
+
+    def finish_exporting(self):
+        if self.buffered:
+            self._write_row_group()
+        self.writer.close()
+
+    def _write_row_group(self):
+        """Writes the buffered items as one row group and empties the buffer."""
+        import pyarrow
+        table = pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.buffered)
+        for values in self.columns.values():
+            values.clear()
+        self.buffered = 0
+
+    @staticmethod
+    def _convert(field, value):
+        """Converts an item value to the Python type of its column."""
+        if value is None:
+            return None
+        if isinstance(value, list):
+            if field in NUMERIC_FIELDS or field in FLAG_FIELDS:
+                value = value[0] if value else None
+            else:
+                return '\n'.join(map(str, value))
+        try:
+            if field in NUMERIC_FIELDS:
+                return float(value)
+            if field in FLAG_FIELDS:
+                return int(value)
+        except (TypeError, ValueError):
+            return None
+        return str(value)
@@ -0,0 +1,326 @@
+"""
+Single-pass field extraction for mega-hatsu.com property pages.
+
+The fields of a property page are described by the declarative `FIELD_SPECS`
+table. `PropertyExtractor` compiles that table once (regexes, resolver lookups)
+and, for every page, walks the document a single time to index what the specs
+need: the `th` label -> `td` map of the detail tables, the "price includes" flag
+vector, the sub table rows and a handful of singular elements. Every field is
+then resolved from that index instead of re-scanning the document with its own
+XPath query.
+
+The values returned for a field are the same strings the former
+`ItemLoader.add_xpath` calls produced, so the `MegaHatsuItem` input and output
+processors apply unchanged.
+"""
+
+import re
+import time
+from collections import namedtuple
+
+from lxml import etree
+
+# A field of the property page.
+#   field:  name of the `MegaHatsuItem` field.
+#   source: where the value comes from (see `PropertyExtractor._resolve_*`).
+#   key:    label searched in `th` texts, or the row / checkbox position (1-based).
+#   index:  1-based position of the value to keep, None keeps them all.
+#   node:   'text' for the text nodes of the cells, 'element' for their HTML.
+#   regex:  pattern applied to every value, the matches replace the values.
+#   join:   separator the matches are joined with into a single value.
+FieldSpec = namedtuple(
+    'FieldSpec',
+    'field source key index node regex join',
+    defaults=(None, None, 'text', None, None)
+)
+
+# The site spells the class 'talbe'; the fixed spelling is accepted as well so
+# that a correction of the markup does not empty the detail fields.
+DETAIL_TABLE_CLASSES = ('property_detail_talbe', 'property_detail_table')
+SUB_TABLE_CLASS = 'property_sub_table'
+PRICE_INCLUDE_CLASS = 'row plice_include'
+
+FIELD_SPECS = (
+    FieldSpec('title', 'h2'),
+    FieldSpec('subtitle', 'store_head'),
+    FieldSpec('Map', 'map'),
+    FieldSpec('sales_price', 'label', '販売価格', index=1),
+    FieldSpec('Yield', 'label', '利回り', index=1, node='element', regex=r'\d+\.\d*'),
+    FieldSpec('property_number', 'label', '物件番号', index=1),
+    FieldSpec('installation_location', 'sub_table', 1),
+    FieldSpec('number_of_lots_sold', 'sub_table', 2),
+    FieldSpec('guarantee', 'sub_table', 3),
+    FieldSpec('system_price', 'price_include', 1),
+    FieldSpec('land_price_or_rent', 'price_include', 2),
+    FieldSpec('interconnection_price', 'price_include', 3),
+    FieldSpec('consumption_tax', 'price_include', 4),
+    FieldSpec('land_developpement', 'price_include', 5),
+    FieldSpec('insurrance_cost', 'price_include', 6),
+    FieldSpec('land_registration', 'price_include', 7),
+    FieldSpec('weed_prevention_sheet', 'price_include', 8),
+    FieldSpec('fence', 'price_include', 9),
+    FieldSpec('sign', 'price_include', 10),
+    FieldSpec('remote_monitoring', 'price_include', 11),
+    FieldSpec('construction_costs', 'price_include', 12),
+    FieldSpec('other_costs_and_features', 'section', 'そのほかにかかる費用・特徴'),
+    FieldSpec('manufacturer', 'detail_label', 'メーカー'),
+    FieldSpec('total_panel_capacity', 'detail_label', 'パネル総容量', regex=r'\d+[,\.\d]*'),
+    FieldSpec('Type', 'detail_label', '型式'),
+    FieldSpec('maximum_output', 'detail_label', '最大出力'),
+    FieldSpec('conversion_efficiency', 'detail_label', '変換効率', regex=r'\d+\.\d*'),
+    FieldSpec('output_guarantee', 'detail_label', '出力保証', regex=r'\d+'),
+    FieldSpec('product_warranty', 'detail_label', '製品保証', regex=r'\d+'),
+    FieldSpec('assumed_investement_surface_yield', 'rate', regex=r'\d*\.\d*'),
+    FieldSpec('irr_notes', 'rate_text'),
+    FieldSpec('geodetic_point', 'label', '観測地点'),
+    FieldSpec('estimated_annual_power_generation', 'label', '年間想定発電量', regex=r'\d+,\d*'),
+    FieldSpec('unit_price_per_unit_of_electricity_sold', 'label', '売電単価（税込）', regex=r'\d+\.\d*'),
+    FieldSpec('estimated_electricity_sales_revenue', 'label', '想定売電収入(年間)', regex=r'[\d,]+'),
+    FieldSpec('estimated_electricity_sales_income', 'label', '想定売電収入(20年)', regex=r'[\d,]+'),
+    FieldSpec('sales_price2', 'label', '販売価格', index=2, regex=r'[\d,]+'),
+    FieldSpec('price_notes', 'label', '販売価格', index=2, regex=r'\D+', join=' '),
+    FieldSpec('manufacturer2', 'label', 'メーカー', index=2),
+    FieldSpec('model', 'label', '型式', index=2),
+    FieldSpec('total_capacity_of_power_conditioner', 'label', 'パワコン総容量', regex=r'\d+\.\d*'),
+    FieldSpec('conversion_efficiency', 'label', '変換効率', index=2, regex=r'\d+'),
+    FieldSpec('product_warranty', 'label', '製品保証', index=2),
+    FieldSpec('carbon_dioxid_emission_reduction', 'label', '二酸化炭素排出削減量'),
+    FieldSpec('conversion_to_cedar_tree', 'label', '杉の木に換算'),
+)
+
+
+def _texts(element):
+    """Returns the child text nodes of an element, like XPath `text()`."""
+    texts = [element.text] if element.text is not None else []
+    texts.extend(child.tail for child in element if child.tail is not None)
+    return texts
+
+
+def _first_text(element):
+    """Returns the first child text node, as compared by `contains(text(), ...)`."""
+    texts = _texts(element)
+    return texts[0] if texts else ''
+
+
+def _classes(element):
+    """Returns the class tokens of an element."""
+    return (element.get('class') or '').split()
+
+
+class PageIndex:
+    """
+    Everything the field specs read from a property page, gathered in one walk.
+
+    Attributes:
+        headers (list): (label, th) pairs of the whole document, in document order.
+        detail_headers (list): (label, th) pairs of the first detail table.
+        sub_rows (dict): Row position -> text nodes of the sub table cells.
+        price_include (list): 0/1 flags of the "price includes" checkboxes.
+        sections (list): (label, h3) pairs of the section headings.
+        h2 (lxml.html.HtmlElement): First `h2` element.
+        store_head (list): Text nodes of the `div.store-head` elements.
+        map (list): Sources of the `img.property_img` elements.
+        rate (lxml.html.HtmlElement): First `p.rate` element.
+        rate_text (lxml.html.HtmlElement): First `p.rate_text` element.
+    """
+
+    def __init__(self, root):
+        """
+        Walks the document once and indexes the elements the specs need.
+
+        Args:
+            root (lxml.html.HtmlElement): Root of the parsed page.
+        """
+        self.headers = []
+        self.detail_headers = []
+        self.sub_rows = {}
+        self.price_include = []
+        self.sections = []
+        self.h2 = None
+        self.store_head = []
+        self.map = []
+        self.rate = None
+        self.rate_text = None
+        detail_table = None
+        for element in root.iter('th', 'table', 'div', 'img', 'h2', 'h3', 'p'):
+            tag = element.tag
+            if tag == 'th':
+                self.headers.append((_first_text(element), element))
+            elif tag == 'table':
+                css = element.get('class')
+                if css == SUB_TABLE_CLASS:
+                    self._index_sub_table(element)
+                elif css in DETAIL_TABLE_CLASSES and detail_table is None:
+                    detail_table = element
+            elif tag == 'div':
+                if element.get('class') == PRICE_INCLUDE_CLASS:
+                    self._index_price_include(element)
+                elif 'store-head' in _classes(element):
+                    self.store_head.extend(_texts(element))
+            elif tag == 'img':
+                if 'property_img' in _classes(element) and element.get('src') is not None:
+                    self.map.append(element.get('src'))
+            elif tag == 'h2':
+                if self.h2 is None:
+                    self.h2 = element
+            elif tag == 'h3':
+                self.sections.append((_first_text(element), element))
+            elif tag == 'p':
+                css = element.get('class')
+                if css == 'rate' and self.rate is None:
+                    self.rate = element
+                elif css == 'rate_text' and self.rate_text is None:
+                    self.rate_text = element
+        if detail_table is not None:
+            self.detail_headers = [(_first_text(th), th) for th in detail_table.iter('th')]
+
+    def _index_sub_table(self, table):
+        """Records the cell texts of a sub table by row position."""
+        positions = {}
+        for row in table.iter('tr'):
+            parent = row.getparent()
+            positions[parent] = positions.get(parent, 0) + 1
+            cells = self.sub_rows.setdefault(positions[parent], [])
+            for cell in row.iterchildren('td'):
+                cells.extend(_texts(cell))
+
+    def _index_price_include(self, row):
+        """Records which "price includes" checkboxes are active."""
+        for position, box in enumerate(row.iterchildren('div')):
+            active = any(span.get('class') == 'active' for span in box.iterchildren('span'))
+            if position == len(self.price_include):
+                self.price_include.append(int(active))
+            elif active:
+                self.price_include[position] = 1
+
+
+class PropertyExtractor:
+    """
+    Extracts the `MegaHatsuItem` fields of a property page from a `PageIndex`.
+
+    The specs are compiled when the extractor is created: regexes are compiled
+    and every spec is bound to its resolver, so extracting a page only walks the
+    document once and then runs plain dictionary and list lookups.
+    """
+
+    def __init__(self, specs=FIELD_SPECS):
+        """
+        Compiles the field specs.
+
+        Args:
+            specs (iterable): `FieldSpec` entries, in loader order.
+        """
+        self.compiled = [
+            (
+                spec,
+                getattr(self, '_resolve_{}'.format(spec.source)),
+                re.compile(spec.regex) if spec.regex else None,
+            )
+            for spec in specs
+        ]
+
+    def extract(self, root, timings=None):
+        """
+        Extracts the raw field values of a property page.
+
+        Args:
+            root (lxml.html.HtmlElement): Root of the parsed page, e.g.
+                `response.selector.root`.
+            timings (dict): When given, receives the seconds spent per field,
+                and on the document walk under '<index>'.
+
+        Returns:
+            dict: Field name -> list of values, ready for `ItemLoader.add_value`.
+                Fields listed twice in the specs accumulate their values.
+        """
+        if timings is not None:
+            return self._extract_timed(root, timings)
+        page = PageIndex(root)
+        fields = {}
+        for compiled in self.compiled:
+            fields.setdefault(compiled[0].field, []).extend(self.resolve(page, compiled))
+        return fields
+
+    def _extract_timed(self, root, timings):
+        """`extract`, timing the document walk and every field."""
+        start = time.perf_counter()
+        page = PageIndex(root)
+        timings['<index>'] = time.perf_counter() - start
+        fields = {}
+        for compiled in self.compiled:
+            field = compiled[0].field
+            start = time.perf_counter()
+            fields.setdefault(field, []).extend(self.resolve(page, compiled))
+            timings[field] = timings.get(field, 0.0) + time.perf_counter() - start
+        return fields
+
+    @staticmethod
+    def resolve(page, compiled):
+        """
+        Resolves a single compiled spec against an indexed page.
+
+        Args:
+            page (PageIndex): The indexed page.
+            compiled (tuple): (spec, resolver, regex) entry of `compiled`.
+
+        Returns:
+            list: The values of the spec.
+        """
+        spec, resolve, regex = compiled
+        values = resolve(page, spec)
+        if regex is not None:
+            values = [match for value in values for match in regex.findall(value)]
+        if spec.join is not None:
+            values = [spec.join.join(values)]
+        return values
+
+    @staticmethod
+    def _cells(headers, spec):
+        """Returns the values of the cells following the headers matching the label."""
+        values = []
+        for label, th in headers:
+            if spec.key in label:
+                for cell in th.itersiblings('td'):
+                    if spec.node == 'element':
+                        values.append(etree.tostring(cell, method='html', encoding='unicode', with_tail=False))
+                    else:
+                        values.extend(_texts(cell))
+        if spec.index is not None:
+            return values[spec.index - 1:spec.index]
+        return values
+
+    def _resolve_label(self, page, spec):
+        return self._cells(page.headers, spec)
+
+    def _resolve_detail_label(self, page, spec):
+        return self._cells(page.detail_headers, spec)
+
+    def _resolve_sub_table(self, page, spec):
+        return list(page.sub_rows.get(spec.key, []))
+
+    def _resolve_price_include(self, page, spec):
+        flags = page.price_include
+        return [flags[spec.key - 1] if spec.key <= len(flags) else 0]
+
+    def _resolve_section(self, page, spec):
+        values = []
+        for label, heading in page.sections:
+            if spec.key in label:
+                for paragraph in heading.itersiblings('p'):
+                    values.extend(_texts(paragraph))
+        return values
+
+    def _resolve_h2(self, page, spec):
+        return [page.h2.text_content() if page.h2 is not None else '']
+
+    def _resolve_store_head(self, page, spec):
+        return list(page.store_head)
+
+    def _resolve_map(self, page, spec):
+        return list(page.map)
+
+    def _resolve_rate(self, page, spec):
+        return [page.rate.text_content() if page.rate is not None else '']
+
+    def _resolve_rate_text(self, page, spec):
+        return [page.rate_text.text_content() if page.rate_text is not None else '']
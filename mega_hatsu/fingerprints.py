@@ -0,0 +1,105 @@
+"""
+On-disk cache of property page fingerprints for incremental crawls.
+
+For every property URL the cache keeps the `ETag` and `Last-Modified` headers
+of the last stored response and a hash of its body. They are used to send
+conditional requests and to recognise pages whose content did not change.
+The cache is a single SQLite file, so it survives between runs without any
+server.
+"""
+
+import hashlib
+import sqlite3
+
+
+def body_digest(body):
+    """
+    Hashes a response body.
+
+    Args:
+        body (bytes): The response body.
+
+    Returns:
+        str: Hex digest of the body.
+    """
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class FingerprintCache:
+    """
+    SQLite backed mapping of URL -> (etag, last_modified, digest).
+
+    Writes are committed every `commit_every` changes and on `close`.
+
+    Attributes:
+        path (str): Path of the SQLite file.
+        commit_every (int): Number of pending changes that triggers a commit.
+    """
+
+    def __init__(self, path, commit_every=500):
+        """
+        Opens the cache, creating the file when needed.
+
+        Args:
+            path (str): Path of the SQLite file.
+            commit_every (int): Number of pending changes that triggers a commit.
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'create table if not exists fingerprints ('
+            'url text primary key, etag text, last_modified text, digest text)'
+        )
+
+    def get(self, url):
+        """
+        Looks up the fingerprint of a URL.
+
+        Args:
+            url (str): The page URL.
+
+        Returns:
+            tuple: (etag, last_modified, digest), or None when the URL is unknown.
+        """
+        return self.db.execute(
+            'select etag, last_modified, digest from fingerprints where url = ?', (url,)
+        ).fetchone()
+
+    def set(self, url, etag, last_modified, digest):
+        """
+        Stores the fingerprint of a URL.
+
+        Args:
+            url (str): The page URL.
+            etag (str): Value of the `ETag` header, or None.
+            last_modified (str): Value of the `Last-Modified` header, or None.
+            digest (str): Hash of the response body.
+        """
+        self.db.execute(
+            'insert or replace into fingerprints (url, etag, last_modified, digest) values (?, ?, ?, ?)',
+            (url, etag, last_modified, digest)
+        )
+        self._changed()
+
+    def forget(self, url):
+        """
+        Removes the fingerprint of a URL so its next fetch is a full one.
+
+        Args:
+            url (str): The page URL.
+        """
+        self.db.execute('delete from fingerprints where url = ?', (url,))
+        self._changed()
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        """Commits the pending changes and closes the file."""
+        self.db.commit()
+        self.db.close()
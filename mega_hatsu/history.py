@@ -0,0 +1,88 @@
+"""
+Queries over the price, yield and status history of the scraped properties.
+
+The `article_versions` table (see `schema.record_versions`) holds one row per
+change of a property: the version valid from a crawl time until the next
+version of the same identifier. Both queries are answered from the
+(identifier, valid_from) primary key and run on every storage backend.
+
+    engine = sqlalchemy.create_engine(database_uri)
+    with engine.connect() as conn:
+        listings = listing_as_of(conn, datetime(2024, 1, 1, tzinfo=timezone.utc))
+        drops = price_drops(conn, days=30)
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy
+
+from mega_hatsu.schema import HISTORY_FIELDS
+
+_COLUMNS = ', '.join('v."{}"'.format(field) for field in HISTORY_FIELDS)
+
+
+def _times(*names):
+    """Returns timezone aware datetime bind parameters."""
+    return [sqlalchemy.bindparam(name, type_=sqlalchemy.DateTime(timezone=True)) for name in names]
+
+
+def listing_as_of(conn, when, include_deleted=False):
+    """
+    Returns the properties as they were listed at a given time.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection to the database.
+        when (datetime.datetime): Point in time, timezone aware.
+        include_deleted (bool): Also return the properties already delisted then.
+
+    Returns:
+        list: Mappings with `identifier`, `valid_from` and the `HISTORY_FIELDS`
+            of the version valid at `when`, ordered by identifier.
+    """
+    query = (
+        'select v.identifier, v.valid_from, {columns} from article_versions v '
+        'join ('
+        'select identifier, max(valid_from) as valid_from from article_versions '
+        'where valid_from <= :when group by identifier'
+        ') latest on latest.identifier = v.identifier and latest.valid_from = v.valid_from '
+        '{where} order by v.identifier ;'
+    ).format(
+        columns=_COLUMNS,
+        where='' if include_deleted else "where v.status is null or v.status <> 'deleted'",
+    )
+    statement = sqlalchemy.text(query).bindparams(*_times('when')).columns(
+        valid_from=sqlalchemy.DateTime(timezone=True)
+    )
+    return conn.execute(statement, {'when': when}).mappings().all()
+
+
+def price_drops(conn, days=7, now=None):
+    """
+    Returns the sales price decreases recorded in the last days.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection to the database.
+        days (int): Size of the window, in days.
+        now (datetime.datetime): End of the window, the current time by default.
+
+    Returns:
+        list: Mappings with `identifier`, `valid_from`, `previous_price`,
+            `sales_price` and `price_drop` (positive amount), most recent first.
+    """
+    now = now or datetime.now(timezone.utc)
+    query = (
+        'select identifier, valid_from, previous_price, sales_price, previous_price - sales_price as price_drop from ('
+        'select identifier, valid_from, sales_price, '
+        'lag(sales_price) over (partition by identifier order by valid_from) as previous_price '
+        'from article_versions '
+        'where identifier in (select identifier from article_versions where valid_from > :since)'
+        ') changes '
+        'where valid_from > :since and valid_from <= :now and sales_price < previous_price '
+        'order by valid_from desc, identifier ;'
+    )
+    return conn.execute(
+        sqlalchemy.text(query).bindparams(*_times('since', 'now')).columns(
+            valid_from=sqlalchemy.DateTime(timezone=True)
+        ),
+        {'since': now - timedelta(days=days), 'now': now}
+    ).mappings().all()
@@ -8,11 +8,22 @@ output processors to clean and standardize the scraped data.
 
 Processors:
     - output_processor=TakeFirst(): Only the first non-null value is taken from the scraped result.
-    - input_processor=lambda: Custom function to convert strings (e.g., with commas) to floats.
+    - input_processor=parse_numbers: Shared conversion of numeric strings (commas,
+      full-width digits, 万/億 units, ranges, kW/kWh...) to floats, see `processors.py`.
+
+`MegaHatsuRecord` is a compact alternative to `MegaHatsuItem` with the same
+fields, filled without an `ItemLoader` (see the `FAST_ITEMS` setting).
 """
 
+from types import MappingProxyType
+
 import scrapy
+from itemadapter import ItemAdapter
+from itemadapter.adapter import AdapterInterface
 from itemloaders.processors import TakeFirst
+from itemloaders.utils import arg_to_iter
+
+from mega_hatsu.processors import parse_numbers
 
 class MegaHatsuItem(scrapy.Item):
     """
@@ -35,11 +46,11 @@ class MegaHatsuItem(scrapy.Item):
         output_processor = TakeFirst()
     )#
     Yield = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     property_number = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     installation_location = scrapy.Field(
@@ -94,7 +105,7 @@ class MegaHatsuItem(scrapy.Item):
         output_processor = TakeFirst()
     )#
     total_panel_capacity = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     Type = scrapy.Field(
@@ -104,19 +115,19 @@ class MegaHatsuItem(scrapy.Item):
         output_processor = TakeFirst()
     )#
     conversion_efficiency = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     output_guarantee = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     product_warranty = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     assumed_investement_surface_yield = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     irr_notes= scrapy.Field(
@@ -126,23 +137,23 @@ class MegaHatsuItem(scrapy.Item):
         output_processor = TakeFirst()
     )#
     estimated_annual_power_generation = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     unit_price_per_unit_of_electricity_sold = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     estimated_electricity_sales_revenue = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     estimated_electricity_sales_income = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     sales_price2 = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     price_notes = scrapy.Field(
@@ -155,14 +166,7 @@ class MegaHatsuItem(scrapy.Item):
         output_processor = TakeFirst()
     )#
     total_capacity_of_power_conditioner = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
-        output_processor = TakeFirst()
-    )#
-    conversion_efficiency = scrapy.Field(
-        input_processor = lambda field_list : [float(number.replace(',','')) for number in field_list],
-        output_processor = TakeFirst()
-    )#
-    product_warranty = scrapy.Field(
+        input_processor = parse_numbers,
         output_processor = TakeFirst()
     )#
     carbon_dioxid_emission_reduction = scrapy.Field(
@@ -180,3 +184,191 @@ class MegaHatsuItem(scrapy.Item):
     url = scrapy.Field(
         output_processor = TakeFirst()
     )
+
+
+class SeenItem(scrapy.Item):
+    """
+    Marks a property as still listed without carrying its details.
+
+    Yielded instead of a `MegaHatsuItem` when the property page did not change
+    since the previous crawl, so the pipeline only refreshes the stored row's
+    status and last-seen time.
+    """
+    identifier = scrapy.Field()
+    url = scrapy.Field()
+
+
+# Column order of the feed exports (`FEED_EXPORT_FIELDS` in settings.py).
+EXPORT_FIELDS = [
+    'property_number',
+    'unit_price_per_unit_of_electricity_sold',
+    'total_capacity_of_power_conditioner',
+    'total_panel_capacity',
+    'Map',
+    'Type',
+    'Yield',
+    'assumed_investement_surface_yield',
+    'carbon_dioxid_emission_reduction',
+    'construction_costs',
+    'consumption_tax',
+    'conversion_efficiency',
+    'conversion_to_cedar_tree',
+    'estimated_annual_power_generation',
+    'estimated_electricity_sales_income',
+    'estimated_electricity_sales_revenue',
+    'fence',
+    'geodetic_point',
+    'guarantee',
+    'identifier',
+    'installation_location',
+    'insurrance_cost',
+    'interconnection_price',
+    'irr_notes',
+    'land_developpement',
+    'land_price_or_rent',
+    'land_registration',
+    'manufacturer',
+    'manufacturer2',
+    'maximum_output',
+    'model',
+    'number_of_lots_sold',
+    'other_costs_and_features',
+    'output_guarantee',
+    'price_notes',
+    'product_warranty',
+    'remote_monitoring',
+    'sales_price2',
+    'sign',
+    'status',
+    'subtitle',
+    'system_price',
+    'title',
+    'url',
+    'weed_prevention_sheet'
+]
+
+# Field order of `MegaHatsuRecord`: the export order, then the remaining item fields.
+RECORD_FIELDS = tuple(dict.fromkeys(
+    [field for field in EXPORT_FIELDS if field in MegaHatsuItem.fields]
+    + list(MegaHatsuItem.fields)
+))
+
+
+def _field_processors(field):
+    """Returns the (input, output) processors of a `MegaHatsuItem` field."""
+    meta = MegaHatsuItem.fields[field]
+    return meta.get('input_processor'), meta.get('output_processor')
+
+
+class MegaHatsuRecord:
+    """
+    Compact, slotted record of a property with the fields of `MegaHatsuItem`.
+
+    Attributes are stored in `__slots__` in `RECORD_FIELDS` order, without the
+    per-item dict of a `scrapy.Item`. A field set to None counts as missing,
+    like an unset `MegaHatsuItem` field. Records support item-style access and
+    are registered with `ItemAdapter`, so pipelines and feed exporters accept
+    them as they are.
+    """
+    __slots__ = RECORD_FIELDS
+
+    processors = {field: _field_processors(field) for field in RECORD_FIELDS}
+
+    def __init__(self, **values):
+        for field in RECORD_FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_fields(cls, fields):
+        """
+        Builds a record from raw extracted values, applying the `MegaHatsuItem`
+        input and output processors the way an `ItemLoader` would.
+
+        Args:
+            fields (dict): Field name -> raw value or list of raw values.
+
+        Returns:
+            MegaHatsuRecord: The record.
+        """
+        record = cls()
+        for field, values in fields.items():
+            input_processor, output_processor = cls.processors[field]
+            values = arg_to_iter(values)
+            if input_processor is not None:
+                values = arg_to_iter(input_processor(values))
+            if not values:
+                continue
+            setattr(record, field, output_processor(values) if output_processor is not None else list(values))
+        return record
+
+    def __getitem__(self, field):
+        value = getattr(self, field) if field in self.processors else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.processors:
+            raise KeyError('{} does not support field: {}'.format(self.__class__.__name__, field))
+        setattr(self, field, value)
+
+    def __delitem__(self, field):
+        self[field]
+        setattr(self, field, None)
+
+    def __iter__(self):
+        return (field for field in RECORD_FIELDS if getattr(self, field) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getstate__(self):
+        # Pickled as a bare tuple of values, e.g. when sent back by the
+        # process pool of `mega_hatsu.parsing`.
+        return tuple(getattr(self, field) for field in RECORD_FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(RECORD_FIELDS, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self
+        ))
+
+
+class MegaHatsuRecordAdapter(AdapterInterface):
+    """`ItemAdapter` support for `MegaHatsuRecord`."""
+
+    @classmethod
+    def is_item_class(cls, item_class):
+        return issubclass(item_class, MegaHatsuRecord)
+
+    @classmethod
+    def get_field_meta_from_class(cls, item_class, field_name):
+        return MappingProxyType(MegaHatsuItem.fields.get(field_name, {}))
+
+    @classmethod
+    def get_field_names_from_class(cls, item_class):
+        return list(RECORD_FIELDS)
+
+    def field_names(self):
+        return list(RECORD_FIELDS)
+
+    def __getitem__(self, field_name):
+        return self.item[field_name]
+
+    def __setitem__(self, field_name, value):
+        self.item[field_name] = value
+
+    def __delitem__(self, field_name):
+        del self.item[field_name]
+
+    def __iter__(self):
+        return iter(self.item)
+
+    def __len__(self):
+        return len(self.item)
+
+
+ItemAdapter.ADAPTER_CLASSES.appendleft(MegaHatsuRecordAdapter)
@@ -0,0 +1,272 @@
+"""
+Normalized locations of the properties, for regional queries.
+
+`installation_location` is a free-text Japanese address (e.g. '三重県津市大字南').
+`locate` parses it into the JIS X 0401 code of the prefecture and the name of
+the municipality, using the bundled `PREFECTURES` table:
+
+- the text is NFKC normalized (full-width digits and letters, spaces) and a
+  leading postal code is dropped,
+- the prefecture is the first full prefecture name found in the text, or a
+  name without its 都/府/県 suffix at the start of the text,
+- the municipality is the city, ward, town or village that follows, with its
+  county for towns and villages ('多気郡多気町'), and the city alone for the
+  wards of designated cities ('名古屋市').
+
+When the address has no prefecture, the title and then the geodetic point of
+the property are tried. Parses are memoized, as the same addresses come back
+every crawl.
+
+`MegaHatsuPipeline` stores the result in the indexed `prefecture_code` and
+`municipality` columns of the articles table (see `schema.articles_table`),
+and `find_listings` filters on them:
+
+    with engine.connect() as conn:
+        listings = find_listings(conn, region='kinki', min_yield=10, max_price=50000000)
+"""
+
+import functools
+import re
+import unicodedata
+from collections import namedtuple
+
+import sqlalchemy
+
+from mega_hatsu.schema import ARTICLES
+
+# JIS X 0401 code and name of the prefectures.
+PREFECTURES = (
+    (1, '北海道'), (2, '青森県'), (3, '岩手県'), (4, '宮城県'), (5, '秋田県'),
+    (6, '山形県'), (7, '福島県'), (8, '茨城県'), (9, '栃木県'), (10, '群馬県'),
+    (11, '埼玉県'), (12, '千葉県'), (13, '東京都'), (14, '神奈川県'), (15, '新潟県'),
+    (16, '富山県'), (17, '石川県'), (18, '福井県'), (19, '山梨県'), (20, '長野県'),
+    (21, '岐阜県'), (22, '静岡県'), (23, '愛知県'), (24, '三重県'), (25, '滋賀県'),
+    (26, '京都府'), (27, '大阪府'), (28, '兵庫県'), (29, '奈良県'), (30, '和歌山県'),
+    (31, '鳥取県'), (32, '島根県'), (33, '岡山県'), (34, '広島県'), (35, '山口県'),
+    (36, '徳島県'), (37, '香川県'), (38, '愛媛県'), (39, '高知県'), (40, '福岡県'),
+    (41, '佐賀県'), (42, '長崎県'), (43, '熊本県'), (44, '大分県'), (45, '宮崎県'),
+    (46, '鹿児島県'), (47, '沖縄県'),
+)
+
+# Prefecture codes of the eight regions.
+REGIONS = {
+    'hokkaido': (1,),
+    'tohoku': tuple(range(2, 8)),
+    'kanto': tuple(range(8, 15)),
+    'chubu': tuple(range(15, 24)),
+    'kinki': tuple(range(24, 31)),
+    'chugoku': tuple(range(31, 36)),
+    'shikoku': tuple(range(36, 40)),
+    'kyushu': tuple(range(40, 48)),
+}
+
+# Municipalities whose name contains a 市, 町, 村 or 郡 the rules would cut at.
+MUNICIPALITY_NAMES = (
+    '東村山市', '武蔵村山市', '大和郡山市', '郡山市', '郡上市', '蒲郡市', '小郡市',
+    '上市町', '市川三郷町', '余市町',
+)
+
+# Counties whose name contains a 市, which the county rule stops at.
+COUNTY_NAMES = ('余市郡', '高市郡')
+
+# Normalized location of a property.
+#   prefecture_code: JIS X 0401 code, None when not found.
+#   prefecture:      name of the prefecture.
+#   municipality:    name of the municipality, None when not found.
+Location = namedtuple('Location', 'prefecture_code prefecture municipality', defaults=(None, None, None))
+
+_CODES = {name: code for code, name in PREFECTURES}
+_SHORT_NAMES = {
+    re.sub('[都府県]$', '', name): code for code, name in PREFECTURES if name != '北海道'
+}
+_PREFECTURE = re.compile('|'.join(sorted(_CODES, key=len, reverse=True)))
+_POSTAL_CODE = re.compile(r'^〒?\d{3}-?\d{4}')
+_COUNTY = re.compile(r'^([^市区]{1,5}?郡)(?=.)')
+_MUNICIPALITY = re.compile(r'^.{1,8}?[市区町村]')
+
+
+def _municipality(text):
+    """Parses the municipality at the start of the text after the prefecture."""
+    county = next((name for name in COUNTY_NAMES if text.startswith(name)), '')
+    if not county:
+        match = _COUNTY.match(text)
+        if match and not text.startswith(MUNICIPALITY_NAMES):
+            county = match.group(1)
+    text = text[len(county):]
+    for name in MUNICIPALITY_NAMES:
+        if text.startswith(name):
+            return county + name
+    match = _MUNICIPALITY.match(text)
+    if match is None:
+        return None
+    name = match.group(0)
+    rest = text[len(name):]
+    # '四日市' + '市', '大町' + '市', '玉村' + '町': the suffix is part of the name.
+    if rest[:1] == '市' or (name[-1] in '町村' and rest[:1] == '町'):
+        name += rest[0]
+    return county + name
+
+
+@functools.lru_cache(maxsize=16384)
+def parse_location(text):
+    """
+    Parses an address into its prefecture and municipality.
+
+    Args:
+        text (str): Free-text Japanese address.
+
+    Returns:
+        Location: The location, with None for the parts not found.
+    """
+    if not text:
+        return Location()
+    text = re.sub(r'\s+', '', unicodedata.normalize('NFKC', text))
+    text = _POSTAL_CODE.sub('', text)
+    match = _PREFECTURE.search(text)
+    if match is not None:
+        name = match.group(0)
+        return Location(_CODES[name], name, _municipality(text[match.end():]))
+    for short_name, code in _SHORT_NAMES.items():
+        if text.startswith(short_name):
+            return Location(code, PREFECTURES[code - 1][1], _municipality(text[len(short_name):]))
+    return Location(None, None, _municipality(text))
+
+
+def locate(installation_location, title=None, geodetic_point=None):
+    """
+    Locates a property from its address, falling back to its title and its
+    geodetic point when the address has no prefecture.
+
+    Args:
+        installation_location (str): Address of the property.
+        title (str): Title of the listing, which usually starts with the place.
+        geodetic_point (str): Nearest observation point of the yield estimate.
+
+    Returns:
+        Location: The first location with a prefecture; otherwise the
+            municipality of the address alone.
+    """
+    address = parse_location(installation_location)
+    if address.prefecture_code is not None:
+        return address
+    for text in (title, geodetic_point):
+        location = parse_location(text)
+        if location.prefecture_code is not None:
+            if address.municipality is not None:
+                return location._replace(municipality=address.municipality)
+            return location
+    return address
+
+
+def prefecture_code(prefecture):
+    """
+    Returns the JIS X 0401 code of a prefecture.
+
+    Args:
+        prefecture (int or str): A code, or a name with or without its suffix.
+
+    Returns:
+        int: The code.
+
+    Raises:
+        ValueError: If the prefecture is unknown.
+    """
+    if isinstance(prefecture, int) and 1 <= prefecture <= len(PREFECTURES):
+        return prefecture
+    code = _CODES.get(prefecture) or _SHORT_NAMES.get(prefecture)
+    if code is None:
+        raise ValueError('Unknown prefecture {!r}'.format(prefecture))
+    return code
+
+
+def backfill_locations(engine, batch_size=1000):
+    """
+    Fills the location columns of the rows written before they existed.
+
+    Args:
+        engine (sqlalchemy.Engine): Engine connected to the database.
+        batch_size (int): Rows updated per statement.
+
+    Returns:
+        int: Number of rows located.
+    """
+    articles = _articles('identifier', 'installation_location', 'title', 'geodetic_point', 'prefecture_code', 'municipality')
+    with engine.begin() as conn:
+        rows = conn.execute(
+            sqlalchemy.select(articles.c.identifier, articles.c.installation_location, articles.c.title, articles.c.geodetic_point)
+            .where(articles.c.prefecture_code.is_(None), articles.c.municipality.is_(None))
+        ).all()
+        updates = []
+        for identifier, installation_location, title, geodetic_point in rows:
+            location = locate(installation_location, title, geodetic_point)
+            if location.prefecture_code is not None or location.municipality is not None:
+                updates.append({
+                    'key': identifier,
+                    'prefecture_code': location.prefecture_code,
+                    'municipality': location.municipality,
+                })
+        statement = articles.update().where(articles.c.identifier == sqlalchemy.bindparam('key'))
+        for start in range(0, len(updates), batch_size):
+            conn.execute(statement, updates[start:start + batch_size])
+    return len(updates)
+
+
+def find_listings(conn, prefectures=None, region=None, municipality=None, min_yield=None,
+                  max_price=None, min_price=None, include_deleted=False, limit=None):
+    """
+    Returns the properties of some prefectures or a region within yield and price bounds.
+
+    The filters are answered from the (prefecture_code, Yield) and
+    (prefecture_code, sales_price) indexes of the articles table, which holds
+    one row per property however many crawls ran.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection to the database.
+        prefectures (iterable): Prefecture codes or names.
+        region (str): One of `REGIONS`, combined with `prefectures`.
+        municipality (str): Name of the municipality, as stored.
+        min_yield (float): Lowest yield, in percent.
+        max_price (float): Highest sales price.
+        min_price (float): Lowest sales price.
+        include_deleted (bool): Also return the properties no longer listed.
+        limit (int): Maximum number of properties.
+
+    Returns:
+        list: Mappings with `identifier`, `title`, `url`, `installation_location`,
+            `prefecture_code`, `municipality`, `Yield`, `sales_price` and
+            `status`, highest yield first.
+
+    Raises:
+        ValueError: If a prefecture or the region is unknown.
+    """
+    articles = _articles(
+        'identifier', 'title', 'url', 'installation_location', 'prefecture_code',
+        'municipality', 'Yield', 'sales_price', 'status'
+    )
+    codes = set(prefecture_code(prefecture) for prefecture in prefectures or ())
+    if region is not None:
+        if region not in REGIONS:
+            raise ValueError('Unknown region {!r}, expected one of: {}'.format(region, ', '.join(REGIONS)))
+        codes.update(REGIONS[region])
+    query = sqlalchemy.select(articles)
+    if codes:
+        query = query.where(articles.c.prefecture_code.in_(sorted(codes)))
+    if municipality is not None:
+        query = query.where(articles.c.municipality == municipality)
+    if min_yield is not None:
+        query = query.where(articles.c.Yield >= min_yield)
+    if max_price is not None:
+        query = query.where(articles.c.sales_price <= max_price)
+    if min_price is not None:
+        query = query.where(articles.c.sales_price >= min_price)
+    if not include_deleted:
+        query = query.where(sqlalchemy.or_(articles.c.status.is_(None), articles.c.status != 'deleted'))
+    query = query.order_by(articles.c.Yield.desc(), articles.c.identifier)
+    if limit is not None:
+        query = query.limit(limit)
+    return conn.execute(query).mappings().all()
+
+
+def _articles(*columns):
+    """Returns a lightweight articles table with the given columns."""
+    return sqlalchemy.table(ARTICLES, *[sqlalchemy.column(name) for name in columns])
@@ -0,0 +1,289 @@
+"""
+Per-stage metrics of a crawl: where a slow run spends its time.
+
+`CrawlMetrics` holds the histograms and gauges of one crawler. The stages
+report into it when the `METRICS_ENABLED` setting is on:
+
+- `MegaHatsuDownloaderMiddleware`: download latency per callback,
+- `MegaHatsuSpiderMiddleware`: parse time per callback,
+- `InfosSpider`: extraction time per field, on a sample of property pages,
+- `MegaHatsuPipeline`: flush latency and the writes queued behind the writer
+  thread (queue depth 'pipeline_writes'),
+- `MetricsExtension`: queue depths of the engine (scheduler, downloader,
+  scraper, item pipelines).
+
+`MetricsExtension` copies a summary of every histogram into the Scrapy stats
+and writes all metrics in the Prometheus text format to `METRICS_FILE` every
+`METRICS_INTERVAL` seconds and when the spider closes. The file can be picked
+up by the node_exporter textfile collector or read directly.
+"""
+
+import bisect
+import os
+import threading
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.engine import get_engine_status
+
+PREFIX = 'mega_hatsu_'
+
+# Upper bounds of the histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CPU_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+HISTOGRAMS = {
+    'download_latency_seconds': ('Time from sending a request to receiving its response.', LATENCY_BUCKETS),
+    'parse_seconds': ('Time spent in a spider callback for one response.', CPU_BUCKETS),
+    'field_extract_seconds': ('Time spent resolving one field of a property page.', CPU_BUCKETS),
+    'pipeline_flush_seconds': ('Time spent writing one batch to the database.', LATENCY_BUCKETS),
+}
+
+GAUGES = {
+    'queue_depth': 'Number of requests, responses or items waiting in a stage.',
+}
+
+# Queue depth label -> expression of `scrapy.utils.engine.get_engine_status`.
+ENGINE_QUEUES = {
+    'scheduler_memory': 'len(engine.scheduler.mqs)',
+    'scheduler_disk': 'len(engine.scheduler.dqs or [])',
+    'downloader_active': 'len(engine.downloader.active)',
+    'scraper_queue': 'len(engine.scraper.slot.queue)',
+    'scraper_active': 'len(engine.scraper.slot.active)',
+    'item_processing': 'engine.scraper.slot.itemproc_size',
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as exposed by Prometheus.
+
+    Attributes:
+        buckets (tuple): Upper bounds of the buckets, in increasing order.
+        counts (list): Observations per bucket, the last one being +Inf.
+        count (int): Number of observations.
+        sum (float): Sum of the observations.
+    """
+
+    def __init__(self, buckets):
+        """
+        Args:
+            buckets (tuple): Upper bounds of the buckets, in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds an observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, share):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            share (float): The quantile, e.g. 0.95.
+
+        Returns:
+            float: The estimate, the largest bound for the +Inf bucket and 0.0
+                without observations.
+        """
+        rank = share * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if count and total >= rank:
+                return bound
+        return self.buckets[-1] if self.count else 0.0
+
+
+class CrawlMetrics:
+    """
+    Histograms and gauges of one crawl, keyed by metric name and labels.
+
+    Observations may come from the writer thread of the pipeline, so updates
+    and rendering hold a lock.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram of `HISTOGRAMS`.
+
+        Args:
+            name (str): Name of the histogram.
+            value (float): The observed value, in seconds.
+            **labels: Labels of the series, e.g. callback='parse_individual'.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets a gauge of `GAUGES`.
+
+        Args:
+            name (str): Name of the gauge.
+            value (float): The current value.
+            **labels: Labels of the series, e.g. queue='scheduler_memory'.
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def to_stats(self, stats):
+        """
+        Copies the count, mean and estimated 50th / 95th percentiles of every
+        histogram and the gauges into the Scrapy stats, e.g.
+        `metrics/parse_seconds/parse_individual/p95`.
+
+        Args:
+            stats (scrapy.statscollectors.StatsCollector): The crawl stats.
+        """
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                key = '/'.join(['metrics', name] + [value for _, value in labels])
+                stats.set_value(key + '/count', histogram.count)
+                stats.set_value(key + '/mean', histogram.sum / histogram.count)
+                stats.set_value(key + '/p50', histogram.quantile(0.5))
+                stats.set_value(key + '/p95', histogram.quantile(0.95))
+            for (name, labels), value in self.gauges.items():
+                stats.set_value('/'.join(['metrics', name] + [value for _, value in labels]), value)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        lines = []
+        with self.lock:
+            for name, (description, _) in HISTOGRAMS.items():
+                series = [(labels, histogram) for (key, labels), histogram in sorted(self.histograms.items()) if key == name]
+                if not series:
+                    continue
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for labels, histogram in series:
+                    total = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append('{}{}_bucket{} {}'.format(PREFIX, name, _labels(labels + (('le', str(bound)),)), total))
+                    lines.append('{}{}_sum{} {}'.format(PREFIX, name, _labels(labels), histogram.sum))
+                    lines.append('{}{}_count{} {}'.format(PREFIX, name, _labels(labels), histogram.count))
+            for name, description in GAUGES.items():
+                series = [(labels, value) for (key, labels), value in sorted(self.gauges.items()) if key == name]
+                if not series:
+                    continue
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+                lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+                for labels, value in series:
+                    lines.append('{}{}{} {}'.format(PREFIX, name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """Formats labels as `{name="value",...}`."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+
+def get_metrics(crawler):
+    """
+    Returns the metrics of a crawler, created on first use.
+
+    Args:
+        crawler (scrapy.crawler.Crawler): The crawler.
+
+    Returns:
+        CrawlMetrics: The metrics, or None when `METRICS_ENABLED` is off.
+    """
+    if not crawler.settings.getbool('METRICS_ENABLED'):
+        return None
+    if not hasattr(crawler, 'mega_hatsu_metrics'):
+        crawler.mega_hatsu_metrics = CrawlMetrics()
+    return crawler.mega_hatsu_metrics
+
+
+class MetricsExtension:
+    """
+    Samples the engine queues and publishes the metrics of the crawl.
+
+    Every `METRICS_INTERVAL` seconds and when the spider closes, the queue
+    depths are sampled, the histogram summaries are copied to the stats and
+    the Prometheus text file `METRICS_FILE` is replaced atomically.
+    """
+
+    def __init__(self, crawler, metrics, path, interval):
+        """
+        Args:
+            crawler (scrapy.crawler.Crawler): The crawler.
+            metrics (CrawlMetrics): The metrics of the crawl.
+            path (str): Prometheus text file, or '' to only fill the stats.
+            interval (float): Seconds between two publications.
+        """
+        self.crawler = crawler
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = get_metrics(crawler)
+        if metrics is None:
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            metrics,
+            crawler.settings.get('METRICS_FILE'),
+            crawler.settings.getfloat('METRICS_INTERVAL', 10.0),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        from twisted.internet import task
+        self.task = task.LoopingCall(self.publish)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.publish()
+
+    def sample_queues(self):
+        """Records the current depth of the engine queues."""
+        engine = self.crawler.engine
+        if engine is None or engine.spider is None:
+            return
+        status = dict(get_engine_status(engine))
+        for queue, expression in ENGINE_QUEUES.items():
+            value = status.get(expression)
+            if isinstance(value, int) and not isinstance(value, bool):
+                self.metrics.set_gauge('queue_depth', value, queue=queue)
+
+    def publish(self):
+        """Updates the stats and the Prometheus text file."""
+        self.sample_queues()
+        self.metrics.to_stats(self.crawler.stats)
+        if not self.path:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(self.metrics.render())
+        os.replace(temporary, self.path)
@@ -3,21 +3,50 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.misc import load_object
+from scrapy.utils.response import response_status_message
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from mega_hatsu.archive import PageArchive
+from mega_hatsu.fingerprints import FingerprintCache, body_digest
+from mega_hatsu.metrics import get_metrics
+from mega_hatsu.pipelines import batch_written
+from mega_hatsu.retry import (
+    FETCH_FAILURE_BUDGET_MIN, LISTING_CALLBACKS, RETRY_BUDGET_MIN, backoff_delay, get_fetch_failures, retry_after
+)
+
+
+def callback_name(request):
+    """Returns the name of the spider callback of a request, used as metric label."""
+    return getattr(request.callback, '__name__', 'parse')
+
 
 class MegaHatsuSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
     # passed objects.
+    #
+    # Measures the time spent in each spider callback (`parse_seconds`) when
+    # `METRICS_ENABLED` is on, see `metrics.py`.
+
+    def __init__(self, metrics):
+        self.metrics = metrics
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        metrics = get_metrics(crawler)
+        if metrics is None:
+            raise NotConfigured
+        s = cls(metrics)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
@@ -33,8 +62,34 @@ class MegaHatsuSpiderMiddleware:
         # it has processed the response.
 
         # Must return an iterable of Request, or item objects.
-        for i in result:
+        # Callbacks are generators, so their time is the time of `next` calls.
+        elapsed = 0.0
+        iterator = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                i = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield i
+        self.metrics.observe('parse_seconds', elapsed, callback=callback_name(response.request))
+
+    async def process_spider_output_async(self, response, result, spider):
+        # Same as process_spider_output(), for asynchronous spider output.
+        elapsed = 0.0
+        iterator = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                i = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
             yield i
+        self.metrics.observe('parse_seconds', elapsed, callback=callback_name(response.request))
 
     def process_spider_exception(self, response, exception, spider):
         # Called when a spider or process_spider_input() method
@@ -60,12 +115,47 @@ class MegaHatsuDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
     # passed objects.
+    #
+    # Records the download latency of each response per callback
+    # (`download_latency_seconds`) when `METRICS_ENABLED` is on.
+    #
+    # Replaces Scrapy's RetryMiddleware (disabled in settings.py): transient
+    # failures are retried after a jittered exponential delay
+    # (RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, or the Retry-After of the
+    # response), within the RETRY_BUDGET of the run. The failed request is
+    # dropped and its retry sent to the scheduler once the delay elapsed, so a
+    # waiting retry holds no download slot; the spider is kept open until the
+    # waiting retries are sent. Pages given up on are recorded in the
+    # FetchFailures of the crawler, and the crawl is closed once they exceed
+    # FETCH_FAILURE_BUDGET (see mega_hatsu/retry.py).
+
+    def __init__(self, crawler, metrics, retry=True):
+        self.crawler = crawler
+        self.metrics = metrics
+        self.stats = crawler.stats
+        self.failures = get_fetch_failures(crawler)
+        self.retry = retry
+        settings = crawler.settings
+        self.max_retry_times = settings.getint('RETRY_TIMES')
+        self.retry_http_codes = {int(code) for code in settings.getlist('RETRY_HTTP_CODES')}
+        self.retry_exceptions = tuple(load_object(path) for path in settings.getlist('RETRY_EXCEPTIONS'))
+        self.priority_adjust = settings.getint('RETRY_PRIORITY_ADJUST')
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60.0)
+        self.retry_budget = settings.getfloat('RETRY_BUDGET', 0.2)
+        self.failure_budget = settings.getfloat('FETCH_FAILURE_BUDGET', 0.05)
+        self.requests = 0
+        self.retries = 0
+        self.delayed = []
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        # Always enabled: the pages given up on are tracked even without retries.
+        s = cls(crawler, get_metrics(crawler), crawler.settings.getbool('RETRY_ENABLED'))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
     def process_request(self, request, spider):
@@ -78,6 +168,8 @@ class MegaHatsuDownloaderMiddleware:
         # - or return a Request object
         # - or raise IgnoreRequest: process_exception() methods of
         #   installed downloader middleware will be called
+        if 'retry_times' not in request.meta:
+            self.requests += 1
         return None
 
     def process_response(self, request, response, spider):
@@ -87,6 +179,16 @@ class MegaHatsuDownloaderMiddleware:
         # - return a Response object
         # - return a Request object
         # - or raise IgnoreRequest
+        if self.metrics is not None and 'download_latency' in request.meta:
+            self.metrics.observe(
+                'download_latency_seconds',
+                request.meta['download_latency'],
+                callback=callback_name(request)
+            )
+        if response.status in self.retry_http_codes and not request.meta.get('dont_retry'):
+            delay = retry_after(response, self.backoff_max)
+            if self._retry(request, response_status_message(response.status), delay):
+                raise IgnoreRequest('Retrying {} later'.format(request))
         return response
 
     def process_exception(self, request, exception, spider):
@@ -97,7 +199,238 @@ class MegaHatsuDownloaderMiddleware:
         # - return None: continue processing this exception
         # - return a Response object: stops process_exception() chain
         # - return a Request object: stops process_exception() chain
-        pass
+        if isinstance(exception, self.retry_exceptions) and not request.meta.get('dont_retry'):
+            if self._retry(request, exception):
+                raise IgnoreRequest('Retrying {} later'.format(request))
+        return None
+
+    def _retry(self, request, reason, delay=None):
+        """
+        Schedules the retry of a failed request after its delay, or records the
+        page as failed once its retries or the retry budget are exhausted (at
+        once with `RETRY_ENABLED` off).
+
+        Args:
+            request (scrapy.Request): The failed request.
+            reason (str or Exception): Why it failed.
+            delay (float): Delay asked by the server, in seconds.
+
+        Returns:
+            bool: Whether a retry was scheduled, False when the page is given up on.
+        """
+        retry = None
+        if self.retry and self.retries >= max(RETRY_BUDGET_MIN, self.retry_budget * self.requests):
+            self.stats.inc_value('retry/budget_exhausted')
+        elif self.retry:
+            retry = get_retry_request(
+                request,
+                spider=self.crawler.spider,
+                reason=reason,
+                max_retry_times=request.meta.get('max_retry_times', self.max_retry_times),
+                priority_adjust=request.meta.get('priority_adjust', self.priority_adjust),
+            )
+        if retry is not None:
+            self.retries += 1
+            if delay is None:
+                delay = backoff_delay(retry.meta['retry_times'], self.backoff_base, self.backoff_max)
+            self._schedule(retry, delay)
+            return True
+        kind = self.failures.record(request)
+        if kind is None:
+            return False
+        self.stats.inc_value('fetch_failures/{}'.format(kind))
+        if not self.failures.exhausted and len(self.failures) > max(FETCH_FAILURE_BUDGET_MIN, self.failure_budget * self.requests):
+            self.failures.exhausted = True
+            self.crawler.spider.logger.error(
+                'Gave up on %d of %d pages, closing the crawl', len(self.failures), self.requests
+            )
+            deferred_from_coro(self.crawler.engine.close_spider_async(reason='failure_budget'))
+        return False
+
+    def _schedule(self, request, delay):
+        """
+        Sends a request to the scheduler once a delay elapsed.
+
+        Args:
+            request (scrapy.Request): The retry.
+            delay (float): Delay, in seconds.
+        """
+        from twisted.internet import reactor
+
+        self.delayed = [call for call in self.delayed if call.active()]
+        self.delayed.append(reactor.callLater(delay, lambda: self.crawler.engine.crawl(request)))
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+    def spider_idle(self, spider):
+        if any(call.active() for call in self.delayed):
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in self.delayed:
+            if call.active():
+                call.cancel()
+
+
+class IncrementalCrawlMiddleware:
+    """
+    Downloader middleware skipping the property pages that did not change.
+
+    Property requests (the ones carrying an `identifier` in their meta) are sent
+    with `If-None-Match` / `If-Modified-Since` headers taken from the fingerprint
+    cache. A 304 answer, or a 200 whose body hashes to the stored digest, is
+    flagged 'unchanged' so that the spider only reports the property as seen
+    instead of parsing it again.
+
+    The fingerprint of a fetched page is kept pending until the pipeline sends
+    `batch_written` for the batch holding its row, and only then stored. It is
+    forgotten when the item was dropped, and the pending fingerprints of
+    batches that could not be written are dropped when the spider closes, so a
+    page whose item never reached the database is fully fetched again on the
+    next run.
+
+    Enabled with the `INCREMENTAL_CRAWL` setting, the cache file is
+    `FINGERPRINT_CACHE`.
+    """
+
+    def __init__(self, cache):
+        """
+        Args:
+            cache (FingerprintCache): The fingerprint cache.
+        """
+        self.cache = cache
+        # Fingerprints of the fetched pages whose row is not written yet,
+        # {identifier: (url, etag, last_modified, digest)}.
+        self.pending = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_CRAWL'):
+            raise NotConfigured
+        s = cls(FingerprintCache(crawler.settings.get('FINGERPRINT_CACHE', 'fingerprints.sqlite')))
+        crawler.signals.connect(s.batch_written, signal=batch_written)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if 'identifier' not in request.meta:
+            return None
+        fingerprint = self.cache.get(request.url)
+        if fingerprint is None:
+            return None
+        etag, last_modified, _ = fingerprint
+        if etag:
+            request.headers.setdefault('If-None-Match', etag)
+        if last_modified:
+            request.headers.setdefault('If-Modified-Since', last_modified)
+        request.meta['handle_httpstatus_list'] = list(request.meta.get('handle_httpstatus_list', [])) + [304]
+        return None
+
+    def process_response(self, request, response, spider):
+        if 'identifier' not in request.meta:
+            return response
+        if response.status == 304:
+            return response.replace(status=200, flags=response.flags + ['unchanged'])
+        if response.status != 200:
+            return response
+        digest = body_digest(response.body)
+        fingerprint = self.cache.get(request.url)
+        if fingerprint is not None and fingerprint[2] == digest:
+            return response.replace(flags=response.flags + ['unchanged'])
+        self.pending[request.meta['identifier']] = (
+            response.url,
+            _header(response, b'ETag'),
+            _header(response, b'Last-Modified'),
+            digest,
+        )
+        return response
+
+    def batch_written(self, identifiers):
+        for identifier in identifiers:
+            fingerprint = self.pending.pop(identifier, None)
+            if fingerprint is not None:
+                self.cache.set(*fingerprint)
+
+    def item_dropped(self, item, response, exception, spider):
+        if response is not None and 'identifier' in response.meta:
+            self.pending.pop(response.meta['identifier'], None)
+            self.cache.forget(response.url)
+
+    def spider_closed(self, spider):
+        if self.pending:
+            spider.logger.info('%d page fingerprints not stored, their rows were not written', len(self.pending))
+        self.pending.clear()
+        self.cache.close()
+
+
+def _header(response, name):
+    """Returns a response header as text, or None when it is missing."""
+    value = response.headers.get(name)
+    return value.decode('latin-1') if value is not None else None
+
+
+class PageArchiveMiddleware:
+    """
+    Downloader middleware storing the downloaded pages in a `PageArchive`.
+
+    Every 200 response of a listing page (a request for one of the
+    `LISTING_CALLBACKS`) or a property page (a request carrying an
+    `identifier` in its meta) is archived under the `crawl_date` of the
+    spider, before `IncrementalCrawlMiddleware` sees it. Other responses
+    (robots.txt, the start page) are not archived. Conditional requests
+    answered with a 304 have no body to archive; their last body already is
+    in the archive.
+
+    Enabled with the `ARCHIVE_ENABLED` setting, the archive directory is
+    `ARCHIVE_DIR`.
+    """
+
+    def __init__(self, archive, stats):
+        """
+        Args:
+            archive (PageArchive): The page archive.
+            stats (scrapy.statscollectors.StatsCollector): The crawl stats.
+        """
+        self.archive = archive
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+        s = cls(
+            PageArchive(
+                crawler.settings.get('ARCHIVE_DIR', 'archive'),
+                level=crawler.settings.getint('ARCHIVE_COMPRESSION_LEVEL', 10),
+            ),
+            crawler.stats,
+        )
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        if response.status != 200 or not hasattr(response, 'text'):
+            return response
+        if 'identifier' in request.meta:
+            kind = 'property'
+        elif callback_name(request) in LISTING_CALLBACKS:
+            kind = 'listing'
+        else:
+            return response
+        stored = self.archive.add(
+            response.url,
+            response.body,
+            spider.crawl_date,
+            kind,
+            identifier=request.meta.get('identifier'),
+            encoding=response.encoding,
+        )
+        self.stats.inc_value('archive/pages')
+        if stored:
+            self.stats.inc_value('archive/stored_bytes', len(response.body))
+        return response
+
+    def spider_closed(self, spider):
+        self.archive.close()
@@ -0,0 +1,189 @@
+"""
+Property page to record conversion, in the crawl process or in a process pool.
+
+Extracting the fields of a property page (lxml parse, document walk, item
+processors) is CPU bound and runs on the reactor thread. With the
+`PARSE_WORKERS` setting, `InfosSpider` hands the raw bodies of the property
+pages to a `ParsePool` instead: worker processes parse them and send back
+compact `MegaHatsuRecord` objects, while the reactor keeps downloading.
+
+The same pool re-parses saved pages in bulk, in order, across all cores:
+
+    with ParsePool(workers=8) as pool:
+        for record, errors in pool.map(pages):
+            ...
+
+where `pages` yields (url, body, encoding) tuples.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from parsel import Selector
+from price_parser import Price
+
+from mega_hatsu.extractors import PropertyExtractor
+from mega_hatsu.items import MegaHatsuRecord
+
+# Extractor of the worker processes, compiled once per process.
+_extractor = None
+
+
+def parse_price(price_string):
+    """
+    Converts a price string into a standardized numerical format.
+
+    Args:
+        price_string (str): Raw price string from the website.
+
+    Returns:
+        float: Price value converted to numerical format (in millions).
+
+    Raises:
+        TypeError: If the price string cannot be parsed.
+    """
+    price = Price.fromstring(price_string).amount
+    return float(price)*10**6
+
+
+def identifier_from_url(url):
+    """
+    Extracts the property identifier (the URL slug) from a property URL.
+
+    Args:
+        url (str): URL of a property page, ending with a slash.
+
+    Returns:
+        str: The property identifier.
+    """
+    return url.split('/')[-2]
+
+
+def record_from_fields(fields, url):
+    """
+    Builds the `MegaHatsuRecord` of a property page from its extracted fields.
+
+    Args:
+        fields (dict): Field name -> list of values, as returned by
+            `PropertyExtractor.extract`. The sales price is removed from it.
+        url (str): URL of the property page.
+
+    Returns:
+        tuple: (record, errors) where errors lists the fields whose value could
+            not be parsed.
+    """
+    errors = []
+    sales_price = fields.pop('sales_price')
+    try:
+        fields['sales_price'] = parse_price(sales_price[0] if sales_price else None)
+    except TypeError:
+        errors.append('sales_price')
+    fields['url'] = url
+    fields['identifier'] = identifier_from_url(url)
+    return MegaHatsuRecord.from_fields(fields), errors
+
+
+def parse_page(url, body, encoding):
+    """
+    Parses a property page in a worker process.
+
+    Args:
+        url (str): URL of the property page.
+        body (bytes): Raw body of the page.
+        encoding (str): Encoding of the body, as detected by the crawl.
+
+    Returns:
+        tuple: (record, errors), see `record_from_fields`.
+    """
+    global _extractor
+    if _extractor is None:
+        _extractor = PropertyExtractor()
+    root = Selector(body=body, encoding=encoding, type='html').root
+    return record_from_fields(_extractor.extract(root), url)
+
+
+def _parse_page_tuple(page):
+    """Calls `parse_page` with a (url, body, encoding) tuple."""
+    return parse_page(*page)
+
+
+class ParsePool:
+    """
+    Pool of worker processes turning property pages into records.
+
+    Workers are started with the 'spawn' method, so they do not inherit the
+    reactor, the database connections or the threads of the crawl. Exceptions
+    raised while parsing a page are re-raised in the caller, with the
+    traceback of the worker attached.
+
+    Attributes:
+        workers (int): Number of worker processes.
+        executor (concurrent.futures.ProcessPoolExecutor): The pool.
+    """
+
+    def __init__(self, workers):
+        """
+        Args:
+            workers (int): Number of worker processes.
+        """
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, url, body, encoding):
+        """
+        Parses a page in the pool, from the reactor thread.
+
+        Args:
+            url (str): URL of the property page.
+            body (bytes): Raw body of the page.
+            encoding (str): Encoding of the body.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with (record, errors) in the
+                reactor thread, or fails with the exception of the worker.
+        """
+        from twisted.internet import reactor
+        from twisted.internet.defer import Deferred
+
+        deferred = Deferred()
+
+        def done(future):
+            error = future.exception()
+            if error is None:
+                reactor.callFromThread(deferred.callback, future.result())
+            else:
+                reactor.callFromThread(deferred.errback, error)
+
+        self.executor.submit(parse_page, url, body, encoding).add_done_callback(done)
+        return deferred
+
+    def map(self, pages, chunksize=16):
+        """
+        Parses many pages in the pool, for bulk re-parses.
+
+        Args:
+            pages (iterable): (url, body, encoding) tuples.
+            chunksize (int): Pages sent to a worker at once.
+
+        Returns:
+            iterator: (record, errors) per page, in the order of `pages`. The
+                exception of a failed page is raised when its result is reached.
+        """
+        return self.executor.map(_parse_page_tuple, pages, chunksize=chunksize)
+
+    def close(self, wait=True):
+        """
+        Stops the workers.
+
+        Args:
+            wait (bool): Wait for the pending pages and the exit of the
+                workers. Otherwise the pages not started yet are cancelled and
+                the workers exit in the background.
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,114 +2,838 @@
 Scrapy pipeline for processing and storing Mega Hatsu scraped items.
 
 This pipeline handles:
-- Connecting to a PostgreSQL database
+- Connecting to a PostgreSQL database, or to an embedded SQLite file
+  (see `storage.py`)
 - Tracking item existence to mark new, still available, or deleted items
-- Appending new items or updates to a Pandas DataFrame
-- Writing final data to the 'articles' table in PostgreSQL
-- Deduplicating entries by 'identifier' at the end of the crawl
+  (only identifiers are read at startup); properties whose page could not be
+  fetched are not marked deleted (see `retry.py`)
+- Collecting new items or updates, written through a Pandas DataFrame when
+  the spider closes
+- Writing final data to the 'articles' table, keyed by 'identifier'
+- Optionally streaming items to the database in bounded batches of upserts
+- Refreshing the status and last-seen time of properties that did not change
+- Recording the changes of prices, yields and status in 'article_versions'
+- Checkpointing its progress in JOBDIR, so an interrupted crawl can resume
+- Optionally writing the batches in a dedicated thread, so the reactor keeps
+  downloading while the database works
+
+`FieldHealthPipeline` watches the share of items in which every field was
+found, so that markup changes of the site show up in the stats after a few
+dozen items instead of after a full crawl of empty columns.
 """
 
+import logging
+import random
+import time
+from collections import Counter
+
+from datetime import datetime, timezone
+
 from itemadapter import ItemAdapter
 import pandas as pd 
 import sqlalchemy
+from scrapy import signals
 from scrapy.exceptions import DropItem
+from scrapy.utils.defer import deferred_from_coro, maybe_deferred_to_future
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+from mega_hatsu.analytics import InvestmentAnalytics
+from mega_hatsu.checkpoint import PipelineCheckpoint
+from mega_hatsu.dedup import RelistDetector
+from mega_hatsu.items import RECORD_FIELDS, SeenItem
+from mega_hatsu.locations import locate
+from mega_hatsu.metrics import get_metrics
+from mega_hatsu.retry import get_fetch_failures
+from mega_hatsu.storage import database_uri, open_backend
+
+logger = logging.getLogger(__name__)
+
+# Items without a value for one of these fields are dropped.
+REQUIRED_FIELDS = ('property_number', 'total_panel_capacity', 'Map')
+
+# Signal sent once a batch is in the database, with the identifiers of its rows.
+batch_written = object()
+
+
+def _column_value(value):
+    """Joins multi-valued fields with newlines."""
+    if isinstance(value, list):
+        return '\n'.join(str(part) for part in value)
+    return value
+
+
+def item_row(item, columns):
+    """
+    Converts an item into a row of the articles table.
+
+    Multi-valued fields are joined with newlines. The location columns are
+    parsed from the address, see `mega_hatsu.locations.locate`.
+
+    Args:
+        item (scrapy.Item or dict): The scraped item or a DataFrame record.
+        columns (iterable): Names of the columns of the row.
+
+    Returns:
+        dict: Column name to value mapping.
+    """
+    adapter = ItemAdapter(item)
+    row = {column: _column_value(adapter.get(column)) for column in columns}
+    if 'prefecture_code' in row or 'municipality' in row:
+        location = locate(*(
+            _column_value(adapter.get(field)) for field in ('installation_location', 'title', 'geodetic_point')
+        ))
+        row['prefecture_code'] = location.prefecture_code
+        row['municipality'] = location.municipality
+    return row
+
+
+class FieldHealthPipeline:
+    """
+    Tracks the hit rate of every item field and alerts when it drops.
+
+    A sampled share (`FIELD_HEALTH_SAMPLE`) of the property items is checked.
+    Per field, the number of items with a value is kept in the stats under
+    `field_health/hits/<field>`, next to `field_health/sampled`, and the null
+    rate of the crawl is set as `field_health/null_rate/<field>` when the
+    spider closes.
+
+    Every `FIELD_HEALTH_WINDOW` sampled items, the hit rate of the fields of
+    `FIELD_HEALTH_THRESHOLDS` over that window is compared to their minimum.
+    A field below it is logged as a warning, counted in `field_health/alerts`
+    and its rate set as `field_health/alert/<field>`; with
+    `FIELD_HEALTH_CLOSESPIDER`, the spider is then closed ('field_health').
+
+    Attributes:
+        crawler (scrapy.crawler.Crawler): The crawler.
+        thresholds (dict): Field -> minimum hit rate over a window.
+        sample (float): Share of the items that are checked.
+        window (int): Number of sampled items per threshold check.
+        close_on_alert (bool): Whether an alert closes the spider.
+        hits (Counter): Hits per field in the current window.
+        sampled (int): Items sampled in the current window.
+        alerted (set): Fields already reported, to log them once.
+    """
+
+    fields = tuple(field for field in RECORD_FIELDS if field != 'status')
+
+    def __init__(self, crawler, thresholds, sample=1.0, window=50, close_on_alert=False):
+        """
+        Args:
+            crawler (scrapy.crawler.Crawler): The crawler.
+            thresholds (dict): Field -> minimum hit rate over a window.
+            sample (float): Share of the items that are checked.
+            window (int): Number of sampled items per threshold check.
+            close_on_alert (bool): Whether an alert closes the spider.
+        """
+        self.crawler = crawler
+        self.thresholds = {field: float(rate) for field, rate in thresholds.items()}
+        self.sample = sample
+        self.window = max(1, window)
+        self.close_on_alert = close_on_alert
+        self.hits = Counter()
+        self.sampled = 0
+        self.alerted = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Instantiates the pipeline from the `FIELD_HEALTH_*` settings.
+
+        Args:
+            crawler (scrapy.crawler.Crawler): The crawler with access to settings.
+
+        Returns:
+            FieldHealthPipeline: An instance of this pipeline class.
+        """
+        return cls(
+            crawler,
+            thresholds=crawler.settings.getdict('FIELD_HEALTH_THRESHOLDS'),
+            sample=crawler.settings.getfloat('FIELD_HEALTH_SAMPLE', 1.0),
+            window=crawler.settings.getint('FIELD_HEALTH_WINDOW', 50),
+            close_on_alert=crawler.settings.getbool('FIELD_HEALTH_CLOSESPIDER'),
+        )
+
+    def process_item(self, item, spider):
+        """
+        Counts the fields found in a sampled property item.
+
+        Args:
+            item (scrapy.Item): The scraped item.
+            spider (scrapy.Spider): The spider that scraped the item.
+
+        Returns:
+            scrapy.Item: The item, unchanged.
+        """
+        if isinstance(item, SeenItem) or (self.sample < 1 and random.random() >= self.sample):
+            return item
+        adapter = ItemAdapter(item)
+        hits = self.hits
+        for field in self.fields:
+            if adapter.get(field) not in (None, '', []):
+                hits[field] += 1
+        self.sampled += 1
+        if self.sampled >= self.window:
+            self.check()
+        return item
+
+    def check(self):
+        """
+        Adds the counts of the current window to the stats, raises the alerts
+        of the fields under their threshold and starts a new window.
+        """
+        stats = self.crawler.stats
+        stats.inc_value('field_health/sampled', self.sampled)
+        for field, count in self.hits.items():
+            stats.inc_value('field_health/hits/{}'.format(field), count)
+        for field, threshold in self.thresholds.items():
+            rate = self.hits[field] / self.sampled
+            if rate >= threshold:
+                continue
+            stats.inc_value('field_health/alerts')
+            stats.set_value('field_health/alert/{}'.format(field), rate)
+            if field not in self.alerted:
+                self.alerted.add(field)
+                logger.warning(
+                    'Field %s found in %.0f%% of the last %d items (expected at least %.0f%%), '
+                    'the markup of the site may have changed',
+                    field, rate * 100, self.sampled, threshold * 100
+                )
+            if self.close_on_alert:
+                deferred_from_coro(self.crawler.engine.close_spider_async(reason='field_health'))
+        self.hits = Counter()
+        self.sampled = 0
+
+    def close_spider(self, spider):
+        """
+        Checks the last, partial window and sets the null rate of every field.
+
+        Args:
+            spider (scrapy.Spider): The spider instance.
+        """
+        if self.sampled:
+            self.check()
+        stats = self.crawler.stats
+        sampled = stats.get_value('field_health/sampled', 0)
+        if not sampled:
+            return
+        for field in self.fields:
+            hits = stats.get_value('field_health/hits/{}'.format(field), 0)
+            stats.set_value('field_health/null_rate/{}'.format(field), 1 - hits / sampled)
 
 class MegaHatsuPipeline:
     """
     Pipeline for cleaning, validating, and persisting items scraped from mega-hatsu.com.
 
     Attributes:
-        postgres_uri (str): Database connection URI.
-        engine (sqlalchemy.Engine): SQLAlchemy engine for PostgreSQL connection.
+        database_uri (str): Database connection URI.
+        backend (StorageBackend): Database specific statements, picked from the URI.
+        engine (sqlalchemy.Engine): SQLAlchemy engine of the database.
         conn (sqlalchemy.Connection): Open SQLAlchemy connection.
-        df (pd.DataFrame): In-memory data store for collected items.
+        items (list): Collected items as dicts, turned into a DataFrame when
+            the spider closes, unless streaming.
         ids (set): Set of previously stored item identifiers.
+        stored_count (int): Number of properties stored before the crawl.
+        streaming (bool): Whether items are upserted in batches during the crawl.
+        batch_size (int): Number of items buffered before a streaming flush.
+        buffer (dict): Pending rows keyed by identifier, in streaming mode.
+        table (sqlalchemy.Table): The articles table, set up when the spider opens.
+        touched (set): Identifiers seen unchanged whose rows still need a touch.
+        seen_at (datetime.datetime): Time of the crawl, stored as `last_seen`.
+        checkpoint (PipelineCheckpoint): Progress kept in `JOBDIR`, or None.
+        seen (set): Identifiers processed so far, kept for the checkpoint.
+        listed (set): Identifiers whose property page was scheduled: the
+            properties are listed even when no item comes back (page in
+            flight at a hard kill, failed or dropped), so they are never
+            marked deleted.
+        replaying (bool): Whether journal entries of a previous run are replayed.
+        async_writes (bool): Whether batches are written by the writer thread.
+        max_pending_writes (int): Number of batches queued for the writer thread
+            before items wait for it (backpressure on the crawl).
+        writer (ThreadPool): Single-thread pool running the writes, or None.
+        write_failed (bool): Whether a batch could not be written; the crawl
+            is then not completed and its checkpoint no longer advances.
+        pending (list): Deferreds of the batches queued for the writer thread.
+        metrics (CrawlMetrics): Flush latency and queued writes, or None.
+        stats (scrapy.statscollectors.StatsCollector): Crawl stats counting the
+            drop reasons under `drop_reasons/`, or None.
+        analytics (InvestmentAnalytics): Refreshes the `article_metrics` table
+            once a crawl completed, or None.
+        relists (RelistDetector): Records the new properties that are relists
+            of a stored one, or None.
+        failures (FetchFailures): Pages the crawl gave up on, whose properties
+            are not marked deleted, or None.
+        signals (scrapy.signalmanager.SignalManager): Sends `batch_written`
+            once a batch is in the database, or None.
     """
 
-    def __init__(self, postgres_uri):
+    def __init__(self, database_uri, streaming=False, batch_size=500, jobdir=None,
+                 async_writes=False, max_pending_writes=2):
         """
-        Initializes the pipeline and loads existing data from the PostgreSQL database.
+        Initializes the pipeline and loads the stored identifiers from the database.
 
         Args:
-            postgres_uri (str): The database URI used for connecting to PostgreSQL.
+            database_uri (str): The database URI, PostgreSQL or SQLite.
+            streaming (bool): Upsert items in batches instead of writing them all
+                when the spider closes.
+            batch_size (int): Number of items buffered before each streaming flush.
+            jobdir (str): Job directory of a resumable crawl. Progress is
+                checkpointed there after every flush, which implies streaming.
+            async_writes (bool): Write the batches in a dedicated thread instead
+                of blocking the reactor.
+            max_pending_writes (int): Batches queued for the writer thread
+                before `process_item` waits for it.
         """
-        self.postgres_uri = postgres_uri
-        self.engine = sqlalchemy.create_engine(self.postgres_uri)
-        try : 
-            self.df = pd.read_sql_query('select * from articles',con=self.engine)
-        except sqlalchemy.exc.ProgrammingError :
-            self.df = pd.DataFrame()
+        self.database_uri = database_uri
+        self.checkpoint = PipelineCheckpoint(jobdir) if jobdir else None
+        self.streaming = streaming or self.checkpoint is not None
+        self.seen = set()
+        self.listed = set()
+        self.write_failed = False
+        self.replaying = False
+        self.async_writes = async_writes
+        self.max_pending_writes = max(1, max_pending_writes)
+        self.writer = None
+        self.pending = []
+        self.metrics = None
+        self.stats = None
+        self.analytics = None
+        self.relists = None
+        self.failures = None
+        self.signals = None
+        self.batch_size = batch_size
+        self.buffer = {}
+        self.table = None
+        self.touched = set()
+        self.seen_at = datetime.now(timezone.utc)
+        self.backend = open_backend(self.database_uri)
+        self.engine = self.backend.engine
+        self.items = []
         self.conn = self.engine.connect()
-        try :
-            results = self.conn.execute('select identifier from articles ;')
-            self.ids = {result[0] for result in results}
-        except sqlalchemy.exc.ProgrammingError : 
-            self.ids = set()
+        self.ids = self._load_identifiers()
+        self.stored_count = len(self.ids)
+
+
+    def _load_identifiers(self, chunk_size=10000):
+        """
+        Streams the stored identifiers through a server-side cursor so startup
+        never holds more than one chunk of rows besides the identifier set.
+
+        Args:
+            chunk_size (int): Number of rows fetched per round trip.
+
+        Returns:
+            set: Identifiers already stored in the articles table.
+        """
+        if not sqlalchemy.inspect(self.engine).has_table('articles'):
+            return set()
+        ids = set()
+        # The transaction ends with the load, no snapshot or lock is held during the crawl.
+        with self.conn.begin():
+            results = self.conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(
+                sqlalchemy.text('select identifier from articles ;')
+            )
+            for partition in results.partitions(chunk_size):
+                ids.update(row[0] for row in partition)
+        return ids
 
     @classmethod
     def from_crawler(cls, crawler):
         """
         Instantiates the pipeline using project settings from the Scrapy crawler.
 
+        The database is `DATABASE_URI` when set, otherwise the PostgreSQL
+        database of the `POSTGRES_*` settings.
+
         Args:
             crawler (scrapy.crawler.Crawler): The crawler with access to settings.
 
         Returns:
             MegaHatsuPipeline: An instance of this pipeline class.
         """
-        return cls(
+        pipeline = cls(
             # mongo_uri=crawler.settings.get('MONGO_URI'), 
-            postgres_uri= "postgresql://{}:{}@{}:{}/{}".format(
-                crawler.settings.get('POSTGRES_USER'),
-                crawler.settings.get('POSTGRES_PASS'), 
-                crawler.settings.get('POSTGRES_HOST'),
-                crawler.settings.get('POSTGRES_PORT'),
-                crawler.settings.get('POSTGRES_DB')
-                ),
-          
-        )    
+            database_uri=database_uri(crawler.settings),
+            streaming=crawler.settings.getbool('POSTGRES_STREAMING'),
+            batch_size=crawler.settings.getint('POSTGRES_BATCH_SIZE', 500),
+            jobdir=crawler.settings.get('JOBDIR'),
+            async_writes=crawler.settings.getbool('POSTGRES_ASYNC_WRITES'),
+            max_pending_writes=crawler.settings.getint('POSTGRES_MAX_PENDING_WRITES', 2),
+        )
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(pipeline.request_scheduled, signal=signals.request_scheduled)
+        pipeline.metrics = get_metrics(crawler)
+        pipeline.stats = crawler.stats
+        if crawler.settings.getbool('ANALYTICS_ENABLED'):
+            pipeline.analytics = InvestmentAnalytics.from_settings(crawler.settings)
+        if crawler.settings.getbool('RELIST_DETECTION'):
+            pipeline.relists = RelistDetector.from_settings(crawler.settings)
+        pipeline.failures = get_fetch_failures(crawler)
+        pipeline.signals = crawler.signals
+        return pipeline
         
 
+    def open_spider(self, spider):
+        """
+        Creates or migrates the articles table before the first item is written,
+        and hands the stored identifiers to the spider for the listing delta
+        mode.
+        A resumed crawl then restores the progress of its previous runs.
+
+        Args:
+            spider (scrapy.Spider): The spider instance.
+        """
+        self.table = self.backend.ensure_schema()
+        if self.relists is not None:
+            self.relists.ensure_table(self.engine)
+        spider.known_identifiers = frozenset(self.ids)
+        if self.checkpoint is not None:
+            self._resume()
+        if self.async_writes and self.streaming:
+            self.writer = ThreadPool(minthreads=1, maxthreads=1, name='MegaHatsuPipeline writer')
+            self.writer.start()
+
+
+    def _resume(self):
+        """
+        Restores the checkpoint of an interrupted crawl and replays the items
+        journaled after it, then flushes them.
+
+        The crawl keeps its original time and the identifiers processed or
+        scheduled before the interruption are no longer candidates for
+        deletion. Journal entries already covered by the checkpoint (the
+        process died between the two writes) are skipped.
+        """
+        seen_at, seen, listed, entries = self.checkpoint.load()
+        if seen_at is None and not entries:
+            return
+        if seen_at is not None:
+            self.seen_at = seen_at
+        self.seen = seen
+        self.listed = listed
+        self.ids -= seen
+        self.replaying = True
+        try:
+            for entry in entries:
+                if 'listed' in entry:
+                    self.listed.add(entry['listed'])
+                    continue
+                if entry.get('seen', entry.get('identifier')) in seen:
+                    continue
+                if 'seen' in entry:
+                    self._process_seen(SeenItem(identifier=entry['seen']))
+                else:
+                    self._process_property(entry)
+        finally:
+            self.replaying = False
+        self.flush()
+
+
+    def request_scheduled(self, request, spider):
+        """
+        Records the identifier of a scheduled property page, journaled in
+        resumable crawls.
+
+        Args:
+            request (scrapy.Request): The scheduled request.
+            spider (scrapy.Spider): The spider instance.
+        """
+        identifier = request.meta.get('identifier')
+        if identifier is None or identifier in self.listed:
+            return
+        self.listed.add(identifier)
+        if self.checkpoint is not None:
+            self.checkpoint.record({'listed': identifier})
+
 
     def process_item(self, item, spider):
         """
         Processes each scraped item. Filters invalid items, tags new/existing status,
-        and adds the item to the internal DataFrame.
+        and collects the item, or buffers it for the next batch when streaming.
 
         Args:
-            item (scrapy.Item): The scraped item.
+            item (scrapy.Item): The scraped item, a `MegaHatsuItem` or a `MegaHatsuRecord`.
             spider (scrapy.Spider): The spider that scraped the item.
 
         Returns:
-            scrapy.Item: The validated and tagged item.
+            scrapy.Item: The validated and tagged item, or a Deferred firing with
+                it once the writer thread caught up, when too many batches wait.
 
         Raises:
-            DropItem: If required fields are missing.
+            DropItem: If required fields are missing, or if a `SeenItem` refers
+                to a property that is not stored.
+        """
+        if isinstance(item, SeenItem):
+            return self._process_seen(item)
+        adapter = ItemAdapter(item)
+        missing = [field for field in REQUIRED_FIELDS if not adapter.get(field)]
+        if missing:
+            self._count_drop(*('missing_{}'.format(field) for field in missing))
+            raise DropItem('missing required fields: {}'.format(', '.join(missing)))
+        return self._process_property(item)
+
+
+    def _count_drop(self, *reasons):
+        """Counts the reasons of a dropped item in the stats."""
+        if self.stats is not None:
+            for reason in reasons:
+                self.stats.inc_value('drop_reasons/{}'.format(reason))
+
+
+    def _process_property(self, item):
+        """
+        Tags a valid property item with its status and buffers it.
+
+        Args:
+            item (scrapy.Item or dict): The property item.
+
+        Returns:
+            scrapy.Item: The tagged item.
         """
-        if not (item['property_number'] and item['total_panel_capacity'] and item['Map']): 
-            raise DropItem
-            
         if item['identifier'] in self.ids : 
             item['status'] = 'still available'
             self.ids.remove(item['identifier'])
         else : 
             item['status'] = 'new'
-        self.df = self.df.append(dict(item),ignore_index=True)
+        if self.streaming:
+            self._journal(item['identifier'], ItemAdapter(item).asdict())
+            self.buffer[item['identifier']] = self._to_row(item)
+            if len(self.buffer) >= self.batch_size:
+                return self._after(self.flush(), item)
+            return item
+        self.items.append(ItemAdapter(item).asdict())
+        return item
+
+
+    def _process_seen(self, item):
+        """
+        Records a property seen unchanged, its row is touched at the next flush.
+
+        Args:
+            item (SeenItem): The property seen unchanged.
+
+        Returns:
+            SeenItem: The item.
+
+        Raises:
+            DropItem: If the property is not stored, so it cannot be touched.
+        """
+        identifier = item['identifier']
+        if identifier in self.ids:
+            self.ids.remove(identifier)
+        elif identifier not in self.touched:
+            self._count_drop('unknown_property')
+            raise DropItem('unchanged page of an unknown property: {}'.format(identifier))
+        self.touched.add(identifier)
+        self._journal(identifier, {'seen': identifier})
+        if self.streaming and len(self.touched) >= self.batch_size:
+            return self._after(self.flush(), item)
         return item
 
 
-    def close_spider(self,spider):
+    def _journal(self, identifier, entry):
+        """
+        Journals a processed item in resumable crawls, until the next checkpoint.
+
+        Args:
+            identifier (str): Identifier of the property.
+            entry (dict): JSON serializable entry replayed by `_resume`.
+        """
+        if self.checkpoint is None:
+            return
+        self.seen.add(identifier)
+        if not self.replaying:
+            self.checkpoint.record(entry)
+
+
+    def _to_row(self, item):
         """
-        Called when the spider closes. Marks missing items as deleted, removes duplicates,
-        writes the final DataFrame to PostgreSQL, and cleans up the connection.
+        Converts an item into a row with a value for every column of the table.
+
+        See `item_row`; `last_seen` is the time of the crawl.
+
+        Args:
+            item (scrapy.Item or dict): The scraped item or a DataFrame record.
+
+        Returns:
+            dict: Column name to value mapping.
+        """
+        row = item_row(item, [column.name for column in self.table.columns])
+        row['last_seen'] = self.seen_at
+        return row
+
+
+    @staticmethod
+    def _after(wait, item):
+        """Returns the item, or a Deferred firing with it once `wait` fired."""
+        if wait is None:
+            return item
+        return wait.addCallback(lambda _: item)
+
+
+    def flush(self):
+        """
+        Hands the buffered rows and touched identifiers over as one batch, see
+        `_write`.
+
+        Without the writer thread the batch is written right away. With it, the
+        batch is queued for the thread; writes keep their order since the
+        thread runs them one at a time.
+
+        Returns:
+            Deferred: Fires when the writer thread has room again, if more than
+                `max_pending_writes` batches are queued; None otherwise.
+        """
+        if not (self.buffer or self.touched):
+            return None
+        rows, touched = list(self.buffer.values()), self.touched
+        progress = None
+        if self.checkpoint is not None and not self.replaying:
+            progress = (set(self.seen), set(self.listed), self.checkpoint.rotate())
+        self.buffer = {}
+        self.touched = set()
+        identifiers = [row['identifier'] for row in rows]
+        if self.writer is None:
+            self._batch_written(self._write(rows, touched, progress), identifiers)
+            return None
+
+        from twisted.internet import reactor
+        write = threads.deferToThreadPool(reactor, self.writer, self._write, rows, touched, progress)
+        write.addCallbacks(self._batch_written, self._write_failed, callbackArgs=(identifiers,))
+        self.pending.append(write)
+        write.addBoth(self._written, write)
+        self._gauge_pending()
+        if len(self.pending) <= self.max_pending_writes:
+            return None
+        # Wait for the oldest write to leave `max_pending_writes` queued.
+        waiter = defer.Deferred()
+        self.pending[0].addBoth(lambda result: waiter.callback(None) or result)
+        return waiter
+
+
+    def _write(self, rows, touched, progress):
+        """
+        Writes a batch in one transaction: the rows as a single
+        `INSERT ... ON CONFLICT (identifier) DO UPDATE` statement, the touch of
+        the properties seen unchanged, the versions of the ones whose
+        tracked values changed and the relists among the new ones. In
+        resumable crawls, the checkpoint is then replaced.
+
+        Runs in the writer thread when there is one, so it only reads state
+        that `flush` handed over and leaves the stats to the reactor thread.
+        Once a batch failed, the checkpoint is no longer replaced: a resumed
+        crawl replays the journal of the failed batch and of the next ones.
+
+        Args:
+            rows (list): Rows to upsert.
+            touched (set): Identifiers of the properties seen unchanged.
+            progress (tuple): (seen, listed, segment) for `PipelineCheckpoint.commit`, or None.
+
+        Returns:
+            int: Number of relists detected in the batch.
+        """
+        start = time.perf_counter()
+        relisted = 0
+        try:
+            with self.engine.begin() as conn:
+                if rows:
+                    self.backend.upsert(conn, self.table, rows)
+                if touched:
+                    self.backend.touch(conn, touched, self.seen_at)
+                self.backend.record_versions(conn, {row['identifier'] for row in rows} | touched, self.seen_at)
+                if self.relists is not None:
+                    relisted = self.relists.detect(conn, self.backend, [row for row in rows if row['status'] == 'new'], self.seen_at)
+        except Exception:
+            self.write_failed = True
+            raise
+        if progress is not None and not self.write_failed:
+            self.checkpoint.commit(self.seen_at, *progress)
+        if self.metrics is not None:
+            self.metrics.observe('pipeline_flush_seconds', time.perf_counter() - start)
+        return relisted
+
+
+    def _batch_written(self, relisted, identifiers):
+        """
+        Adds the relists detected by a written batch to the stats and sends
+        `batch_written` with the identifiers of its rows. Runs in the reactor
+        thread.
+
+        Args:
+            relisted (int): Number of relists detected in the batch.
+            identifiers (list): Identifiers of the rows of the batch.
+        """
+        if relisted and self.stats is not None:
+            self.stats.inc_value('relists/detected', relisted)
+        if identifiers and self.signals is not None:
+            self.signals.send_catch_log(batch_written, identifiers=identifiers)
+
+
+    def _written(self, result, write):
+        """Forgets a write of the writer thread once it completed."""
+        self.pending.remove(write)
+        self._gauge_pending()
+        return result
+
+
+    def _gauge_pending(self):
+        """Reports the number of batches queued for the writer thread."""
+        if self.metrics is not None:
+            self.metrics.set_gauge('queue_depth', len(self.pending), queue='pipeline_writes')
+
+
+    def _write_failed(self, failure):
+        """Logs and counts a batch the writer thread could not write."""
+        if self.stats is not None:
+            self.stats.inc_value('pipeline/write_failures')
+        logger.error(
+            'Writing a batch to the database failed',
+            exc_info=(failure.type, failure.value, failure.getTracebackObject())
+        )
+
+
+    def _drain(self):
+        """
+        Returns a Deferred firing once the writer thread wrote every queued batch.
+        """
+        return defer.DeferredList(list(self.pending))
+
+
+    async def close_spider(self,spider):
+        """
+        Called when the spider closes. Upserts the collected items, or the
+        pending batch when streaming, into the database.
+
+        Deletions wait for `spider_closed`, which knows whether the crawl
+        finished. With the writer thread, it returns once every batch is
+        written.
         
         Args:
             spider (scrapy.Spider): The spider instance.
         """
-        for identifier in self.ids : 
-            self.df.loc[self.df['identifier']==identifier,'status'] = 'deleted'
-        self.df.drop_duplicates(subset=['identifier'],keep='last',inplace= True)
-        self.df.to_sql(con=self.engine,name='articles',if_exists='append',index=False)
-        self.conn.execute('delete from articles where ctid not in (select * from (select max(ctid) from articles group by identifier) it);')
+        if not self.streaming and self.items:
+            df = pd.DataFrame(self.items)
+            self.items = []
+            df.drop_duplicates(subset=['identifier'],keep='last',inplace= True)
+            records = df.astype(object).where(df.notna(), None).to_dict('records')
+            for start in range(0, len(records), self.batch_size):
+                self.buffer = {
+                    record['identifier']: self._to_row(record)
+                    for record in records[start:start + self.batch_size]
+                }
+                self.flush()
+        self.flush()
+        if self.writer is not None:
+            await maybe_deferred_to_future(self._drain())
+
+
+    def spider_closed(self, spider, reason):
+        """
+        Completes the crawl once every item is written, see `_complete`.
+        Nothing is completed when a batch could not be written. An interrupted
+        resumable crawl keeps its checkpoint so that running it again with the
+        same `JOBDIR` resumes it.
+
+        Args:
+            spider (scrapy.Spider): The spider instance.
+            reason (str): Why the spider closed, 'finished' when it completed.
+        """
+        if self.write_failed:
+            logger.error('Batches could not be written, no property is marked deleted')
+        else:
+            self._complete(reason)
+        if self.checkpoint is not None:
+            if reason == 'finished' and not self.write_failed:
+                self.checkpoint.clear()
+            else:
+                self.checkpoint.close()
+        self._dispose()
+
+
+    def _complete(self, reason):
+        """
+        Marks the deletions of a completed crawl, drops the relists whose former
+        listing was seen after all and refreshes the analytics. Only a crawl
+        that finished is completed: a crawl closed early (Ctrl-C,
+        CLOSESPIDER_*, a field health alert, the failure budget...) did not see
+        every listing.
+
+        Args:
+            reason (str): Why the spider closed, 'finished' when it completed.
+        """
+        if not self._mark_deleted(reason):
+            return
+        if self.relists is not None:
+            with self.engine.begin() as conn:
+                pruned = self.relists.prune(conn, self.seen_at)
+            if pruned and self.stats is not None:
+                self.stats.inc_value('relists/detected', -pruned)
+        self._refresh_analytics()
+
+
+    def _mark_deleted(self, reason):
+        """
+        Marks the stored properties that were not seen during the crawl as
+        deleted, except the ones whose page was scheduled (see `listed`) or
+        could not be fetched. Nothing is marked when the crawl did not finish
+        (closed for 'failure_budget', 'field_health', 'shutdown'...), a
+        listing page could not be fetched or no stored property was seen at
+        all (the start page failed, the listings could not be parsed): the
+        properties not seen are then not known.
+
+        Args:
+            reason (str): Why the spider closed.
+
+        Returns:
+            bool: Whether the crawl was complete.
+        """
+        ids = self.ids - self.listed
+        if reason != 'finished':
+            logger.warning('Crawl closed (%s), not marking %d unseen properties deleted', reason, len(ids))
+            self._count_deletions_skipped(len(ids))
+            return False
+        if self.stored_count and len(self.ids) == self.stored_count:
+            logger.warning('No stored property was seen, not marking %d properties deleted', len(ids))
+            self._count_deletions_skipped(len(ids))
+            return False
+        if self.failures is not None:
+            if not self.failures.complete:
+                logger.warning(
+                    'Not marking %d unseen properties deleted: %d listing pages failed%s',
+                    len(ids), len(self.failures.listings),
+                    ', failure budget exceeded' if self.failures.exhausted else ''
+                )
+                self._count_deletions_skipped(len(ids))
+                return False
+            self._count_deletions_skipped(len(ids & self.failures.identifiers))
+            ids = ids - self.failures.identifiers
+        if ids:
+            with self.engine.begin() as conn:
+                self.backend.mark_deleted(conn, ids)
+                self.backend.record_versions(conn, ids, self.seen_at)
+        return True
+
+
+    def _count_deletions_skipped(self, count):
+        """Counts the unseen properties left as they are because the crawl was incomplete."""
+        if count and self.stats is not None:
+            self.stats.inc_value('pipeline/deletions_skipped', count)
+
+
+    def _refresh_analytics(self):
+        """Recomputes the investment metrics of the properties written or deleted by the crawl."""
+        if self.analytics is None:
+            return
+        start = time.perf_counter()
+        refreshed = self.analytics.refresh(self.backend)
+        logger.info('Refreshed the investment metrics of %d properties in %.1fs', refreshed, time.perf_counter() - start)
+        if self.stats is not None:
+            self.stats.set_value('analytics/refreshed', refreshed)
+
+
+    def _dispose(self):
+        """Stops the writer thread and closes the connection and the engine."""
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
         self.conn.close()
-        self.engine.dispose()
\ No newline at end of file
+        self.engine.dispose()
@@ -0,0 +1,81 @@
+"""
+Numeric normalization shared by the `MegaHatsuItem` input processors.
+
+Values scraped from mega-hatsu.com come as text such as '1,234', '75.6kW',
+'１０．５％', '1,850万円', '1億2000万円', '-3.2%' or '10〜12年'. `parse_number`
+turns any of them into a float with one precompiled regex:
+
+- full-width digits and punctuation are folded to ASCII first,
+- a leading minus sign is kept,
+- thousands separators are dropped,
+- the Japanese units 千, 万, 百万, 千万 and 億 multiply the number, and the
+  groups of a compound amount (1億2000万, 1万5000) are summed,
+- for a range, the lower bound is kept,
+- trailing units such as kW, kWh, 円, 年 or % are ignored.
+
+Values are converted one at a time; the results are cached, since the same
+strings (warranty years, tariffs, ...) repeat across most pages.
+"""
+
+import re
+from functools import lru_cache
+
+_FULL_WIDTH = str.maketrans('０１２３４５６７８９．，－−', '0123456789.,--')
+
+NUMBER = re.compile(r'(-?)(\d[\d,]*(?:\.\d*)?|\.\d+)\s*(千万|百万|千|万|億)?')
+
+# Next group of a compound amount, right after the unit of the previous one.
+NEXT_GROUP = re.compile(r'(\d[\d,]*(?:\.\d*)?)\s*(千万|百万|千|万|億)?')
+
+MULTIPLIERS = {
+    None: 1,
+    '千': 10**3,
+    '万': 10**4,
+    '百万': 10**6,
+    '千万': 10**7,
+    '億': 10**8,
+}
+
+
+@lru_cache(maxsize=4096)
+def parse_number(text):
+    """
+    Converts a scraped value into a float.
+
+    Args:
+        text (str): The scraped value.
+
+    Returns:
+        float: The number, or None when the value contains no number.
+    """
+    if not isinstance(text, str):
+        return None if text is None else float(text)
+    text = text.translate(_FULL_WIDTH)
+    match = NUMBER.search(text)
+    if match is None:
+        return None
+    sign, digits, unit = match.groups()
+    number = float(digits.replace(',', '')) * MULTIPLIERS[unit]
+    # Sum the groups of a compound amount while their units decrease.
+    while unit is not None:
+        match = NEXT_GROUP.match(text, match.end())
+        if match is None or MULTIPLIERS[match.group(2)] >= MULTIPLIERS[unit]:
+            break
+        digits, unit = match.groups()
+        number += float(digits.replace(',', '')) * MULTIPLIERS[unit]
+    return -number if sign else number
+
+
+def parse_numbers(values):
+    """
+    Input processor of the numeric `MegaHatsuItem` fields.
+
+    Values without a number are dropped instead of failing the whole item.
+
+    Args:
+        values (list): The scraped values of a field.
+
+    Returns:
+        list: The values as floats.
+    """
+    return [number for number in map(parse_number, values) if number is not None]
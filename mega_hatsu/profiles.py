@@ -0,0 +1,72 @@
+"""
+Named crawl profiles tuned for the listing -> detail fan-out of mega-hatsu.com.
+
+A crawl fetches about one listing page per 20 property pages. Listing requests
+are yielded with a lower priority than property requests (see `InfosSpider`),
+so the scheduler drains the property pages of a listing before moving on and
+the queue stays close to one listing page worth of requests.
+
+Select a profile with the `CRAWL_PROFILE` setting, e.g.
+`scrapy crawl infos -s CRAWL_PROFILE=standard`. Its settings override the
+project settings but not the ones given on the command line.
+
+Profiles:
+    polite:       one request at a time with a delay, for daytime runs.
+    standard:     a few parallel requests, AutoThrottle keeps latency in check.
+    bulk-refresh: full re-crawls during off-peak hours.
+"""
+
+# Settings shared by every profile.
+COMMON = {
+    'DNSCACHE_ENABLED': True,
+    'DNSCACHE_SIZE': 1000,
+    'AUTOTHROTTLE_ENABLED': True,
+    'SCHEDULER_PRIORITY_QUEUE': 'scrapy.pqueues.ScrapyPriorityQueue',
+}
+
+CRAWL_PROFILES = {
+    'polite': {
+        'CONCURRENT_REQUESTS': 4,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 1,
+        'DOWNLOAD_DELAY': 2.0,
+        'AUTOTHROTTLE_START_DELAY': 2.0,
+        'AUTOTHROTTLE_MAX_DELAY': 60.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0,
+    },
+    'standard': {
+        'CONCURRENT_REQUESTS': 16,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'DOWNLOAD_DELAY': 0.25,
+        'AUTOTHROTTLE_START_DELAY': 1.0,
+        'AUTOTHROTTLE_MAX_DELAY': 30.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 3.0,
+    },
+    'bulk-refresh': {
+        'CONCURRENT_REQUESTS': 32,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+        'DOWNLOAD_DELAY': 0.0,
+        'AUTOTHROTTLE_START_DELAY': 0.5,
+        'AUTOTHROTTLE_MAX_DELAY': 10.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 6.0,
+    },
+}
+
+
+def profile_settings(name):
+    """
+    Returns the settings of a crawl profile.
+
+    Args:
+        name (str): Name of the profile.
+
+    Returns:
+        dict: The profile settings, including the common ones.
+
+    Raises:
+        ValueError: If the profile does not exist.
+    """
+    if name not in CRAWL_PROFILES:
+        raise ValueError('unknown crawl profile {!r}, expected one of: {}'.format(
+            name, ', '.join(sorted(CRAWL_PROFILES))
+        ))
+    return dict(COMMON, **CRAWL_PROFILES[name])
@@ -0,0 +1,139 @@
+"""
+Backoff of retried requests and pages that could not be fetched.
+
+`MegaHatsuDownloaderMiddleware` retries the transient failures of the crawl
+(the `RETRY_HTTP_CODES` statuses and the `RETRY_EXCEPTIONS`, `RETRY_TIMES`
+times) after a jittered exponential delay, see `backoff_delay`. The pages it
+gives up on are recorded in the `FetchFailures` of the crawler:
+
+- a property page that failed is not a deleted property: `MegaHatsuPipeline`
+  leaves the stored properties whose page failed as they are,
+- a listing page (a request for one of the `LISTING_CALLBACKS`) that failed
+  hides the identifiers it lists, so when one failed no property is marked
+  deleted at all,
+- robots.txt is ignored, and the other pages (the start page) only count in
+  the failure budget. When the start page fails no listing page is requested,
+  and `MegaHatsuPipeline` marks nothing deleted after a crawl that saw none of
+  the stored properties.
+
+Two budgets bound a bad run. Retries stop once they reach `RETRY_BUDGET` of
+the requests of the run, so an unavailable site gets fewer requests rather
+than `RETRY_TIMES` times more. Once the pages given up on exceed
+`FETCH_FAILURE_BUDGET` of the pages requested, the crawl is closed with the
+reason 'failure_budget' and nothing is marked deleted.
+"""
+
+import random
+
+from scrapy.utils.httpobj import urlparse_cached
+
+# Failures of a run always within the budgets, however few requests were sent.
+RETRY_BUDGET_MIN = 10
+FETCH_FAILURE_BUDGET_MIN = 10
+
+# Spider callbacks of the listing pages, the pages listing the properties.
+LISTING_CALLBACKS = ('parse_individuals',)
+
+
+def backoff_delay(retries, base=1.0, cap=60.0, rng=random):
+    """
+    Returns the delay before a retry: exponential in the number of retries,
+    capped, with half of it random so that failed requests are not all
+    retried at the same moment.
+
+    Args:
+        retries (int): Number of the retry, from 1.
+        base (float): Delay of the first retry, in seconds.
+        cap (float): Longest delay, in seconds.
+        rng (random.Random): Random generator.
+
+    Returns:
+        float: Seconds to wait, between half the capped delay and the capped delay.
+    """
+    delay = min(cap, base * 2 ** (retries - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def retry_after(response, cap=60.0):
+    """
+    Returns the delay a 429 or 503 response asks for in its Retry-After header.
+
+    Args:
+        response (scrapy.http.Response): The response.
+        cap (float): Longest delay, in seconds.
+
+    Returns:
+        float: Seconds to wait, or None without a header in seconds.
+    """
+    value = response.headers.get(b'Retry-After')
+    if not value:
+        return None
+    try:
+        return min(cap, max(0.0, float(value.decode('latin-1'))))
+    except ValueError:
+        return None
+
+
+class FetchFailures:
+    """
+    Pages of a crawl that could not be fetched once the retries were exhausted.
+
+    Attributes:
+        identifiers (set): Identifiers of the property pages that failed.
+        listings (list): URLs of the listing pages that failed.
+        others (list): URLs of the other pages that failed, robots.txt aside.
+        exhausted (bool): Whether the crawl exceeded its failure budget.
+    """
+
+    def __init__(self):
+        self.identifiers = set()
+        self.listings = []
+        self.others = []
+        self.exhausted = False
+
+    def __len__(self):
+        return len(self.identifiers) + len(self.listings) + len(self.others)
+
+    def record(self, request):
+        """
+        Records a page given up on.
+
+        Args:
+            request (scrapy.Request): Request of the page, carrying the
+                property identifier in its meta for property pages.
+
+        Returns:
+            str: Kind of the page, 'properties', 'listings' or 'others', or
+                None for robots.txt, which is not recorded.
+        """
+        identifier = request.meta.get('identifier')
+        if identifier is not None:
+            self.identifiers.add(identifier)
+            return 'properties'
+        if getattr(request.callback, '__name__', None) in LISTING_CALLBACKS:
+            self.listings.append(request.url)
+            return 'listings'
+        if urlparse_cached(request).path == '/robots.txt':
+            return None
+        self.others.append(request.url)
+        return 'others'
+
+    @property
+    def complete(self):
+        """bool: Whether every listing page was fetched and the budget was kept."""
+        return not self.listings and not self.exhausted
+
+
+def get_fetch_failures(crawler):
+    """
+    Returns the fetch failures of a crawler, created on first use.
+
+    Args:
+        crawler (scrapy.crawler.Crawler): The crawler.
+
+    Returns:
+        FetchFailures: The failures.
+    """
+    if not hasattr(crawler, 'mega_hatsu_fetch_failures'):
+        crawler.mega_hatsu_fetch_failures = FetchFailures()
+    return crawler.mega_hatsu_fetch_failures
@@ -0,0 +1,320 @@
+"""
+Database schema for the items scraped from mega-hatsu.com.
+
+The `articles` table is derived from the fields of `MegaHatsuItem`: numeric
+fields become floats, the "price includes" checkboxes become integer flags and
+everything else is stored as text. `identifier` is the primary key, so items
+are written with native upserts instead of being appended and deduplicated.
+`last_seen` records when the crawl last found the property listed.
+`prefecture_code` and `municipality` hold the normalized location of the
+property (see `locations.py`), indexed together with the yield and the price
+for regional queries, and with the panel capacity for the relist detection
+(see `dedup.py`).
+
+`ensure_schema` creates the table on first use and migrates tables created by
+earlier versions of the pipeline (missing columns and indexes, no key on
+`identifier`).
+
+The append-only `article_versions` table keeps the history of `HISTORY_FIELDS`:
+`record_versions` adds a row, valid from the crawl time, only for the properties
+whose prices or yields differ from their latest version, or that were deleted
+or listed again since, so it grows with the number of changes rather than the
+number of crawls (see `history.py`).
+"""
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from mega_hatsu.items import MegaHatsuItem
+
+ARTICLES = 'articles'
+ARTICLE_VERSIONS = 'article_versions'
+
+# Fields whose changes are recorded in the article_versions table.
+VALUE_FIELDS = ('sales_price', 'Yield', 'assumed_investement_surface_yield')
+
+# Columns of the article_versions table: the tracked values and the status,
+# compared only as deleted or listed ('new' then 'still available' is no change).
+HISTORY_FIELDS = VALUE_FIELDS + ('status',)
+
+# Fields converted to floats by the item input processors.
+NUMERIC_FIELDS = {
+    'Yield',
+    'property_number',
+    'total_panel_capacity',
+    'conversion_efficiency',
+    'output_guarantee',
+    'product_warranty',
+    'assumed_investement_surface_yield',
+    'estimated_annual_power_generation',
+    'unit_price_per_unit_of_electricity_sold',
+    'estimated_electricity_sales_revenue',
+    'estimated_electricity_sales_income',
+    'sales_price',
+    'sales_price2',
+    'total_capacity_of_power_conditioner',
+}
+
+# "Price includes" checkboxes stored as 0/1 flags.
+FLAG_FIELDS = {
+    'system_price',
+    'land_price_or_rent',
+    'interconnection_price',
+    'consumption_tax',
+    'land_developpement',
+    'insurrance_cost',
+    'land_registration',
+    'weed_prevention_sheet',
+    'fence',
+    'sign',
+    'remote_monitoring',
+    'construction_costs',
+}
+
+
+def column_type(field):
+    """
+    Returns the column type used to store an item field.
+
+    Args:
+        field (str): Name of a `MegaHatsuItem` field.
+
+    Returns:
+        sqlalchemy.types.TypeEngine: The column type.
+    """
+    if field in NUMERIC_FIELDS:
+        return sqlalchemy.Float
+    if field in FLAG_FIELDS:
+        return sqlalchemy.Integer
+    return sqlalchemy.Text
+
+
+def articles_table(metadata, name=ARTICLES):
+    """
+    Builds the table definition for scraped items from `MegaHatsuItem` fields.
+
+    Args:
+        metadata (sqlalchemy.MetaData): Metadata the table is attached to.
+        name (str): Name of the table.
+
+    Returns:
+        sqlalchemy.Table: The table definition, keyed by `identifier`, with the
+            location indexes.
+    """
+    columns = [
+        sqlalchemy.Column(field, column_type(field), primary_key=field == 'identifier')
+        for field in MegaHatsuItem.fields
+    ]
+    columns.append(sqlalchemy.Column('last_seen', sqlalchemy.DateTime(timezone=True)))
+    columns.append(sqlalchemy.Column('prefecture_code', sqlalchemy.SmallInteger))
+    columns.append(sqlalchemy.Column('municipality', sqlalchemy.Text))
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        *columns,
+        sqlalchemy.Index('ix_{}_prefecture_yield'.format(name), 'prefecture_code', 'Yield'),
+        sqlalchemy.Index('ix_{}_prefecture_price'.format(name), 'prefecture_code', 'sales_price'),
+        sqlalchemy.Index('ix_{}_municipality'.format(name), 'municipality'),
+        sqlalchemy.Index('ix_{}_prefecture_capacity'.format(name), 'prefecture_code', 'total_panel_capacity'),
+    )
+
+
+def versions_table(metadata, name=ARTICLE_VERSIONS):
+    """
+    Builds the table definition of the article history.
+
+    The primary key on (identifier, valid_from) doubles as the index of the
+    "as of" and per-property history lookups.
+
+    Args:
+        metadata (sqlalchemy.MetaData): Metadata the table is attached to.
+        name (str): Name of the table.
+
+    Returns:
+        sqlalchemy.Table: The table definition.
+    """
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column('identifier', sqlalchemy.Text, primary_key=True),
+        sqlalchemy.Column('valid_from', sqlalchemy.DateTime(timezone=True), primary_key=True),
+        *[sqlalchemy.Column(field, column_type(field)) for field in HISTORY_FIELDS]
+    )
+
+
+def ensure_schema(engine):
+    """
+    Creates the articles table, or migrates an existing one to the current schema.
+
+    Migration adds the columns and indexes the table does not have yet and, when
+    `identifier` is neither the primary key nor uniquely indexed, removes the
+    duplicate rows left by the old append-only pipeline before adding the key.
+    The deduplication runs once, on the first start after the upgrade. The
+    `article_versions` table is created when missing.
+
+    Args:
+        engine (sqlalchemy.Engine): Engine connected to the database.
+
+    Returns:
+        sqlalchemy.Table: The articles table as it exists in the database.
+    """
+    metadata = sqlalchemy.MetaData()
+    expected = articles_table(metadata)
+    metadata.create_all(engine, tables=[versions_table(metadata)])
+    inspector = sqlalchemy.inspect(engine)
+    if not inspector.has_table(ARTICLES):
+        metadata.create_all(engine)
+        return expected
+
+    existing = {column['name'] for column in inspector.get_columns(ARTICLES)}
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for column in expected.columns:
+            if column.name not in existing:
+                conn.execute(sqlalchemy.text('alter table {} add column {} {};'.format(
+                    ARTICLES,
+                    preparer.quote(column.name),
+                    column.type.compile(dialect=engine.dialect)
+                )))
+        create_indexes(conn, expected)
+        if not _is_keyed(inspector):
+            conn.execute(sqlalchemy.text('delete from articles where identifier is null;'))
+            conn.execute(sqlalchemy.text('delete from articles where ctid not in (select * from (select max(ctid) from articles group by identifier) it);'))
+            conn.execute(sqlalchemy.text('alter table articles add primary key (identifier);'))
+    return sqlalchemy.Table(ARTICLES, sqlalchemy.MetaData(), autoload_with=engine)
+
+
+def create_indexes(conn, table):
+    """
+    Creates the indexes of a table definition that do not exist yet.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection inside a transaction.
+        table (sqlalchemy.Table): The table definition.
+    """
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _is_keyed(inspector):
+    """
+    Tells whether `identifier` already is the primary key or has a unique index.
+
+    Args:
+        inspector (sqlalchemy.engine.Inspector): Inspector of the database.
+
+    Returns:
+        bool: True when upserts on `identifier` are possible.
+    """
+    if inspector.get_pk_constraint(ARTICLES).get('constrained_columns') == ['identifier']:
+        return True
+    return any(
+        index['unique'] and index['column_names'] == ['identifier']
+        for index in inspector.get_indexes(ARTICLES)
+    )
+
+
+def upsert(table, rows):
+    """
+    Builds an `INSERT ... ON CONFLICT (identifier) DO UPDATE` statement.
+
+    Args:
+        table (sqlalchemy.Table): The articles table.
+        rows (list): Rows with a value for every column, unique by identifier.
+
+    Returns:
+        sqlalchemy.sql.Insert: The upsert statement.
+    """
+    statement = insert(table).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=['identifier'],
+        set_={
+            column.name: statement.excluded[column.name]
+            for column in table.columns
+            if column.name != 'identifier'
+        }
+    )
+
+
+def mark_deleted(conn, identifiers):
+    """
+    Marks the given identifiers as deleted with a single set-based UPDATE.
+
+    The identifiers are sent as one array parameter (`identifier = ANY(...)`),
+    so the statement stays the same size however many properties were delisted
+    and is resolved through the primary key index.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection inside a transaction.
+        identifiers (iterable): Identifiers that were not seen during the crawl.
+    """
+    conn.execute(
+        sqlalchemy.text("update articles set status = 'deleted' where identifier = any(:identifiers) ;"),
+        {'identifiers': list(identifiers)}
+    )
+
+
+def touch(conn, identifiers, seen_at):
+    """
+    Marks unchanged properties as still available and refreshes their last-seen time.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection inside a transaction.
+        identifiers (iterable): Identifiers of the properties seen unchanged.
+        seen_at (datetime.datetime): Time of the crawl.
+    """
+    conn.execute(
+        sqlalchemy.text("update articles set status = 'still available', last_seen = :seen_at where identifier = any(:identifiers) ;"),
+        {'identifiers': list(identifiers), 'seen_at': seen_at}
+    )
+
+
+def compared_columns(alias):
+    """
+    Returns the SQL expressions compared to decide whether a property changed.
+
+    Args:
+        alias (str): Alias of the articles or versions table in the statement.
+
+    Returns:
+        list: The `VALUE_FIELDS` columns, then whether the property is deleted.
+    """
+    columns = ['{}."{}"'.format(alias, field) for field in VALUE_FIELDS]
+    return columns + ["(coalesce({}.status, '') = 'deleted')".format(alias)]
+
+
+def record_versions(conn, identifiers, valid_from):
+    """
+    Appends a version for each given property whose `VALUE_FIELDS` or deleted
+    state differ from its latest version, or that has no version yet.
+
+    Runs after the articles rows are written, in the same transaction, and
+    compares them to the latest versions in a single INSERT ... SELECT.
+
+    Args:
+        conn (sqlalchemy.Connection): Connection inside a transaction.
+        identifiers (iterable): Identifiers of the properties just written.
+        valid_from (datetime.datetime): Time of the crawl.
+    """
+    columns = ', '.join('"{}"'.format(field) for field in HISTORY_FIELDS)
+    current = ', '.join('a."{}"'.format(field) for field in HISTORY_FIELDS)
+    conn.execute(
+        sqlalchemy.text(
+            'insert into article_versions (identifier, valid_from, {columns}) '
+            'select a.identifier, :valid_from, {current} from articles a '
+            'left join lateral ('
+            'select * from article_versions v where v.identifier = a.identifier '
+            'order by v.valid_from desc limit 1'
+            ') v on true '
+            'where a.identifier = any(:identifiers) '
+            'and (v.identifier is null or ({current_state}) is distinct from ({latest_state})) '
+            'on conflict (identifier, valid_from) do update set {updates} ;'.format(
+                columns=columns,
+                current=current,
+                current_state=', '.join(compared_columns('a')),
+                latest_state=', '.join(compared_columns('v')),
+                updates=', '.join('"{0}" = excluded."{0}"'.format(field) for field in HISTORY_FIELDS),
+            )
+        ),
+        {'identifiers': list(identifiers), 'valid_from': valid_from}
+    )
@@ -7,11 +7,19 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+from mega_hatsu.items import EXPORT_FIELDS
+
 BOT_NAME = 'mega_hatsu'
 
+# Site to crawl; only changed to crawl a local stand-in (benchmarks/mock_server.py).
+MEGA_HATSU_BASE_URL = 'https://mega-hatsu.com'
+
 SPIDER_MODULES = ['mega_hatsu.spiders']
 NEWSPIDER_MODULE = 'mega_hatsu.spiders'
 
+# Project commands, e.g. `scrapy reextract` (see mega_hatsu/commands).
+COMMANDS_MODULE = 'mega_hatsu.commands'
+
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'mega_hatsu (+http://www.yourdomain.com)'
@@ -19,6 +27,11 @@ NEWSPIDER_MODULE = 'mega_hatsu.spiders'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
+# Named crawl profile setting concurrency, delays and AutoThrottle together:
+# 'polite', 'standard' or 'bulk-refresh' (see mega_hatsu/profiles.py).
+# Empty keeps the settings of this file.
+CRAWL_PROFILE = ''
+
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 #CONCURRENT_REQUESTS = 32
 
@@ -44,27 +57,88 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'mega_hatsu.middlewares.MegaHatsuSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'mega_hatsu.middlewares.MegaHatsuSpiderMiddleware': 543,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #DOWNLOADER_MIDDLEWARES = {
 #    'mega_hatsu.middlewares.MegaHatsuDownloaderMiddleware': 543,
 #}
+DOWNLOADER_MIDDLEWARES = {
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'mega_hatsu.middlewares.MegaHatsuDownloaderMiddleware': 543,
+    'mega_hatsu.middlewares.IncrementalCrawlMiddleware': 560,
+    'mega_hatsu.middlewares.PageArchiveMiddleware': 570,
+}
+
+# Retry the transient failures (RETRY_HTTP_CODES, RETRY_EXCEPTIONS) up to
+# RETRY_TIMES times after a jittered exponential delay, starting at
+# RETRY_BACKOFF_BASE seconds and capped at RETRY_BACKOFF_MAX (see
+# MegaHatsuDownloaderMiddleware and mega_hatsu/retry.py); a retry waits for
+# its delay outside the downloader. Retries stop once they reach RETRY_BUDGET
+# of the requests of the run. Stored properties whose page could not be
+# fetched are not marked deleted; when a listing page failed, none are. Once
+# the pages given up on exceed FETCH_FAILURE_BUDGET of the requests, the crawl
+# is closed with the reason 'failure_budget'.
+RETRY_TIMES = 3
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_BUDGET = 0.2
+FETCH_FAILURE_BUDGET = 0.05
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 #}
+EXTENSIONS = {
+    'mega_hatsu.metrics.MetricsExtension': 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
+ITEM_PIPELINES = {
+    'mega_hatsu.pipelines.FieldHealthPipeline': 200,
 #    'mega_hatsu.pipelines.MegaHatsuPipeline': 300,
-# }
+}
+
+# Minimum share of items in which a field is found, checked every
+# FIELD_HEALTH_WINDOW sampled items (see FieldHealthPipeline). Lower values
+# only raise an alert in the stats and the log, unless FIELD_HEALTH_CLOSESPIDER.
+FIELD_HEALTH_THRESHOLDS = {
+    'title': 0.95,
+    'property_number': 0.95,
+    'total_panel_capacity': 0.9,
+    'Map': 0.9,
+    'sales_price': 0.8,
+    'Yield': 0.8,
+    'manufacturer': 0.7,
+    'installation_location': 0.8,
+}
+FIELD_HEALTH_SAMPLE = 1.0
+FIELD_HEALTH_WINDOW = 50
+FIELD_HEALTH_CLOSESPIDER = False
+
+# Refresh the investment metrics of the article_metrics table (see
+# mega_hatsu/analytics.py) after every completed crawl. ANALYTICS_DEGRADATION
+# lists the yearly panel degradation scenarios, ANALYTICS_YEARS the years of
+# revenue of the IRR and ANALYTICS_OPERATING_COST the share of the revenue
+# spent on operations.
+ANALYTICS_ENABLED = False
+ANALYTICS_DEGRADATION = [0.0, 0.005, 0.01]
+ANALYTICS_YEARS = 20
+ANALYTICS_OPERATING_COST = 0.0
+
+# Record the new properties that are probably a stored property relisted under
+# a new identifier in the article_relists table (see mega_hatsu/dedup.py).
+# Properties are compared when in the same prefecture with panel capacities
+# within RELIST_CAPACITY_TOLERANCE, and recorded from a similarity of
+# RELIST_MIN_SCORE (0 to 1). Off by default.
+RELIST_DETECTION = False
+RELIST_MIN_SCORE = 0.75
+RELIST_CAPACITY_TOLERANCE = 0.01
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -92,6 +166,7 @@ USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Ge
 
 FEED_EXPORTERS = {
     'xlsx': 'scrapy_xlsx.XlsxItemExporter',
+    'parquet': 'mega_hatsu.exporters.ParquetItemExporter',
 }
 
 
@@ -102,54 +177,58 @@ POSTGRES_PORT = '5432'
 POSTGRES_DB = 'test_db'
 POSTGRES_TABLE = 'articles'
 
-
-FEED_EXPORT_FIELDS = [
-    'property_number',
-    'unit_price_per_unit_of_electricity_sold',
-    'total_capacity_of_power_conditioner',
-    'total_panel_capacity',
-    'Map',
-    'Type',
-    'Yield',
-    'assumed_investement_surface_yield',
-    'carbon_dioxid_emission_reduction',
-    'construction_costs',
-    'consumption_tax',
-    'conversion_efficiency',
-    'conversion_to_cedar_tree',
-    'estimated_annual_power_generation',
-    'estimated_electricity_sales_income',
-    'estimated_electricity_sales_revenue',
-    'fence',
-    'geodetic_point',
-    'guarantee',
-    'identifier',
-    'installation_location',
-    'insurrance_cost',
-    'interconnection_price',
-    'irr_notes',
-    'land_developpement',
-    'land_price_or_rent',
-    'land_registration',
-    'manufacturer',
-    'manufacturer2',
-    'maximum_output',
-    'model',
-    'number_of_lots_sold',
-    'other_costs_and_features',
-    'output_guarantee',
-    'price_notes',
-    'product_warranty',
-    'property_number',
-    'remote_monitoring',
-
-    'sales_price2',
-    'sign',
-    'status',
-    'subtitle',
-    'system_price',
-    'title',
-
-    'url',
-    'weed_prevention_sheet'
-]
\ No newline at end of file
+# SQLAlchemy URI of the database, overriding the POSTGRES_* settings above, e.g.
+# 'sqlite:///mega_hatsu.sqlite' for an embedded database (see storage.py).
+DATABASE_URI = ''
+
+# Upsert items in batches of POSTGRES_BATCH_SIZE while crawling instead of
+# writing the whole run when the spider closes.
+POSTGRES_STREAMING = True
+POSTGRES_BATCH_SIZE = 500
+
+# Write the batches in a dedicated thread so downloads go on during writes.
+# Items wait for the writer once POSTGRES_MAX_PENDING_WRITES batches are queued.
+POSTGRES_ASYNC_WRITES = True
+POSTGRES_MAX_PENDING_WRITES = 2
+
+# Send conditional requests for property pages and skip parsing the ones that
+# did not change since the previous crawl (see IncrementalCrawlMiddleware).
+INCREMENTAL_CRAWL = False
+FINGERPRINT_CACHE = 'fingerprints.sqlite'
+
+# Keep every downloaded listing and property page in a zstd compressed archive
+# (see PageArchiveMiddleware and mega_hatsu/archive.py), so that extraction
+# fixes can be applied with `scrapy reextract` instead of a new crawl.
+# Requires `pip install zstandard`.
+ARCHIVE_ENABLED = False
+ARCHIVE_DIR = 'archive'
+ARCHIVE_COMPRESSION_LEVEL = 10
+
+# Decide from the listing pages which property pages to fetch: new properties,
+# plus the known ones whose refresh day it is (each is refreshed once every
+# LISTING_DELTA_REFRESH_DAYS days). Known properties missing from the listings
+# are marked deleted as usual.
+LISTING_DELTA = False
+LISTING_DELTA_REFRESH_DAYS = 20
+
+# Record per-stage timings and queue depths (see metrics.py), copied into the
+# stats and written in the Prometheus text format to METRICS_FILE every
+# METRICS_INTERVAL seconds ('' keeps them in the stats only).
+METRICS_ENABLED = False
+METRICS_FILE = 'metrics.prom'
+METRICS_INTERVAL = 10.0
+# Share of property pages whose extraction is timed field by field.
+METRICS_FIELD_SAMPLE = 0.05
+
+# Build property items as slotted MegaHatsuRecord objects straight from the
+# extracted values instead of going through an ItemLoader and a MegaHatsuItem.
+FAST_ITEMS = False
+
+# Number of worker processes parsing the property pages, off the reactor
+# thread (see mega_hatsu/parsing.py). Property items are then MegaHatsuRecord
+# objects, as with FAST_ITEMS. 0 parses in the crawl process.
+PARSE_WORKERS = 0
+
+
+# Column order of the feed exports, shared with MegaHatsuRecord (see items.py).
+FEED_EXPORT_FIELDS = list(EXPORT_FIELDS)
\ No newline at end of file
@@ -1,8 +1,17 @@
+import random
+import zlib
+from datetime import date
+from urllib.parse import urlparse
+
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
 from scrapy.loader import ItemLoader
-from mega_hatsu.items import MegaHatsuItem
-from price_parser import Price
+from scrapy.utils.defer import maybe_deferred_to_future
+from mega_hatsu.items import MegaHatsuItem, SeenItem
+from mega_hatsu.extractors import PropertyExtractor
+from mega_hatsu.metrics import get_metrics
+from mega_hatsu.parsing import ParsePool, identifier_from_url, parse_price, record_from_fields
+from mega_hatsu.profiles import profile_settings
 
 class InfosSpider(scrapy.Spider):
     """Scrapy spider for crawling solar power plant listing data from mega-hatsu.com.
@@ -16,14 +25,81 @@ class InfosSpider(scrapy.Spider):
         allowed_domains (list): Domain(s) the spider is allowed to crawl.
         start_urls (list): Initial URL(s) where the spider begins crawling.
         listing_template (str): URL template for paginated listing pages.
+        extractor (PropertyExtractor): Field extractor compiled once for all pages.
+        known_identifiers (frozenset): Identifiers already stored, handed over by
+            `MegaHatsuPipeline` when the spider opens.
+        listing_priority (int): Priority of listing page requests.
+        detail_priority (int): Priority of property page requests, higher so that
+            the pages of a listing are fetched before the next listing page.
+        crawl_date (str): ISO date of the crawl, usable in feed URIs as
+            `%(crawl_date)s` to partition exports. Defaults to today.
+        metrics (CrawlMetrics): Metrics of the crawl, None unless `METRICS_ENABLED`.
+        parse_pool (ParsePool): Worker processes parsing the property pages,
+            None unless `PARSE_WORKERS`.
     """
     name = 'infos'
     allowed_domains = ['mega-hatsu.com']
     start_urls = ['https://mega-hatsu.com/article-for-sale/']
+    extractor = PropertyExtractor()
+    known_identifiers = frozenset()
+    listing_priority = 0
+    detail_priority = 10
+    crawl_date = None
+    metrics = None
+    parse_pool = None
+
+    @classmethod
+    def update_settings(cls, settings):
+        """Apply the crawl profile named by the `CRAWL_PROFILE` setting, if any.
+        
+        Args:
+            settings (scrapy.settings.Settings): The crawler settings.
+        """
+        super().update_settings(settings)
+        profile = settings.get('CRAWL_PROFILE')
+        if profile:
+            settings.setdict(profile_settings(profile), priority='spider')
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         """Initialize the spider with URL templates for pagination."""
+        super().__init__(*args, **kwargs)
         self.listing_template = 'https://mega-hatsu.com/article-for-sale/page/{}/'
+        if self.crawl_date is None:
+            self.crawl_date = date.today().isoformat()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        """Create the spider and point it at `MEGA_HATSU_BASE_URL`.
+        
+        The base URL only differs from https://mega-hatsu.com when crawling a
+        local stand-in of the site, e.g. `benchmarks/mock_server.py`.
+        
+        Args:
+            crawler (scrapy.crawler.Crawler): The crawler.
+            
+        Returns:
+            InfosSpider: The spider.
+        """
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        base_url = crawler.settings.get('MEGA_HATSU_BASE_URL', 'https://mega-hatsu.com').rstrip('/')
+        spider.start_urls = [base_url + '/article-for-sale/']
+        spider.listing_template = base_url + '/article-for-sale/page/{}/'
+        spider.allowed_domains = [urlparse(base_url).hostname]
+        spider.metrics = get_metrics(crawler)
+        workers = crawler.settings.getint('PARSE_WORKERS')
+        if workers > 0:
+            spider.parse_pool = ParsePool(workers)
+            crawler.signals.connect(spider.close_parse_pool, signal=signals.spider_closed)
+        return spider
+
+
+    def close_parse_pool(self):
+        """Stop the worker processes of `parse_pool` when the spider closes.
+
+        Every page was parsed by then, so the reactor does not wait for the
+        workers to exit.
+        """
+        self.parse_pool.close(wait=False)
         
 
     def parse(self, response):
@@ -39,24 +115,43 @@ class InfosSpider(scrapy.Spider):
         for page in range(1,total_pages +1 ):
             yield Request(
                 self.listing_template.format(page),
-                callback = self.parse_individuals
+                callback = self.parse_individuals,
+                priority = self.listing_priority
             )
 
     
     def parse_individuals(self,response):
         """Parse a listing page and generate requests for individual property pages.
         
+        With the `LISTING_DELTA` setting, only new properties and the share of
+        known ones due for a refresh (see `is_refresh_due`) are fetched; the
+        other known properties are reported as seen straight from the listing.
+        
+        Property pages are handled by `parse_individual`, or by
+        `parse_individual_in_pool` when a `parse_pool` is running.
+        
         Args:
             response (scrapy.http.Response): The response object from a listing page.
             
         Yields:
-            scrapy.Request: Request objects for each individual property page.
+            scrapy.Request: Request objects for each individual property page,
+                carrying the property identifier in their meta.
+            SeenItem: Known properties skipped by the listing delta mode.
         """
         individuals_urls = response.css('h5 a::attr(href)').getall()
+        delta = self.settings.getbool('LISTING_DELTA')
+        callback = self.parse_individual if self.parse_pool is None else self.parse_individual_in_pool
         for url in individuals_urls :
+            identifier = self.get_identifier(url)
+            if delta and identifier in self.known_identifiers and not self.is_refresh_due(identifier):
+                self.crawler.stats.inc_value('listing_delta/skipped')
+                yield SeenItem(identifier=identifier, url=url)
+                continue
             yield Request(
                 url,
-                callback= self.parse_individual
+                callback= callback,
+                priority= self.detail_priority,
+                meta={'identifier': identifier}
             )
 
 
@@ -70,67 +165,114 @@ class InfosSpider(scrapy.Spider):
         - Location and legal information
         - Warranty and guarantee details
         - Additional features and costs
+
+        The page is walked once by `extractor` and every field is resolved
+        from the resulting index (see `mega_hatsu.extractors.FIELD_SPECS`).
+        Pages flagged 'unchanged' by the incremental crawl are not parsed.
+        With the `FAST_ITEMS` setting, the values are loaded into a
+        `MegaHatsuRecord` directly, without an `ItemLoader`.
         
         Args:
             response (scrapy.http.Response): The response object from a property page.
             
         Yields:
-            dict: Item containing all extracted property data.
+            dict: Item containing all extracted property data, or a `SeenItem`
+                when the page did not change since the previous crawl.
         """
-        loader = ItemLoader(MegaHatsuItem(),response)
+        if 'unchanged' in response.flags:
+            yield SeenItem(identifier=self.get_identifier(response.url), url=response.url)
+            return
+        if self.settings.getbool('FAST_ITEMS'):
+            yield self.build_record(response)
+            return
+        loader = ItemLoader(MegaHatsuItem())
         loader.add_value('url',response.url)
-        loader.add_xpath('title','string(//h2)')
-        loader.add_css('subtitle','div.store-head::text')
-        loader.add_css('Map','img.property_img::attr(src)')
+        fields = self.extract_fields(response)
+        sales_price = fields.pop('sales_price')
         try :
-            loader.add_value('sales_price',self.get_price(response.xpath('(//th[contains(text(),"販売価格")]/following-sibling::td)[1]/text()').get()))
+            loader.add_value('sales_price',self.get_price(sales_price[0] if sales_price else None))
         except TypeError : 
-            pass
-        loader.add_xpath('Yield','(//th[contains(text(),"利回り")]/following-sibling::td)[1]',re='\d+\.\d*')
-        loader.add_xpath('property_number','(//th[contains(text(),"物件番号")]/following-sibling::td)[1]/text()')
-        loader.add_xpath('installation_location','//table[@class="property_sub_table"]//tr[1]/td/text()')
-        loader.add_xpath('number_of_lots_sold','//table[@class="property_sub_table"]//tr[2]/td/text()')
-        loader.add_xpath('guarantee','//table[@class="property_sub_table"]//tr[3]/td/text()')
-        loader.add_value('system_price',int(bool(response.xpath('//div[@class="row plice_include"]/div[1]/span[@class="active"]'))))
-        loader.add_value('land_price_or_rent',int(bool(response.xpath('//div[@class="row plice_include"]/div[2]/span[@class="active"]'))))
-        loader.add_value('interconnection_price',int(bool(response.xpath('//div[@class="row plice_include"]/div[3]/span[@class="active"]'))))
-        loader.add_value('consumption_tax',int(bool(response.xpath('//div[@class="row plice_include"]/div[4]/span[@class="active"]'))))
-        loader.add_value('land_developpement',int(bool(response.xpath('//div[@class="row plice_include"]/div[5]/span[@class="active"]'))))
-        loader.add_value('insurrance_cost',int(bool(response.xpath('//div[@class="row plice_include"]/div[6]/span[@class="active"]'))))
-        loader.add_value('land_registration',int(bool(response.xpath('//div[@class="row plice_include"]/div[7]/span[@class="active"]'))))
-        loader.add_value('weed_prevention_sheet',int(bool(response.xpath('//div[@class="row plice_include"]/div[8]/span[@class="active"]'))))
-        loader.add_value('fence',int(bool(response.xpath('//div[@class="row plice_include"]/div[9]/span[@class="active"]'))))
-        loader.add_value('sign',int(bool(response.xpath('//div[@class="row plice_include"]/div[10]/span[@class="active"]'))))
-        loader.add_value('remote_monitoring',int(bool(response.xpath('//div[@class="row plice_include"]/div[11]/span[@class="active"]'))))
-        loader.add_value('construction_costs',int(bool(response.xpath('//div[@class="row plice_include"]/div[12]/span[@class="active"]'))))
-        loader.add_xpath('other_costs_and_features','//h3[contains(text(),"そのほかにかかる費用・特徴")]/following-sibling::p/text()')
-        loader.add_xpath('manufacturer','//table[@class="property_detail_talbe"][1]//th[contains(text(),"メーカー")]/following-sibling::td/text()')
-        loader.add_xpath('total_panel_capacity','//table[@class="property_detail_talbe"][1]//th[contains(text(),"パネル総容量")]/following-sibling::td/text()',re='\d+[,\.\d]*')
-        loader.add_xpath('Type','//table[@class="property_detail_talbe"][1]//th[contains(text(),"型式")]/following-sibling::td/text()')
-        loader.add_xpath('maximum_output','//table[@class="property_detail_talbe"][1]//th[contains(text(),"最大出力")]/following-sibling::td/text()')
-        loader.add_xpath('conversion_efficiency','//table[@class="property_detail_talbe"][1]//th[contains(text(),"変換効率")]/following-sibling::td/text()',re='\d+\.\d*')
-        loader.add_xpath('output_guarantee','//table[@class="property_detail_talbe"][1]//th[contains(text(),"出力保証")]/following-sibling::td/text()',re='\d+')
-        loader.add_xpath('product_warranty','//table[@class="property_detail_talbe"][1]//th[contains(text(),"製品保証")]/following-sibling::td/text()',re='\d+')
-        loader.add_xpath('assumed_investement_surface_yield','string(//p[@class="rate"])',re='\d*\.\d*')
-        loader.add_xpath('irr_notes','string(//p[@class="rate_text"])')
-        loader.add_xpath('geodetic_point','//th[contains(text(),"観測地点")]/following-sibling::td/text()')
-        loader.add_xpath('estimated_annual_power_generation','//th[contains(text(),"年間想定発電量")]/following-sibling::td/text()',re='\d+,\d*')
-        loader.add_xpath('unit_price_per_unit_of_electricity_sold','//th[contains(text(),"売電単価（税込）")]/following-sibling::td/text()',re='\d+\.\d*')
-        loader.add_xpath('estimated_electricity_sales_revenue','//th[contains(text(),"想定売電収入(年間)")]/following-sibling::td/text()',re='[\d,]+')
-        loader.add_xpath('estimated_electricity_sales_income','//th[contains(text(),"想定売電収入(20年)")]/following-sibling::td/text()',re='[\d,]+')
-        loader.add_xpath('sales_price2','(//th[contains(text(),"販売価格")]/following-sibling::td/text())[2]',re='[\d,]+')
-        loader.add_value('price_notes',' '.join(response.xpath('(//th[contains(text(),"販売価格")]/following-sibling::td/text())[2]').re('\D+')))
-        loader.add_xpath('manufacturer2','(//th[contains(text(),"メーカー")]/following-sibling::td/text())[2]')
-        loader.add_xpath('model','(//th[contains(text(),"型式")]/following-sibling::td/text())[2]')
-        loader.add_xpath('total_capacity_of_power_conditioner','(//th[contains(text(),"パワコン総容量")]/following-sibling::td/text())',re='\d+\.\d*')
-        loader.add_xpath('conversion_efficiency','(//th[contains(text(),"変換効率")]/following-sibling::td/text())[2]',re='\d+')
-        loader.add_xpath('product_warranty','(//th[contains(text(),"製品保証")]/following-sibling::td/text())[2]')
-        loader.add_xpath('carbon_dioxid_emission_reduction','//th[contains(text(),"二酸化炭素排出削減量")]/following-sibling::td/text()')
-        loader.add_xpath('conversion_to_cedar_tree','//th[contains(text(),"杉の木に換算")]/following-sibling::td/text()')
-        loader.add_value('identifier',response.url.split('/')[-2])
+            self.crawler.stats.inc_value('field_health/parse_errors/sales_price')
+        for field, values in fields.items():
+            loader.add_value(field,values)
+        loader.add_value('identifier',self.get_identifier(response.url))
         yield loader.load_item()
 
 
+    def build_record(self,response):
+        """Build the `MegaHatsuRecord` of a property page.
+        
+        Same values as the `ItemLoader` path of `parse_individual`, without
+        its per-item loader, context and value lists.
+        
+        Args:
+            response (scrapy.http.Response): The response object from a property page.
+            
+        Returns:
+            MegaHatsuRecord: The property record.
+        """
+        record, errors = record_from_fields(self.extract_fields(response), response.url)
+        self.count_parse_errors(errors)
+        return record
+
+
+    async def parse_individual_in_pool(self,response):
+        """Parse a property page in a worker process of `parse_pool`.
+        
+        The raw body is sent to the pool and the reactor keeps downloading
+        while the page is parsed. The record is the one `build_record` builds;
+        an exception raised by the worker fails the callback like an
+        exception of `parse_individual` would.
+        
+        Args:
+            response (scrapy.http.Response): The response object from a property page.
+            
+        Yields:
+            MegaHatsuRecord: The property record, or a `SeenItem` when the page
+                did not change since the previous crawl.
+        """
+        if 'unchanged' in response.flags:
+            yield SeenItem(identifier=self.get_identifier(response.url), url=response.url)
+            return
+        record, errors = await maybe_deferred_to_future(
+            self.parse_pool.submit(response.url, response.body, response.encoding)
+        )
+        self.count_parse_errors(errors)
+        yield record
+
+
+    def count_parse_errors(self,errors):
+        """Count the fields whose value could not be parsed in the stats.
+        
+        Args:
+            errors (list): Field names, see `mega_hatsu.parsing.record_from_fields`.
+        """
+        for field in errors:
+            self.crawler.stats.inc_value('field_health/parse_errors/{}'.format(field))
+
+
+    def extract_fields(self,response):
+        """Extract the raw field values of a property page.
+        
+        With metrics enabled, the extraction of a `METRICS_FIELD_SAMPLE` share
+        of the pages is timed field by field (`field_extract_seconds`).
+        
+        Args:
+            response (scrapy.http.Response): The response object from a property page.
+            
+        Returns:
+            dict: Field name -> list of values.
+        """
+        root = response.selector.root
+        if self.metrics is None or random.random() >= self.settings.getfloat('METRICS_FIELD_SAMPLE'):
+            return self.extractor.extract(root)
+        timings = {}
+        fields = self.extractor.extract(root, timings)
+        for field, seconds in timings.items():
+            self.metrics.observe('field_extract_seconds', seconds, field=field)
+        return fields
+
+
     def get_total_pages(self,response):
         """Extract the total number of paginated listing pages.
         
@@ -143,6 +285,38 @@ class InfosSpider(scrapy.Spider):
         return int(max(response.css('span.pages::text').re('\d+')))
 
 
+    def get_identifier(self,url):
+        """Extract the property identifier (the URL slug) from a property URL.
+        
+        Args:
+            url (str): URL of a property page, ending with a slash.
+            
+        Returns:
+            str: The property identifier.
+        """
+        return identifier_from_url(url)
+
+
+    def is_refresh_due(self,identifier):
+        """Tell whether a known property is refetched today in listing delta mode.
+        
+        Known properties are spread over `LISTING_DELTA_REFRESH_DAYS` buckets by a
+        hash of their identifier and one bucket is refreshed per day, so every
+        property gets its details updated once per period. A period of 0
+        disables refreshes.
+        
+        Args:
+            identifier (str): The property identifier.
+            
+        Returns:
+            bool: True when the property page should be fetched.
+        """
+        period = self.settings.getint('LISTING_DELTA_REFRESH_DAYS')
+        if period <= 0:
+            return False
+        return zlib.crc32(identifier.encode()) % period == date.today().toordinal() % period
+
+
     def get_price(self,price_string):
         """Convert a price string into a standardized numerical format.
         
@@ -155,5 +329,4 @@ class InfosSpider(scrapy.Spider):
         Raises:
             TypeError: If the price string cannot be parsed.
         """
-        price = Price.fromstring(price_string).amount
-        return float(price)*10**6
\ No newline at end of file
+        return parse_price(price_string)
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+Fixtures shared by the tests: an embedded SQLite database and readers of its
+tables.
+"""
+
+import pytest
+import sqlalchemy
+
+
+def query(uri, statement):
+    """Returns the rows of a two column query as a dict."""
+    engine = sqlalchemy.create_engine(uri)
+    with engine.connect() as conn:
+        rows = dict(conn.execute(sqlalchemy.text(statement)).all())
+    engine.dispose()
+    return rows
+
+
+@pytest.fixture
+def uri(tmp_path):
+    """URI of a SQLite database in the temporary directory of the test."""
+    return 'sqlite:///{}'.format(tmp_path / 'articles.sqlite')
+
+
+@pytest.fixture
+def stored(uri):
+    """Function returning identifier -> status of the stored properties."""
+    return lambda: query(uri, 'select identifier, status from articles')
+
+
+@pytest.fixture
+def versions(uri):
+    """Function returning the number of versions of every property."""
+    return lambda: query(uri, 'select identifier, count(*) from article_versions group by identifier')
@@ -0,0 +1,82 @@
+"""
+Tests of `PageArchiveMiddleware` and `scrapy reextract`.
+"""
+
+import asyncio
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+import sqlalchemy
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+pytest.importorskip('zstandard')
+
+from mega_hatsu.archive import PageArchive
+from mega_hatsu.commands.reextract import Command
+from mega_hatsu.middlewares import PageArchiveMiddleware
+from mega_hatsu.parsing import parse_page
+from mega_hatsu.pipelines import MegaHatsuPipeline
+
+FIXTURES = Path(__file__).parent.parent / 'benchmarks' / 'fixtures'
+PROPERTY_URL = 'https://mega-hatsu.com/article-for-sale/fukuoka-omuta-123/'
+
+
+class ListingSpider(Spider):
+    name = 'test'
+    crawl_date = '2024-06-30'
+
+    def parse_individuals(self, response):
+        pass
+
+
+def test_only_listing_and_property_pages_are_archived(tmp_path):
+    spider = ListingSpider()
+    middleware = PageArchiveMiddleware(PageArchive(str(tmp_path / 'archive')), get_crawler(ListingSpider).stats)
+    requests = [
+        Request('https://mega-hatsu.com/robots.txt'),
+        Request('https://mega-hatsu.com/article-for-sale/'),
+        Request('https://mega-hatsu.com/article-for-sale/page/1/', callback=spider.parse_individuals),
+        Request(PROPERTY_URL, meta={'identifier': 'fukuoka-omuta-123'}),
+    ]
+    for request in requests:
+        response = HtmlResponse(request.url, body=b'<html></html>', encoding='utf-8', request=request)
+        middleware.process_response(request, response, spider)
+
+    archive = middleware.archive
+    assert [url for url, *_ in archive.pages('listing')] == ['https://mega-hatsu.com/article-for-sale/page/1/']
+    assert [url for url, *_ in archive.pages('property')] == [PROPERTY_URL]
+    archive.close()
+
+
+def test_reextract_keeps_missing_fields_and_records_versions(tmp_path, uri, stored, versions):
+    body = (FIXTURES / 'property' / 'fukuoka-omuta-123.html').read_bytes()
+    record, _ = parse_page(PROPERTY_URL, body, 'utf-8')
+    record['sales_price'] = 20000000.0
+    record['model'] = 'KPW-A44'
+    spider = Spider('test')
+    pipeline = MegaHatsuPipeline(uri)
+    pipeline.open_spider(spider)
+    pipeline.process_item(record, spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, 'finished')
+
+    # The archived page lost its model row.
+    archive = PageArchive(str(tmp_path / 'archive'))
+    archive.add(PROPERTY_URL, body.replace('<tr><th>型式</th><td>KPW-A55</td></tr>'.encode(), b''),
+                '2024-06-30', 'property', identifier='fukuoka-omuta-123', encoding='utf-8')
+    archive.close()
+    command = Command()
+    command.settings = Settings({'DATABASE_URI': uri, 'ARCHIVE_DIR': str(tmp_path / 'archive')})
+    command.run([], Namespace(fields=None, as_of=None, identifiers=None, workers=0, dry_run=False))
+
+    engine = sqlalchemy.create_engine(uri)
+    with engine.connect() as conn:
+        row = conn.execute(sqlalchemy.text('select sales_price, model from articles')).mappings().one()
+    engine.dispose()
+    assert (row['sales_price'], row['model']) == (18500000.0, 'KPW-A44')
+    assert stored() == {'fukuoka-omuta-123': 'new'}
+    assert versions() == {'fukuoka-omuta-123': 2}
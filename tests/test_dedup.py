@@ -0,0 +1,100 @@
+"""
+Tests of `RelistDetector`: the blocking key, the score threshold and the
+pruning of the former listings still listed.
+"""
+
+import asyncio
+
+import pytest
+import sqlalchemy
+from scrapy import Spider
+
+from mega_hatsu.dedup import RelistDetector, relists, score, title_shingles
+from mega_hatsu.items import MegaHatsuItem
+from mega_hatsu.pipelines import MegaHatsuPipeline
+
+
+def make_plant(identifier, capacity=50.0, location='三重県津市大字南', price=10000000.0):
+    """Returns a property item of a plant with the compared fields."""
+    return MegaHatsuItem(
+        identifier=identifier,
+        url='https://mega-hatsu.com/article-for-sale/{}/'.format(identifier),
+        title='【値下げ】三重県津市 高圧太陽光発電所 No.{}'.format(len(identifier)),
+        property_number=float(len(identifier)),
+        total_panel_capacity=capacity,
+        Map='https://maps.google.com/?q=34.7,136.5',
+        sales_price=price,
+        installation_location=location,
+        manufacturer='カナディアンソーラー',
+    )
+
+
+def crawl(uri, items, detector):
+    """Runs a finished crawl writing the items one at a time with relist detection."""
+    spider = Spider('test')
+    pipeline = MegaHatsuPipeline(uri, streaming=True, batch_size=1)
+    pipeline.relists = detector
+    pipeline.open_spider(spider)
+    detector.ensure_table(pipeline.engine)
+    for item in items:
+        pipeline.process_item(item, spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, 'finished')
+
+
+def recorded(uri):
+    """Returns new identifier -> former identifier of the recorded relists."""
+    engine = sqlalchemy.create_engine(uri)
+    with engine.connect() as conn:
+        pairs = {row['identifier']: row['previous_identifier'] for row in relists(conn)}
+    engine.dispose()
+    return pairs
+
+
+def test_title_shingles_ignore_listing_tags():
+    assert title_shingles('【値下げ】津市 発電所 No.12') == title_shingles('津市発電所')
+    assert title_shingles('') == frozenset()
+
+
+def test_score_of_identical_and_different_plants():
+    plant = {'title': '津市 発電所', 'municipality': '津市', 'manufacturer': 'A', 'sales_price': 100.0}
+    assert score(plant, plant) == pytest.approx(1.0)
+    other = {'title': '札幌市 風車', 'municipality': '札幌市', 'manufacturer': 'B', 'sales_price': 200.0}
+    assert score(plant, other) == pytest.approx(0.0)
+
+
+def test_relisted_plant_is_recorded(uri):
+    detector = RelistDetector()
+    crawl(uri, [make_plant('a1')], detector)
+    crawl(uri, [make_plant('b1', capacity=50.2, price=9500000.0)], detector)
+
+    assert recorded(uri) == {'b1': 'a1'}
+
+
+@pytest.mark.parametrize('plant', [
+    make_plant('b1', capacity=60.0),
+    make_plant('b1', location='福岡県大牟田市岬町'),
+], ids=['capacity', 'prefecture'])
+def test_plants_outside_the_block_are_not_compared(uri, plant):
+    detector = RelistDetector()
+    crawl(uri, [make_plant('a1')], detector)
+    crawl(uri, [plant], detector)
+
+    assert recorded(uri) == {}
+
+
+def test_pairs_under_the_minimum_score_are_not_recorded(uri):
+    detector = RelistDetector(min_score=0.99)
+    crawl(uri, [make_plant('a1')], detector)
+    crawl(uri, [make_plant('b1', price=7000000.0)], detector)
+
+    assert recorded(uri) == {}
+
+
+def test_former_listing_still_listed_is_pruned(uri):
+    detector = RelistDetector()
+    crawl(uri, [make_plant('a1')], detector)
+    # b1 is written before a1 is seen, then the crawl lists a1 too.
+    crawl(uri, [make_plant('b1'), make_plant('a1')], detector)
+
+    assert recorded(uri) == {}
@@ -0,0 +1,28 @@
+"""
+Tests of `ParquetItemExporter`.
+"""
+
+import io
+
+import pytest
+
+parquet = pytest.importorskip('pyarrow.parquet')
+
+from mega_hatsu.exporters import ParquetItemExporter
+from mega_hatsu.items import MegaHatsuItem, MegaHatsuRecord, SeenItem
+
+
+def test_only_property_items_are_exported():
+    file = io.BytesIO()
+    exporter = ParquetItemExporter(file)
+    exporter.start_exporting()
+    exporter.export_item(MegaHatsuItem(identifier='a1', title='三重県津市', sales_price=1000000.0))
+    exporter.export_item(SeenItem(identifier='a2', url='https://mega-hatsu.com/article-for-sale/a2/'))
+    record = MegaHatsuRecord()
+    record['identifier'] = 'a3'
+    exporter.export_item(record)
+    exporter.finish_exporting()
+
+    table = parquet.read_table(io.BytesIO(file.getvalue()))
+    assert table.column('identifier').to_pylist() == ['a1', 'a3']
+    assert table.column('sales_price').to_pylist() == [1000000.0, None]
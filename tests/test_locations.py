@@ -0,0 +1,57 @@
+"""
+Tests of the address parsing of `locations.py` and of the location backfill.
+"""
+
+import pytest
+import sqlalchemy
+
+from mega_hatsu import storage
+from mega_hatsu.locations import locate, parse_location
+from mega_hatsu.storage import open_backend
+
+
+@pytest.mark.parametrize('address, code, municipality', [
+    ('三重県津市大字南', 24, '津市'),
+    ('〒514-0001 三重県津市江戸橋', 24, '津市'),
+    ('三重県多気郡多気町', 24, '多気郡多気町'),
+    ('愛知県名古屋市中区', 23, '名古屋市'),
+    ('三重県四日市市', 24, '四日市市'),
+    ('福島県郡山市', 7, '郡山市'),
+    ('奈良県大和郡山市', 29, '大和郡山市'),
+    ('富山県中新川郡上市町', 16, '中新川郡上市町'),
+    ('北海道余市郡余市町黒川町', 1, '余市郡余市町'),
+    ('北海道余市郡仁木町', 1, '余市郡仁木町'),
+    ('奈良県高市郡明日香村', 29, '高市郡明日香村'),
+    ('福岡大牟田市岬町', 40, '大牟田市'),
+])
+def test_parse_location(address, code, municipality):
+    location = parse_location(address)
+    assert (location.prefecture_code, location.municipality) == (code, municipality)
+
+
+def test_locate_falls_back_to_the_title():
+    location = locate('大字南', title='三重県 津市 太陽光発電所')
+    assert location.prefecture_code == 24
+
+
+def test_stored_rows_are_located_once_by_the_migration(uri, monkeypatch):
+    engine = sqlalchemy.create_engine(uri)
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text(
+            'create table articles (identifier text primary key, installation_location text, '
+            'title text, geodetic_point text)'
+        ))
+        conn.execute(sqlalchemy.text("insert into articles values ('a1', '北海道余市郡仁木町', null, null)"))
+    backend = open_backend(uri)
+    backend.ensure_schema()
+    with engine.connect() as conn:
+        row = conn.execute(sqlalchemy.text('select prefecture_code, municipality from articles')).one()
+    assert tuple(row) == (1, '余市郡仁木町')
+
+    def backfill_locations(engine):
+        raise AssertionError('located again')
+
+    monkeypatch.setattr(storage, 'backfill_locations', backfill_locations)
+    backend.ensure_schema()
+    backend.engine.dispose()
+    engine.dispose()
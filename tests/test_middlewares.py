@@ -0,0 +1,63 @@
+"""
+Tests of the retries of `MegaHatsuDownloaderMiddleware` and of `FetchFailures`.
+"""
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from mega_hatsu.middlewares import MegaHatsuDownloaderMiddleware
+from mega_hatsu.retry import FetchFailures
+
+
+class ListingSpider(Spider):
+    name = 'test'
+
+    def parse_individuals(self, response):
+        pass
+
+
+def test_retries_wait_outside_the_downloader():
+    crawler = get_crawler(Spider, {'RETRY_TIMES': 1, 'RETRY_HTTP_CODES': [503]})
+    crawler.spider = crawler._create_spider('test')
+    middleware = MegaHatsuDownloaderMiddleware.from_crawler(crawler)
+    request = Request('https://mega-hatsu.com/article-for-sale/a1/', meta={'identifier': 'a1'})
+    response = HtmlResponse(request.url, status=503, request=request)
+
+    assert middleware.process_request(request, crawler.spider) is None
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(request, response, crawler.spider)
+    assert len(middleware.delayed) == 1 and middleware.delayed[0].active()
+    with pytest.raises(DontCloseSpider):
+        middleware.spider_idle(crawler.spider)
+
+    middleware.spider_closed(crawler.spider)
+    assert not middleware.delayed[0].active()
+    middleware.spider_idle(crawler.spider)
+    assert not middleware.failures
+
+
+def test_pages_given_up_on_are_recorded():
+    crawler = get_crawler(Spider, {'RETRY_TIMES': 1, 'RETRY_HTTP_CODES': [503]})
+    crawler.spider = crawler._create_spider('test')
+    middleware = MegaHatsuDownloaderMiddleware.from_crawler(crawler)
+    request = Request('https://mega-hatsu.com/article-for-sale/a1/', meta={'identifier': 'a1', 'retry_times': 1})
+    response = HtmlResponse(request.url, status=503, request=request)
+
+    assert middleware.process_response(request, response, crawler.spider) is response
+    assert middleware.failures.identifiers == {'a1'}
+    assert middleware.delayed == []
+
+
+def test_only_listing_pages_block_the_deletions():
+    spider = ListingSpider()
+    failures = FetchFailures()
+    assert failures.record(Request('https://mega-hatsu.com/robots.txt')) is None
+    assert failures.record(Request('https://mega-hatsu.com/article-for-sale/')) == 'others'
+    assert failures.complete and len(failures) == 1
+
+    request = Request('https://mega-hatsu.com/article-for-sale/page/2/', callback=spider.parse_individuals)
+    assert failures.record(request) == 'listings'
+    assert not failures.complete
@@ -0,0 +1,174 @@
+"""
+Tests of `MegaHatsuPipeline` against an embedded SQLite database.
+"""
+
+import asyncio
+
+import pytest
+import sqlalchemy
+from scrapy import Request, Spider, signals
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from mega_hatsu.items import MegaHatsuItem
+from mega_hatsu.middlewares import IncrementalCrawlMiddleware
+from mega_hatsu.pipelines import MegaHatsuPipeline
+
+
+def make_item(identifier, price=1000000.0):
+    """Returns a property item with the required fields."""
+    return MegaHatsuItem(
+        identifier=identifier,
+        url='https://mega-hatsu.com/article-for-sale/{}/'.format(identifier),
+        title='三重県津市 {}'.format(identifier),
+        property_number=float(identifier[1:]),
+        total_panel_capacity=50.0,
+        Map='https://maps.google.com/?q=34.7,136.5',
+        sales_price=price,
+        installation_location='三重県津市大字南',
+    )
+
+
+def test_items_are_written_without_streaming(uri, stored):
+    spider = Spider('test')
+    pipeline = MegaHatsuPipeline(uri, streaming=False)
+    pipeline.open_spider(spider)
+    for identifier in ('a1', 'a2', 'a1'):
+        pipeline.process_item(make_item(identifier), spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, 'finished')
+
+    assert stored() == {'a1': 'new', 'a2': 'new'}
+
+
+def crawl(uri, items, reason='finished', streaming=True):
+    """Runs a crawl storing the items, closed for `reason`."""
+    spider = Spider('test')
+    pipeline = MegaHatsuPipeline(uri, streaming=streaming)
+    pipeline.open_spider(spider)
+    for item in items:
+        pipeline.process_item(item, spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, reason)
+
+
+def test_versions_record_changes_not_crawls(uri, stored, versions):
+    crawl(uri, [make_item('a1'), make_item('a2'), make_item('a3')])
+    crawl(uri, [make_item('a1'), make_item('a2', price=900000.0)])
+    crawl(uri, [make_item('a1'), make_item('a2', price=900000.0), make_item('a3')])
+
+    assert stored() == {'a1': 'still available', 'a2': 'still available', 'a3': 'still available'}
+    # a2: price drop; a3: deleted, then listed again.
+    assert versions() == {'a1': 1, 'a2': 2, 'a3': 3}
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+@pytest.mark.parametrize('reason', ['field_health', 'shutdown', 'closespider_itemcount'])
+def test_crawl_closed_early_marks_nothing_deleted(reason, streaming, uri, stored, versions):
+    crawl(uri, [make_item('a1'), make_item('a2'), make_item('a3')])
+    crawl(uri, [make_item('a1', price=900000.0)], reason=reason, streaming=streaming)
+
+    assert stored() == {'a1': 'still available', 'a2': 'new', 'a3': 'new'}
+    assert versions() == {'a1': 2, 'a2': 1, 'a3': 1}
+
+
+def test_pages_in_flight_at_a_hard_kill_are_not_deleted(tmp_path, uri, stored):
+    jobdir = str(tmp_path / 'job')
+    crawl(uri, [make_item(identifier) for identifier in ('a1', 'a2', 'a3', 'a4')])
+    spider = Spider('test')
+
+    # First run: a1 to a3 are scheduled, only a1 is scraped before the kill.
+    pipeline = MegaHatsuPipeline(uri, jobdir=jobdir, batch_size=1)
+    pipeline.open_spider(spider)
+    for identifier in ('a1', 'a2', 'a3'):
+        pipeline.request_scheduled(Request('https://mega-hatsu.com/', meta={'identifier': identifier}), spider)
+    pipeline.process_item(make_item('a1'), spider)
+    pipeline.checkpoint.close()
+    pipeline.engine.dispose()
+
+    # Second run: the queue on disk only holds a2; a3 was in flight.
+    pipeline = MegaHatsuPipeline(uri, jobdir=jobdir, batch_size=1)
+    pipeline.open_spider(spider)
+    pipeline.process_item(make_item('a2'), spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, 'finished')
+
+    assert stored() == {'a1': 'still available', 'a2': 'still available', 'a3': 'new', 'a4': 'deleted'}
+
+
+def test_failed_write_marks_nothing_deleted(monkeypatch, uri, stored):
+    crawl(uri, [make_item('a1'), make_item('a2')])
+    spider = Spider('test')
+    pipeline = MegaHatsuPipeline(uri, streaming=True, batch_size=1)
+    pipeline.open_spider(spider)
+
+    def upsert(conn, table, rows):
+        raise sqlalchemy.exc.OperationalError('upsert', {}, Exception('disk full'))
+
+    monkeypatch.setattr(pipeline.backend, 'upsert', upsert)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        pipeline.process_item(make_item('a1'), spider)
+    asyncio.run(pipeline.close_spider(spider))
+    pipeline.spider_closed(spider, 'finished')
+
+    assert pipeline.write_failed
+    assert stored() == {'a1': 'new', 'a2': 'new'}
+
+
+def incremental_crawl(uri, tmp_path, body, price, fail=False):
+    """
+    Runs an incremental crawl fetching the page of a1 with `body` and
+    storing it at `price`, whose batch write fails with `fail`.
+
+    Returns:
+        bool: Whether the page was flagged 'unchanged'.
+    """
+    crawler = get_crawler(Spider, {
+        'INCREMENTAL_CRAWL': True,
+        'FINGERPRINT_CACHE': str(tmp_path / 'fingerprints.sqlite'),
+        'DATABASE_URI': uri,
+        'POSTGRES_STREAMING': True,
+    })
+    spider = crawler._create_spider('test')
+    middleware = IncrementalCrawlMiddleware.from_crawler(crawler)
+    pipeline = MegaHatsuPipeline.from_crawler(crawler)
+    pipeline.open_spider(spider)
+    if fail:
+        def upsert(conn, table, rows):
+            raise sqlalchemy.exc.OperationalError('upsert', {}, Exception('disk full'))
+        pipeline.backend.upsert = upsert
+
+    request = Request('https://mega-hatsu.com/article-for-sale/a1/', meta={'identifier': 'a1'})
+    middleware.process_request(request, spider)
+    response = middleware.process_response(
+        request, HtmlResponse(request.url, body=body, request=request), spider
+    )
+    unchanged = 'unchanged' in response.flags
+    if not unchanged:
+        # The item is buffered, the engine reports it scraped before its batch is written.
+        item = pipeline.process_item(make_item('a1', price=price), spider)
+        crawler.signals.send_catch_log(signals.item_scraped, item=item, response=response, spider=spider)
+    try:
+        asyncio.run(pipeline.close_spider(spider))
+    except sqlalchemy.exc.OperationalError:
+        assert fail
+    crawler.signals.send_catch_log(signals.spider_closed, spider=spider, reason='finished')
+    return unchanged
+
+
+def test_pages_of_failed_batches_are_fetched_again(uri, tmp_path, versions):
+    assert not incremental_crawl(uri, tmp_path, b'<html>1</html>', 1000000.0)
+    assert incremental_crawl(uri, tmp_path, b'<html>1</html>', 1000000.0)
+    assert not incremental_crawl(uri, tmp_path, b'<html>2</html>', 900000.0, fail=True)
+    assert versions() == {'a1': 1}
+
+    assert not incremental_crawl(uri, tmp_path, b'<html>2</html>', 900000.0)
+    assert versions() == {'a1': 2}
+    assert incremental_crawl(uri, tmp_path, b'<html>2</html>', 900000.0)
+
+
+def test_crawl_seeing_no_stored_property_marks_nothing_deleted(uri, stored):
+    crawl(uri, [make_item('a1'), make_item('a2')])
+    crawl(uri, [], streaming=False)
+
+    assert stored() == {'a1': 'new', 'a2': 'new'}
@@ -0,0 +1,34 @@
+"""
+Tests of the numeric input processors.
+"""
+
+import pytest
+
+from mega_hatsu.processors import parse_number, parse_numbers
+
+
+@pytest.mark.parametrize('text, number', [
+    ('1,234', 1234.0),
+    ('75.6kW', 75.6),
+    ('１０．５％', 10.5),
+    ('1,850万円', 18500000.0),
+    ('18.5百万円（税込 20,350,000円）', 18500000.0),
+    ('1億2000万', 120000000.0),
+    ('1億2000万円', 120000000.0),
+    ('3億5千万', 350000000.0),
+    ('1万5000円', 15000.0),
+    ('10〜12年', 10.0),
+    ('10-12年', 10.0),
+    ('-3.2%', -3.2),
+    ('－５', -5.0),
+    ('2千万 5年', 20000000.0),
+    ('なし', None),
+    (None, None),
+    (19.8, 19.8),
+])
+def test_parse_number(text, number):
+    assert parse_number(text) == number
+
+
+def test_parse_numbers_drops_values_without_a_number():
+    assert parse_numbers(['1,234', '-', 'なし', '5万']) == [1234.0, 50000.0]